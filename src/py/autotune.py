@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import itertools
+import argparse
+import torch
+import common
+import cnn
+import rnn
+import rnn_gru
+import cnn_rl
+import deep_cnn
+import inceptionv3
+from torchvision import models
+
+# Model constructor, input preparation and optimizer for each tunable model, matching their train loops
+MODELS = {
+    'cnn':         ( cnn.StandardCNN,                          None,                           lambda p: torch.optim.RMSprop( p, lr=1e-3 ) ),
+    'rnn':         ( rnn.StandardRNN,                          common.image_to_sequence,       lambda p: torch.optim.Adam( p, lr=1e-4, weight_decay=1e-6 ) ),
+    'rnn_gru':     ( rnn_gru.StandardRNN,                      common.image_to_sequence,       lambda p: torch.optim.Adam( p, lr=1e-4, weight_decay=1e-6 ) ),
+    'cnn_rl':      ( cnn_rl.CNN_RL,                            None,                           lambda p: torch.optim.RMSprop( p, lr=1e-3 ) ),
+    'deep_cnn':    ( deep_cnn.DeepCNN,                         None,                           lambda p: torch.optim.RMSprop( p, lr=1e-3 ) ),
+    'inceptionv3': ( lambda: models.Inception3( num_classes=2 ), inceptionv3.to_inception_input, lambda p: torch.optim.RMSprop( p, lr=1e-3 ) ),
+}
+
+# Search space. Thread counts are fractions of the machine's cores
+BATCH_SIZES      = [ 16, 32, 64, 128, 256 ]
+THREAD_FRACTIONS = [ 0.25, 0.5, 1.0 ]
+NUM_WORKERS      = [ 0, 2, 4 ]
+
+def get_search_space():
+    """
+    Every combination of batch size, thread count, DataLoader workers and pin_memory to try.
+    Pinned memory only matters when copying batches to a GPU.
+    """
+    threads     = sorted( set( max( 1, int( os.cpu_count() * f ) ) for f in THREAD_FRACTIONS ) )
+    pin_options = [ False, True ] if common.device.type == 'cuda' else [ False ]
+
+    return [
+        { 'batch_size': b, 'num_threads': t, 'num_workers': w, 'pin_memory': p }
+        for b, t, w, p in itertools.product( BATCH_SIZES, threads, NUM_WORKERS, pin_options )
+    ]
+
+def run_trial( model_name: str, dataset, config: dict, mode: str, n_steps: int ):
+    """
+    Times n_steps batches of training or scoring with the given settings, after one untimed warmup batch.
+    Data loading is included, since that's what workers and pinned memory change.
+    Returns samples per second.
+    """
+    make_model, prepare_input, make_optimizer = MODELS[model_name]
+
+    torch.set_num_threads( config['num_threads'] )
+    loader = torch.utils.data.DataLoader( dataset, batch_size=config['batch_size'], shuffle=False,
+                                          num_workers=config['num_workers'], pin_memory=config['pin_memory'] )
+
+    model     = make_model().to( common.device )
+    optimizer = make_optimizer( model.parameters() )
+    criterion = torch.nn.modules.loss.CrossEntropyLoss()
+
+    if mode == 'train':
+        model.train()
+    else:
+        model.eval()
+
+    n_samples = 0
+    batches   = iter( loader )
+    for step in range( n_steps + 1 ):
+        # Start timing after the warmup batch, which also pays for spawning workers
+        if step == 1:
+            start_time = time.perf_counter()
+            n_samples  = 0
+
+        try:
+            data, target = next( batches )
+        except StopIteration:
+            break
+
+        data, target = data.to( common.device, non_blocking=True ), target.to( common.device, non_blocking=True )
+        if prepare_input is not None:
+            data = prepare_input( data )
+
+        if mode == 'train':
+            optimizer.zero_grad()
+            outputs = model( data )
+            # Inception3 also returns its aux classifier's output while training
+            if isinstance( outputs, tuple ):
+                outputs = outputs[0]
+            loss = criterion( outputs, target )
+            loss.backward()
+            optimizer.step()
+        else:
+            with torch.no_grad():
+                model( data )
+
+        n_samples = n_samples + len( target )
+
+    if common.device.type == 'cuda':
+        torch.cuda.synchronize()
+
+    return n_samples / ( time.perf_counter() - start_time )
+
+def save_tuned_config( model_name: str, mode: str, config: dict ):
+    """
+    Stores config for model_name and mode under this machine's fingerprint, keeping all other entries.
+    """
+    configs     = common.load_tuned_configs()
+    fingerprint = common.get_machine_fingerprint()
+    configs.setdefault( fingerprint, dict() ).setdefault( model_name, dict() )[mode] = config
+
+    tmp_path = common.get_autotune_path() + '.tmp'
+    with open( tmp_path, 'w' ) as f:
+        json.dump( configs, f, indent=1 )
+    os.replace( tmp_path, common.get_autotune_path() )
+
+def autotune( model_name: str, data_path: str, modes=( 'train', 'score' ), n_steps: int = 10 ):
+    """
+    Tries every setting in the search space on the train split of data_path and saves the fastest for each mode.
+    """
+    train_loader, _, _ = common.load_data( data_path=data_path )
+    dataset = train_loader.dataset
+
+    print( f"\nAutotuning {model_name} on machine {common.get_machine_fingerprint()} ({os.cpu_count()} cores)" )
+
+    for mode in modes:
+        print( f"\n{mode}:" )
+        print( "%10s %10s %10s %10s %14s" % ( "batch", "threads", "workers", "pinned", "samples/sec" ) )
+
+        best = None
+        for config in get_search_space():
+            # Trials need n_steps full batches after the warmup one
+            if config['batch_size'] * ( n_steps + 1 ) > len( dataset ):
+                continue
+
+            throughput = run_trial( model_name, dataset, config, mode, n_steps )
+            print( "%10d %10d %10d %10s %14.1f" % ( config['batch_size'], config['num_threads'], config['num_workers'], config['pin_memory'], throughput ) )
+
+            if best is None or throughput > best[1]:
+                best = ( config, throughput )
+
+        if best is None:
+            print( f"Train split too small for {n_steps} step trials" )
+            continue
+
+        config, throughput = best
+        save_tuned_config( model_name, mode, dict( config, samples_per_sec=throughput ) )
+        print( "Best: batch size %d, %d threads, %d workers, pin_memory=%s at %.1f samples/sec" % (
+            config['batch_size'], config['num_threads'], config['num_workers'], config['pin_memory'], throughput ) )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str, choices=list(MODELS) + ['all'],
+                        help='Model to tune settings for')
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR')
+    parser.add_argument('-m', '--mode', type=str, choices=['train', 'score', 'both'], default='both',
+                        help='Tune training, scoring or both')
+    parser.add_argument('-s', '--n_steps', type=int, default=10,
+                        help='Number of timed batches per trial')
+    common.add_common_args(parser)
+    args = parser.parse_args()
+    common.apply_common_args(args)
+
+    cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+    modes = ( 'train', 'score' ) if args.mode == 'both' else ( args.mode, )
+    model_names = list( MODELS ) if args.model == 'all' else [ args.model ]
+
+    for model_name in model_names:
+        autotune( model_name, cohort_path, modes, args.n_steps )
@@ -0,0 +1,213 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import common
+
+def load_score_columns( csv_file_path, cols ):
+    """
+    Reads only the given column positions from an exported clinical score csv.
+    Returns a dict mapping each position to a float64 numpy array.
+    """
+    # usecols keeps file order, so look the columns back up by their original position
+    header = pd.read_csv( csv_file_path, nrows=0 ).columns
+    df     = pd.read_csv( csv_file_path, usecols=sorted( set( int(c) for c in cols ) ) )
+
+    return { c: df[header[c]].to_numpy( dtype=np.float64 ) for c in cols }
+
+def load_score_csv( csv_file_path, score_col, died_col ):
+    """
+    Loads patient id, visit id, a clinical score and ground truth from an exported
+    clinical score csv, reading only those columns.
+    """
+    cols = load_score_columns( csv_file_path, [ common.MEWS_rows.PATIENT_ID, common.MEWS_rows.VISIT_ID, score_col, died_col ] )
+
+    patient_ids = cols[common.MEWS_rows.PATIENT_ID].astype( np.int64 )
+    visit_ids   = cols[common.MEWS_rows.VISIT_ID].astype( np.int64 )
+    died        = cols[died_col].astype( np.int64 )
+
+    return patient_ids, visit_ids, cols[score_col], died
+
+def load_model_outputs( output_csv_path ):
+    """
+    Loads model scores written by common.dump_outputs along with the patient and
+    visit ids parsed from the image names. Output files written without scores and
+    image names can't be joined, so those are rejected.
+    """
+    df = pd.read_csv( output_csv_path, header=None )
+    if df.shape[1] < 4:
+        raise ValueError( f"{output_csv_path} has no score/image name columns, rerun the model to regenerate it" )
+
+    # Image names are <patient_id>_<visit_id>_<died>.png
+    ids = df[3].str.split( '_', expand=True )
+
+    patient_ids = ids[0].astype( np.int64 ).to_numpy()
+    visit_ids   = ids[1].astype( np.int64 ).to_numpy()
+    score       = df[2].to_numpy( dtype=np.float64 )
+    died        = df[1].to_numpy( dtype=np.int64 )
+
+    return patient_ids, visit_ids, score, died
+
+def compute_curves( y_true, y_score ):
+    """
+    Computes the full ROC and PR curves of a continuous score in one sorted pass.
+    A visit is predicted positive when its score is >= the threshold.
+    Returns a dict of per-threshold arrays along with AUC, average precision
+    and the optimal threshold by Youden's J statistic.
+    """
+    y_true  = np.asarray( y_true,  dtype=np.int64   )
+    y_score = np.asarray( y_score, dtype=np.float64 )
+
+    # Sort descending by score, stable so ties keep their input order
+    order   = np.argsort( -y_score, kind='mergesort' )
+    y_true  = y_true[order]
+    y_score = y_score[order]
+
+    # Last index of each run of tied scores is where a threshold takes effect
+    ends = np.r_[ np.flatnonzero( np.diff( y_score ) ), y_true.size - 1 ]
+
+    tps = np.cumsum( y_true )[ends]
+    fps = ( ends + 1 ) - tps
+    n_pos = tps[-1]
+    n_neg = fps[-1]
+    fns = n_pos - tps
+    tns = n_neg - fps
+
+    thresholds = y_score[ends]
+    tpr        = tps / max( n_pos, 1 )
+    fpr        = fps / max( n_neg, 1 )
+    precision  = tps / ( tps + fps )
+    accuracy   = ( tps + tns ) / y_true.size
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        f1 = np.nan_to_num( 2 * precision * tpr / ( precision + tpr ) )
+
+    # Anchor ROC at the origin and integrate with the trapezoid rule
+    roc_fpr = np.r_[ 0.0, fpr ]
+    roc_tpr = np.r_[ 0.0, tpr ]
+    auc     = np.sum( np.diff( roc_fpr ) * ( roc_tpr[1:] + roc_tpr[:-1] ) / 2.0 )
+
+    # Average precision as the recall-weighted sum of precisions
+    ap = np.sum( np.diff( np.r_[ 0.0, tpr ] ) * precision )
+
+    best = int( np.argmax( tpr - fpr ) )
+
+    return {
+        'thresholds': thresholds,
+        'fpr':        fpr,
+        'tpr':        tpr,
+        'precision':  precision,
+        'accuracy':   accuracy,
+        'f1':         f1,
+        'tp': tps, 'fp': fps, 'tn': tns, 'fn': fns,
+        'auc':        auc,
+        'ap':         ap,
+        'best':       best,
+    }
+
+def calibration_table( y_true, y_score ):
+    """
+    Observed mortality for each distinct score value. For integer clinical scores
+    this is the empirical mapping from score to risk.
+    """
+    y_true = np.asarray( y_true, dtype=np.int64 )
+    values, inverse = np.unique( np.asarray( y_score, dtype=np.float64 ), return_inverse=True )
+
+    n_visits = np.bincount( inverse )
+    n_died   = np.bincount( inverse, weights=y_true )
+
+    return values, n_visits, n_died / n_visits
+
+def print_sweep( label, y_true, y_score, fixed_threshold=None ):
+    """
+    Prints AUC, AP and metrics at the optimal threshold, and at fixed_threshold if given.
+    """
+    curves = compute_curves( y_true, y_score )
+    best   = curves['best']
+
+    print( f"\n{label}: n={len(y_true)} positives={int(np.sum(y_true))}" )
+    print( "     AUC: %.6f" % curves['auc'] )
+    print( "      AP: %.6f" % curves['ap'] )
+    print( "Optimal threshold (Youden's J): score >= %g" % curves['thresholds'][best] )
+    common.print_scores( "optimal", curves['accuracy'][best], curves['auc'], curves['precision'][best], curves['tpr'][best], curves['f1'][best] )
+
+    if fixed_threshold is not None:
+        # Index of the lowest sweep threshold still strictly above the fixed one
+        i = np.searchsorted( -curves['thresholds'], -fixed_threshold, side='left' ) - 1
+        if i >= 0:
+            common.print_scores( "fixed", curves['accuracy'][i], curves['auc'], curves['precision'][i], curves['tpr'][i], curves['f1'][i] )
+
+    return curves
+
+def print_calibration( label, y_true, y_score ):
+    """
+    Prints observed mortality per distinct score value.
+    """
+    values, n_visits, mortality = calibration_table( y_true, y_score )
+
+    print( f"\n{label} calibration:" )
+    print( "%10s %10s %10s" % ( "score", "visits", "mortality" ) )
+    for v, n, m in zip( values, n_visits, mortality ):
+        print( "%10g %10d %10.4f" % ( v, n, m ) )
+
+def compare_with_model( label, patient_ids, visit_ids, score, died, output_csv_path ):
+    """
+    Joins baseline scores with model scores on patient/visit id and
+    compares both on the shared set of visits.
+    """
+    m_patient_ids, m_visit_ids, m_score, m_died = load_model_outputs( output_csv_path )
+
+    _, idx_base, idx_model = np.intersect1d( visit_ids, m_visit_ids, assume_unique=False, return_indices=True )
+    if len( idx_base ) == 0:
+        print( f"\nNo visits in common between {label} and {os.path.basename(output_csv_path)}" )
+        return
+
+    mismatched = np.sum( patient_ids[idx_base] != m_patient_ids[idx_model] ) + np.sum( died[idx_base] != m_died[idx_model] )
+    if mismatched > 0:
+        print( f"Warning: {mismatched} joined visits disagree on patient id or ground truth" )
+
+    base_curves  = compute_curves( died[idx_base], score[idx_base] )
+    model_curves = compute_curves( m_died[idx_model], m_score[idx_model] )
+
+    print( f"\n{label} vs {os.path.basename(output_csv_path)} on {len(idx_base)} shared visits:" )
+    print( "%8s %-12s %-12s" % ( " ", "AUC", "AP" ) )
+    print( "%8s %.10f %.10f" % ( label, base_curves['auc'], base_curves['ap'] ) )
+    print( "%8s %.10f %.10f" % ( "model", model_curves['auc'], model_curves['ap'] ) )
+    print( "%8s %+.10f %+.10f" % ( "delta", model_curves['auc'] - base_curves['auc'], model_curves['ap'] - base_curves['ap'] ) )
+
+def evaluate_baseline( csv_file_path, score_col, died_col, label, fixed_threshold=None, output_csv_path=None ):
+    """
+    Evaluates a clinical score as a continuous predictor of mortality.
+    """
+    patient_ids, visit_ids, score, died = load_score_csv( csv_file_path, score_col, died_col )
+
+    print_sweep( label, died, score, fixed_threshold )
+    print_calibration( label, died, score )
+
+    if output_csv_path is not None:
+        compare_with_model( label, patient_ids, visit_ids, score, died, output_csv_path )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_file', type=str,
+                        help='Exported MEWS or SOFA csv, relative to DATA_DIR')
+    parser.add_argument('score', type=str, choices=['mews', 'sofa', 'sofa_est'],
+                        help='Which clinical score the csv holds')
+    parser.add_argument('-o', '--model_outputs', type=str, nargs=1,
+                        help='Model output csv written by dump_outputs, relative to DATA_DIR')
+    args = parser.parse_args()
+
+    path = os.path.join( os.getenv('DATA_DIR'), args.csv_file )
+
+    output_path = None
+    if args.model_outputs is not None:
+        output_path = os.path.join( os.getenv('DATA_DIR'), args.model_outputs[0] )
+
+    if args.score == 'mews':
+        evaluate_baseline( path, common.MEWS_rows.MEWS_SCORE, common.MEWS_rows.DIED, "MEWS", common.MEWS_THRESHOLD, output_path )
+    elif args.score == 'sofa':
+        evaluate_baseline( path, common.SOFA_rows.SOFA_SCORE, common.SOFA_rows.DIED, "SOFA", common.SOFA_SCORE_THRESHOLD, output_path )
+    else:
+        evaluate_baseline( path, common.SOFA_rows.EST_MORTALITY, common.SOFA_rows.DIED, "SOFA est", common.SOFA_EST_THRESHOLD, output_path )
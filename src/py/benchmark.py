@@ -0,0 +1,207 @@
+import time
+import argparse
+import torch
+import os
+import common
+import cnn
+import rnn
+import rnn_gru
+import cnn_rl
+import deep_cnn
+import inceptionv3
+from torchvision import models
+
+def time_call( fn, n_iters, n_warmup=3 ):
+    """
+    Average wall time of fn() in seconds over n_iters calls, after n_warmup untimed calls.
+    """
+    for _ in range( n_warmup ):
+        fn()
+
+    start_time = time.perf_counter()
+    for _ in range( n_iters ):
+        fn()
+
+    return ( time.perf_counter() - start_time ) / n_iters
+
+def benchmark_cnn_rl_recurrent( batch_size=128, n_iters=20 ):
+    """
+    Compares CNN_RL's fused recurrent layer against the ConvLSTM_pytorch submodule.
+    Both models share weights, so outputs are checked for equivalence before timing
+    forward and forward+backward passes.
+    """
+    torch.manual_seed( 0 )
+    x = torch.rand( ( batch_size, ) + common.get_input_shape() )
+
+    fused = cnn_rl.CNN_RL( fused_recurrent=True )
+
+    try:
+        reference = cnn_rl.CNN_RL( fused_recurrent=False )
+    except ImportError as e:
+        reference = None
+        print( f"ConvLSTM_pytorch submodule unavailable ({e}), timing fused path only" )
+
+    models = { 'fused': fused }
+    if reference is not None:
+        # Copy the submodule's weights into the fused model so both compute the same function
+        fused.load_state_dict( cnn_rl.convert_convlstm_state_dict( reference.state_dict() ) )
+        models['convlstm'] = reference
+
+        with torch.no_grad():
+            max_diff = ( fused( x ) - reference( x ) ).abs().max().item()
+        print( "Max abs difference between fused and ConvLSTM outputs: %.3e" % max_diff )
+
+    print( "%10s %14s %14s" % ( " ", "forward ms", "fwd+bwd ms" ) )
+    for name, model in models.items():
+        def forward():
+            with torch.no_grad():
+                model( x )
+
+        def forward_backward():
+            model.zero_grad()
+            model( x ).sum().backward()
+
+        model.eval()
+        t_fwd = time_call( forward, n_iters )
+        model.train()
+        t_bwd = time_call( forward_backward, n_iters )
+        print( "%10s %14.3f %14.3f" % ( name, t_fwd * 1000, t_bwd * 1000 ) )
+
+def benchmark_deep_cnn( batch_size=16, n_iters=20, data_path=None, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
+    """
+    Compares the native resolution DeepCNN against Inception3 on upsampled inputs.
+    Times inference on synthetic batches, including Inception's upsampling, and when
+    data_path is given also trains both on that cohort and compares val AUC.
+    """
+    torch.manual_seed( 0 )
+    x = torch.rand( ( batch_size, ) + common.get_input_shape() ).to( common.device )
+
+    deep = deep_cnn.DeepCNN().to( common.device )
+    inception = models.Inception3( num_classes=2 ).to( common.device )
+
+    # Model, input preparation, train function and eval function for each contender
+    contenders = {
+        'deep_cnn':    ( deep,      lambda data: data,                             deep_cnn.train_deep_cnn,       deep_cnn.eval_model    ),
+        'inceptionv3': ( inception, inceptionv3.to_inception_input,                inceptionv3.train_inceptionv3, inceptionv3.eval_model ),
+    }
+
+    print( "%12s %12s %14s %14s" % ( " ", "params", "forward ms", "visits/sec" ) )
+    for name, ( model, prepare_input, _, _ ) in contenders.items():
+        def forward():
+            with torch.no_grad():
+                model( prepare_input( x ) )
+
+        model.eval()
+        t_fwd = time_call( forward, n_iters )
+        n_params = sum( p.numel() for p in model.parameters() )
+        print( "%12s %12d %14.3f %14.1f" % ( name, n_params, t_fwd * 1000, batch_size / t_fwd ) )
+
+    if data_path is None:
+        return
+
+    # Same small batches as inceptionv3.main for both, so neither gets a batch size advantage
+    train_loader, _, val_loader = common.load_data( batch_size=batch_size, data_path=data_path )
+
+    results = dict()
+    for name, ( model, _, train, eval_model ) in contenders.items():
+        print( f"\nTraining {name}" )
+        train_start_time = time.time()
+        model.train()
+        model = train( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+        train_time = time.time() - train_start_time
+
+        with torch.no_grad():
+            y_score_val, y_pred_val, y_val = eval_model( model, val_loader )
+        auc, _, _, _, _ = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
+        results[name] = ( auc, train_time )
+
+    print( "\n%12s %-12s %-12s" % ( " ", "val AUC", "train sec" ) )
+    for name, ( auc, train_time ) in results.items():
+        print( "%12s %.10f %-12.1f" % ( name, auc, train_time ) )
+
+# Module with eval_model, model class and train function for models the convergence benchmarks can train
+TRAINABLE = {
+    'cnn':      ( cnn,      cnn.StandardCNN,     cnn.train_cnn           ),
+    'rnn':      ( rnn,      rnn.StandardRNN,     rnn.train_rnn           ),
+    'rnn_gru':  ( rnn_gru,  rnn_gru.StandardRNN, rnn_gru.train_rnn       ),
+    'cnn_rl':   ( cnn_rl,   cnn_rl.CNN_RL,       cnn_rl.train_cnn_rl     ),
+    'deep_cnn': ( deep_cnn, deep_cnn.DeepCNN,    deep_cnn.train_deep_cnn ),
+}
+
+def benchmark_neg_subsampling( model_name, data_path, fractions, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
+    """
+    Trains model_name from the same initial weights once per negative sampling fraction
+    and compares epoch wall time and final val AUC. Per-epoch AUCs are printed by the train loop.
+    """
+    module, model_class, train = TRAINABLE[model_name]
+
+    torch.manual_seed( 0 )
+    initial_state = model_class().state_dict()
+
+    results = dict()
+    for fraction in fractions:
+        print( f"\nTraining {model_name} with negative fraction {fraction}" )
+        train_loader, _, val_loader = common.load_data( data_path=data_path, neg_fraction=( None if fraction >= 1.0 else fraction ) )
+
+        model = model_class().to( common.device )
+        model.load_state_dict( initial_state )
+
+        train_start_time = time.time()
+        model = train( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+        train_time = time.time() - train_start_time
+
+        with torch.no_grad():
+            y_score_val, y_pred_val, y_val = module.eval_model( model, val_loader )
+        auc, _, _, _, _ = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
+        results[fraction] = ( len( train_loader.sampler ), train_time, auc )
+
+    print( "\n%10s %14s %14s %-12s" % ( "fraction", "visits/epoch", "train sec", "val AUC" ) )
+    for fraction, ( n_visits, train_time, auc ) in results.items():
+        print( "%10g %14d %14.1f %.10f" % ( fraction, n_visits, train_time, auc ) )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, choices=['cnn_rl_recurrent', 'deep_cnn', 'neg_subsampling'],
+                        help='Which benchmark to run')
+    parser.add_argument('-b', '--batch_size', type=int,
+                        help='Batch size of the synthetic inputs, and of training for deep_cnn. Defaults to 128, or 16 for deep_cnn like inceptionv3.main')
+    parser.add_argument('-n', '--n_iters', type=int, default=20,
+                        help='Number of timed iterations')
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR, to also train and compare AUC on')
+    parser.add_argument('-e', '--n_epochs', type=int, nargs=1,
+                        help='Number of training epochs')
+    parser.add_argument('-w', '--class_weight', type=float, nargs=1,
+                        help='Class weight ratio to use for training')
+    parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
+                        help='Learning rate to use for training')
+    parser.add_argument('-m', '--model', type=str, default='cnn', choices=list(TRAINABLE),
+                        help='Model to train for convergence benchmarks')
+    parser.add_argument('-f', '--fractions', type=float, nargs='+', default=[1.0, 0.25],
+                        help='Negative sampling fractions to compare')
+    common.add_common_args(parser)
+    args = parser.parse_args()
+    common.apply_common_args(args)
+
+    if args.benchmark == 'cnn_rl_recurrent':
+        benchmark_cnn_rl_recurrent( 128 if args.batch_size is None else args.batch_size, args.n_iters )
+    elif args.benchmark == 'deep_cnn':
+        cohort_path = None
+        if args.cohort is not None:
+            cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+        n_epochs      = common.N_EPOCH if args.n_epochs is None else args.n_epochs[0]
+        class_weight  = common.CLASS_WEIGHT_RATIO if args.class_weight is None else args.class_weight[0]
+        learning_rate = 1e-3 if args.learning_rate is None else args.learning_rate[0]
+
+        benchmark_deep_cnn( 16 if args.batch_size is None else args.batch_size, args.n_iters, cohort_path, n_epochs, class_weight, learning_rate )
+    elif args.benchmark == 'neg_subsampling':
+        cohort_path   = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+        n_epochs      = common.N_EPOCH if args.n_epochs is None else args.n_epochs[0]
+        class_weight  = common.CLASS_WEIGHT_RATIO if args.class_weight is None else args.class_weight[0]
+        learning_rate = 1e-3 if args.learning_rate is None else args.learning_rate[0]
+
+        benchmark_neg_subsampling( args.model, cohort_path, args.fractions, n_epochs, class_weight, learning_rate )
@@ -0,0 +1,67 @@
+import os
+import time
+import torch
+import common
+import distributed
+
+CHECKPOINT_EXT = '.ckpt'
+
+def get_checkpoint_path( checkpoint_dir: str, model_name: str ):
+    """
+    Checkpoints are stored as <DATA_DIR>/<checkpoint_dir>/<model_name>.ckpt
+    """
+    return os.path.join( os.getenv('DATA_DIR'), checkpoint_dir, model_name + CHECKPOINT_EXT )
+
+def save( model_name: str, model, optimizer, data_path: str ):
+    """
+    Saves model weights, optimizer state and the input layout to common.CHECKPOINT_DIR, if set.
+    Only rank 0 writes when distributed.
+    """
+    if common.CHECKPOINT_DIR is None or not distributed.is_main_rank():
+        return
+
+    path = get_checkpoint_path( common.CHECKPOINT_DIR, model_name )
+    os.makedirs( os.path.dirname( path ), exist_ok=True )
+
+    state = {
+        'model':         model_name,
+        'state_dict':    distributed.unwrap_model( model ).state_dict(),
+        'optimizer':     optimizer.state_dict(),
+        'input_shape':   list( common.get_input_shape() ),
+        'channels':      [ c.name for c in common.IMG_CHANNELS ],
+        'n_hours':       common.N_HOURS,
+        'hours_per_col': common.HOURS_PER_COL,
+        'cohort':        os.path.basename( os.path.normpath( data_path ) ),
+        'created':       time.time(),
+    }
+
+    # Write then rename, so an interrupted save never clobbers the previous checkpoint
+    torch.save( state, path + '.tmp' )
+    os.replace( path + '.tmp', path )
+    print( f"Saved checkpoint {path}" )
+
+def warm_start( model_name: str, model, optimizer ):
+    """
+    Loads weights, and optimizer state if common.WARM_START_OPTIMIZER, from the checkpoint
+    for model_name in common.WARM_START_DIR, if set. The checkpoint must have been trained
+    on the same input layout.
+    """
+    if common.WARM_START_DIR is None:
+        return
+
+    path  = get_checkpoint_path( common.WARM_START_DIR, model_name )
+    state = torch.load( path, map_location=common.device )
+
+    if tuple( state['input_shape'] ) != common.get_input_shape() or state['channels'] != [ c.name for c in common.IMG_CHANNELS ]:
+        raise ValueError( f"Checkpoint {path} was trained on {state['channels']} {state['input_shape']} inputs, "
+                          f"rerun with matching --channels/--horizon/--resolution" )
+
+    distributed.unwrap_model( model ).load_state_dict( state['state_dict'] )
+    if common.WARM_START_OPTIMIZER:
+        # Keep this run's learning rate rather than the one the previous run ended on
+        learning_rates = [ group['lr'] for group in optimizer.param_groups ]
+        optimizer.load_state_dict( state['optimizer'] )
+        for group, lr in zip( optimizer.param_groups, learning_rates ):
+            group['lr'] = lr
+
+    print( f"      Warm started: {path} (cohort {state['cohort']}{', with optimizer state' if common.WARM_START_OPTIMIZER else ''})" )
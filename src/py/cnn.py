@@ -1,5 +1,10 @@
 import numpy as np
 import common
+import checkpoint
+import early_stopping
+import distributed
+import export
+import quantize
 import os
 import numpy as np
 import torch
@@ -10,14 +15,16 @@ import argparse
 from sklearn.metrics import accuracy_score, roc_auc_score
 
 class StandardCNN( nn.Module ):
-    def __init__( self ):
-        # Layer architecture taken from S2 Table in the paper
+    def __init__( self, input_shape=None ):
+        # Layer architecture taken from S2 Table in the paper.
+        # Layer sizes follow from the [channels, rows, cols] input shape, which defaults to common.get_input_shape()
         super( StandardCNN, self ).__init__()
-        self.conv1    = nn.Conv2d( in_channels=1,  out_channels=32, kernel_size=(120,1) )
+        in_channels, n_rows, n_cols = common.get_input_shape() if input_shape is None else input_shape
+        self.conv1    = nn.Conv2d( in_channels=in_channels, out_channels=32, kernel_size=(n_rows,1) )
         self.conv2    = nn.Conv2d( in_channels=32, out_channels=64, kernel_size=(1,1) )
         self.pool     = nn.MaxPool2d( kernel_size=(1, 3) )
         self.dropout1 = nn.Dropout( p=0.25 )
-        self.fc1      = nn.Linear( in_features=1024, out_features=2 )
+        self.fc1      = nn.Linear( in_features=64 * (n_cols // 3), out_features=2 )
         self.dropout2 = nn.Dropout( 0.5 )
 
     def forward( self, x ):
@@ -40,12 +47,16 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     print( f"            Cohort: {os.path.basename(data_path)}")
 
 
+    # Use batch size, thread and loader settings tuned for this machine, if any
+    common.apply_tuned_config( 'cnn' )
+
     # Load images and labels for each split
-    train_loader, test_loader, val_loader = common.load_data(data_path=data_path)
+    train_loader, test_loader, val_loader = common.load_data(data_path=data_path, neg_fraction=common.get_neg_fraction( 'cnn' ), replay=True)
 
     # Create and train the model
-    model = StandardCNN().to( common.device )
+    model = distributed.wrap_model( StandardCNN().to( common.device ) )
     model = train_cnn( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+    model = distributed.unwrap_model( model )
 
     # Evaluate the model's predictions against the ground truth
     y_score_test, y_pred_test, y_test = eval_model( model, test_loader )
@@ -58,7 +69,19 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     auc, acc, p, r, f = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
     common.print_scores( "val", acc, auc, p, r, f )
 
-    common.dump_outputs( y_pred_val, y_val )
+    # Only rank 0 writes outputs when training is distributed
+    if not distributed.is_main_rank():
+        return
+
+    common.dump_outputs( y_pred_val, y_val, y_score_val, val_loader.dataset.img_labels.iloc[:, 0].values )
+
+    # Optionally export the trained model for the TorchScript/ONNX scoring backend
+    if common.EXPORT_DIR is not None:
+        export.export_model( model, 'cnn', os.path.join( os.getenv('DATA_DIR'), common.EXPORT_DIR ) )
+
+    # Optionally compare int8 quantized inference against fp32 on CPU
+    if common.QUANTIZE_EVAL:
+        quantize.report_quantized( model, train_loader, val_loader )
 
 def eval_model( model, dataloader ):
     """
@@ -70,6 +93,8 @@ def eval_model( model, dataloader ):
         Y_test: truth labels for the test set. Should be an numpy array of ints
         Y_val: truth labels for the val set. Should be an numpy array of ints
     """
+    # Eval runs on each rank's shard without DDP, which would sync on every forward pass
+    model = distributed.unwrap_model( model )
     model.eval()
     
     Y_score = torch.FloatTensor()
@@ -87,10 +112,11 @@ def eval_model( model, dataloader ):
         Y_pred.append( predictions )
         Y_true.append( target      )
 
-    Y_pred = np.concatenate( Y_pred, axis=0 )
-    Y_true = np.concatenate( Y_true, axis=0 )
+    Y_pred = distributed.concatenate( Y_pred )
+    Y_true = distributed.concatenate( Y_true )
 
-    return Y_score, Y_pred, Y_true
+    # Collect every rank's shard of the split when distributed
+    return distributed.gather_outputs( Y_score, Y_pred, Y_true )
 
 def train_cnn( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learn_rate=1e-3 ):
     """
@@ -108,13 +134,19 @@ def train_cnn( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class
     print( f"Class weight ratio: {class_weight_ratio}" )
     common.print_output_header()
 
-    weights       = [1.0/class_weight_ratio, 1.0-(1.0/class_weight_ratio) ]
+    weights       = common.correct_class_weights( [1.0/class_weight_ratio, 1.0-(1.0/class_weight_ratio) ], train_dataloader )
     class_weights = torch.FloatTensor( weights ).to( common.device )
     criterion     = torch.nn.modules.loss.CrossEntropyLoss( weight=class_weights )
 
     # Assign LR=1e-3 taken from the paper
     optimizer = torch.optim.RMSprop( model.parameters(), lr=learn_rate )
 
+    # Optionally continue from a previous run's checkpoint
+    checkpoint.warm_start( 'cnn', model, optimizer )
+
+    # Stop once the val metric stops improving, see early_stopping.EarlyStopper
+    stopper = early_stopping.EarlyStopper( model, optimizer, n_epoch )
+
     model.train() # prep model for training
 
     train_start_time = time.time()
@@ -168,11 +200,22 @@ def train_cnn( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class
 
                 # Stop early if we hit our target
                 if common.DO_EARLY_STOPPING and auc >= common.TARGET_AUC_CNN:
+                    stopper.reached_target( epoch+1 )
+                    break
+
+                # Stop once val AUC or loss stops improving
+                val_loss = common.eval_loss( model, val_loader, criterion ) if stopper.needs_loss() else None
+                if stopper.step( epoch+1, auc2, val_loss ):
                     break
 
             # Put model back in training mode
             model.train()
 
+    stopper.finish()
+
+    # Optionally save weights and optimizer state for warm starting later runs
+    checkpoint.save( 'cnn', model, optimizer, data_path )
+
     print("Training took {:.2f} sec".format( time.time() - train_start_time) )
 
     return model
@@ -190,7 +233,9 @@ if __name__ == "__main__":
                         help='Class weight ratio to use for training')
     parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
                         help='Learning rate to use for training')
+    common.add_common_args(parser)
     args = parser.parse_args()
+    common.apply_common_args(args)
 
     cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
 
@@ -1,5 +1,10 @@
 import numpy as np
 import common
+import checkpoint
+import early_stopping
+import distributed
+import export
+import quantize
 import os
 import numpy as np
 import torch
@@ -8,19 +13,83 @@ import torch.nn.functional as F
 import time
 import argparse
 from sklearn.metrics import accuracy_score, roc_auc_score
-import third_party.ConvLSTM_pytorch.convlstm as convLSTM
 from csv import writer
 
+class FusedConvLSTM( nn.Module ):
+    """
+    Single layer ConvLSTM with 1x1 kernels, numerically equivalent to
+    third_party.ConvLSTM_pytorch.convlstm.ConvLSTM( kernel_size=(1,1), num_layers=1, batch_first=True ).
+    With 1x1 kernels each spatial position is an independent LSTM, so positions are folded
+    into the batch and run through nn.LSTM's fused kernels instead of a Python loop of convolutions.
+    Returns the same ( [layer_output], [[h, c]] ) structure as ConvLSTM.
+    """
+    def __init__( self, input_dim, hidden_dim, bias=False ):
+        super( FusedConvLSTM, self ).__init__()
+        self.hidden_dim = hidden_dim
+        self.lstm       = nn.LSTM( input_size=input_dim, hidden_size=hidden_dim, num_layers=1, bias=bias, batch_first=True )
+
+    def forward( self, x ):
+        # [batch, time, channels, height, width] -> [batch * height * width, time, channels]
+        b, t, c, h, w = x.shape
+        x = x.permute( 0, 3, 4, 1, 2 ).reshape( b * h * w, t, c )
+
+        y, ( h_n, c_n ) = self.lstm( x )
+
+        # Unfold positions back out of the batch
+        y   = y.reshape( b, h, w, t, self.hidden_dim ).permute( 0, 3, 4, 1, 2 )
+        h_n = h_n.reshape( b, h, w, self.hidden_dim ).permute( 0, 3, 1, 2 )
+        c_n = c_n.reshape( b, h, w, self.hidden_dim ).permute( 0, 3, 1, 2 )
+
+        return [ y ], [ [ h_n, c_n ] ]
+
+def convert_convlstm_state_dict( state_dict, prefix='convLSTM.' ):
+    """
+    Converts a CNN_RL state dict using the third party ConvLSTM into one for FusedConvLSTM.
+    ConvLSTM concatenates [input, hidden] into one conv with gates ordered i, f, o, g,
+    while nn.LSTM keeps separate input/hidden weights with gates ordered i, f, g, o.
+    """
+    state_dict = dict( state_dict )
+    weight_key = prefix + 'cell_list.0.conv.weight'
+    bias_key   = prefix + 'cell_list.0.conv.bias'
+    if weight_key not in state_dict:
+        return state_dict
+
+    weight = state_dict.pop( weight_key ).flatten( 1 )
+    hidden_dim = weight.shape[0] // 4
+    input_dim  = weight.shape[1] - hidden_dim
+
+    i, f, o, g = torch.split( weight, hidden_dim, dim=0 )
+    weight     = torch.cat( [ i, f, g, o ], dim=0 )
+    state_dict[prefix + 'lstm.weight_ih_l0'] = weight[:, :input_dim].contiguous()
+    state_dict[prefix + 'lstm.weight_hh_l0'] = weight[:, input_dim:].contiguous()
+
+    if bias_key in state_dict:
+        i, f, o, g = torch.split( state_dict.pop( bias_key ), hidden_dim, dim=0 )
+        state_dict[prefix + 'lstm.bias_ih_l0'] = torch.cat( [ i, f, g, o ], dim=0 )
+        state_dict[prefix + 'lstm.bias_hh_l0'] = torch.zeros( 4 * hidden_dim )
+
+    return state_dict
+
 class CNN_RL( nn.Module ):
-    def __init__( self ):
-        # Layer architecture taken from S2 Table in the paper
+    def __init__( self, input_shape=None, fused_recurrent=None ):
+        # Layer architecture taken from S2 Table in the paper.
+        # Layer sizes follow from the [channels, rows, cols] input shape, which defaults to common.get_input_shape()
+        # fused_recurrent selects FusedConvLSTM over the third party ConvLSTM, defaulting to common.CNN_RL_FUSED_RECURRENT
         super( CNN_RL, self ).__init__()
-        self.conv1    = nn.Conv2d( in_channels=1,  out_channels=32, kernel_size=( 120,1 ) )
+        if fused_recurrent is None:
+            fused_recurrent = common.CNN_RL_FUSED_RECURRENT
+        in_channels, n_rows, n_cols = common.get_input_shape() if input_shape is None else input_shape
+        self.conv1    = nn.Conv2d( in_channels=in_channels, out_channels=32, kernel_size=( n_rows,1 ) )
         self.conv2    = nn.Conv2d( in_channels=32, out_channels=64, kernel_size=( 1,  1 ) )
         self.pool     = nn.MaxPool2d( kernel_size=(1, 3) ) 
         self.dropout1 = nn.Dropout( p=0.25 ) 
-        self.convLSTM = convLSTM.ConvLSTM( input_dim=64, hidden_dim=8, kernel_size=(1,1), num_layers=1, batch_first=True, bias=False, return_all_layers=False) 
-        self.fc1      = nn.Linear( in_features=128, out_features=2 ) 
+        if fused_recurrent:
+            self.convLSTM = FusedConvLSTM( input_dim=64, hidden_dim=8, bias=False )
+        else:
+            # Only needs the ConvLSTM_pytorch submodule when explicitly requested
+            import third_party.ConvLSTM_pytorch.convlstm as convLSTM
+            self.convLSTM = convLSTM.ConvLSTM( input_dim=64, hidden_dim=8, kernel_size=(1,1), num_layers=1, batch_first=True, bias=False, return_all_layers=False) 
+        self.fc1      = nn.Linear( in_features=8 * (n_cols // 3), out_features=2 ) 
         self.dropout2 = nn.Dropout( p=0.25 )
 
     def forward( self, x ):
@@ -47,12 +116,16 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     print( f"\nRunning CNN_RL on CUDA device: {common.device}" )
     print( f"            Cohort: {os.path.basename(data_path)}")
 
+    # Use batch size, thread and loader settings tuned for this machine, if any
+    common.apply_tuned_config( 'cnn_rl' )
+
     # Load images and labels for each split
-    train_loader, test_loader, val_loader = common.load_data(data_path=data_path)
+    train_loader, test_loader, val_loader = common.load_data(data_path=data_path, neg_fraction=common.get_neg_fraction( 'cnn_rl' ), replay=True)
 
     # Create and train the model
-    model = CNN_RL().to( common.device )
+    model = distributed.wrap_model( CNN_RL().to( common.device ) )
     model = train_cnn_rl( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+    model = distributed.unwrap_model( model )
 
     # Evaluate the model's predictions against the ground truth
     y_score_test, y_pred_test, y_test = eval_model( model, test_loader )
@@ -66,7 +139,19 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     auc, acc, p, r, f = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
     common.print_scores( "val", acc, auc, p, r, f )
 
-    common.dump_outputs( y_pred_val, y_val )
+    # Only rank 0 writes outputs when training is distributed
+    if not distributed.is_main_rank():
+        return
+
+    common.dump_outputs( y_pred_val, y_val, y_score_val, val_loader.dataset.img_labels.iloc[:, 0].values )
+
+    # Optionally export the trained model for the TorchScript/ONNX scoring backend
+    if common.EXPORT_DIR is not None:
+        export.export_model( model, 'cnn_rl', os.path.join( os.getenv('DATA_DIR'), common.EXPORT_DIR ) )
+
+    # Optionally compare int8 quantized inference against fp32 on CPU
+    if common.QUANTIZE_EVAL:
+        quantize.report_quantized( model, train_loader, val_loader )
 
 def eval_model( model, dataloader ):
     """
@@ -78,6 +163,8 @@ def eval_model( model, dataloader ):
         Y_test: truth labels for the test set. Should be an numpy array of ints
         Y_val: truth labels for the val set. Should be an numpy array of ints
     """
+    # Eval runs on each rank's shard without DDP, which would sync on every forward pass
+    model = distributed.unwrap_model( model )
     model.eval()
     
     Y_score = torch.FloatTensor()
@@ -95,10 +182,11 @@ def eval_model( model, dataloader ):
         Y_pred.append( predictions )
         Y_true.append( target )
 
-    Y_pred = np.concatenate( Y_pred, axis=0 )
-    Y_true = np.concatenate( Y_true, axis=0 )
+    Y_pred = distributed.concatenate( Y_pred )
+    Y_true = distributed.concatenate( Y_true )
 
-    return Y_score, Y_pred, Y_true
+    # Collect every rank's shard of the split when distributed
+    return distributed.gather_outputs( Y_score, Y_pred, Y_true )
 
 def train_cnn_rl( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learn_rate=1e-3 ):
     """
@@ -115,13 +203,19 @@ def train_cnn_rl( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, cl
     print( f"Class weight ratio: {class_weight_ratio}" )
     common.print_output_header()
     
-    weights       = [1.0 / class_weight_ratio, 1.0 - (1.0 / class_weight_ratio) ]
+    weights       = common.correct_class_weights( [1.0 / class_weight_ratio, 1.0 - (1.0 / class_weight_ratio) ], train_dataloader )
     class_weights = torch.FloatTensor( weights ).to( common.device )
     criterion     = torch.nn.modules.loss.CrossEntropyLoss( weight=class_weights )
 
     # Assign LR=1e-3 taken from the paper
     optimizer = torch.optim.RMSprop( model.parameters(), lr=learn_rate )
 
+    # Optionally continue from a previous run's checkpoint
+    checkpoint.warm_start( 'cnn_rl', model, optimizer )
+
+    # Stop once the val metric stops improving, see early_stopping.EarlyStopper
+    stopper = early_stopping.EarlyStopper( model, optimizer, n_epoch )
+
     # Assign decay 1e-6 as per the paper
     scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=range(n_epoch), gamma=1e-6)
     model.train() # prep model for training
@@ -179,11 +273,22 @@ def train_cnn_rl( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, cl
 
                 # Stop early if we hit our target
                 if common.DO_EARLY_STOPPING and auc >= common.TARGET_AUC_CNN_RL:
+                    stopper.reached_target( epoch+1 )
+                    break
+
+                # Stop once val AUC or loss stops improving
+                val_loss = common.eval_loss( model, val_loader, criterion ) if stopper.needs_loss() else None
+                if stopper.step( epoch+1, auc2, val_loss ):
                     break
 
             # Put model back in training mode
             model.train()
 
+    stopper.finish()
+
+    # Optionally save weights and optimizer state for warm starting later runs
+    checkpoint.save( 'cnn_rl', model, optimizer, data_path )
+
     print( "\nTraining took {:.2f} sec".format( time.time() - train_start_time ) )
 
     return model
@@ -201,7 +306,14 @@ if __name__ == "__main__":
                         help='Class weight ratio to use for training')
     parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
                         help='Learning rate to use for training')
+    parser.add_argument('--convlstm', action='store_true',
+                        help='Use the third party ConvLSTM instead of the fused recurrent layer')
+    common.add_common_args(parser)
     args = parser.parse_args()
+    common.apply_common_args(args)
+
+    if args.convlstm:
+        common.CNN_RL_FUSED_RECURRENT = False
 
     cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
 
@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import common
+
+# Bump whenever image generation changes in a way that invalidates previously cached images
+CACHE_VERSION = 4
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+# Per visit csvs written alongside the images, which are concatenated across shards rather than linked
+APPENDED_FILE_NAMES = [ common.CS_MEWS_PREDS_FILE_NAME, common.CS_SOFA_PREDS_FILE_NAME ]
+
+class Shard:
+    """
+    Contiguous block of csv rows whose patient ids fall into the same bucket of
+    common.COHORT_CACHE_SHARD_WIDTH ids. Holds the byte range and a digest of its contents.
+    """
+    def __init__( self, shard_id: int, start: int ):
+        self.shard_id = shard_id
+        self.start    = start
+        self.end      = start
+        self.hasher   = hashlib.sha256()
+
+    def first_patient_id( self ):
+        return self.shard_id * common.COHORT_CACHE_SHARD_WIDTH
+
+    def last_patient_id( self ):
+        return ( self.shard_id + 1 ) * common.COHORT_CACHE_SHARD_WIDTH - 1
+
+def get_cache_path():
+    return os.path.join( os.getenv( 'IMAGES_DIR' ), common.COHORT_CACHE_DIR_NAME )
+
+def scan_shards( csv_file: str ):
+    """
+    Makes one pass over the raw bytes of csv_file and splits it into shards.
+    The csv must be sorted by patient id, as export_patient_data.sql does.
+    Header and mapping rows are left out, since they're covered by the stats digest.
+    """
+    shards = list()
+    shard  = None
+
+    with open( csv_file, 'rb' ) as f:
+        # Skip header row
+        pos = len( f.readline() )
+
+        for line in f:
+            patient_id = int( line[:line.index( b',' )].strip( b'"' ) )
+            if patient_id != common.MAPPING_PATIENT_ID:
+                shard_id = patient_id // common.COHORT_CACHE_SHARD_WIDTH
+
+                if shard is None or shard.shard_id != shard_id:
+                    shard = Shard( shard_id, pos )
+                    shards.append( shard )
+
+                shard.hasher.update( line )
+                shard.end = pos + len( line )
+
+            pos = pos + len( line )
+
+    return shards
+
+def params_digest( item2feature: dict, stats: np.ndarray, norm_method: common.Norm_method ):
+    """
+    Digest of everything besides the csv contents that affects the generated images.
+    """
+    hasher = hashlib.sha256()
+    hasher.update( str( CACHE_VERSION ).encode() )
+    hasher.update( np.ascontiguousarray( stats ).tobytes() )
+    hasher.update( repr( sorted( item2feature.items() ) ).encode() )
+    hasher.update( repr( (
+        norm_method.name,
+        common.N_HOURS,
+        common.HOURS_PER_COL,
+        common.N_ROWS,
+        common.N_COLS,
+        common.CSV_PARSER_PATIENTID_DO_LIMIT,
+        common.CSV_PARSER_PATIENTID_MIN,
+        common.CSV_PARSER_PATIENTID_MAX,
+        common.SPARSE_EVENTS,
+    ) ).encode() )
+
+    return hasher.hexdigest()
+
+def shard_key( shard: Shard, params: str ):
+    return hashlib.sha256( ( shard.hasher.hexdigest() + params ).encode() ).hexdigest()
+
+def load_manifest( cache_path: str ):
+    """
+    Loads the cache manifest, which maps each cache key to its shard and usage info.
+    Entries whose directories have gone missing are dropped.
+    """
+    manifest = { 'version': CACHE_VERSION, 'entries': dict() }
+
+    try:
+        with open( os.path.join( cache_path, MANIFEST_FILE_NAME ), 'r' ) as f:
+            manifest = json.load( f )
+    except FileNotFoundError:
+        pass
+
+    manifest['entries'] = { key: entry for key, entry in manifest['entries'].items() if os.path.isdir( os.path.join( cache_path, key ) ) }
+
+    return manifest
+
+def save_manifest( cache_path: str, manifest: dict ):
+    """
+    Writes the manifest atomically so an interrupted run never leaves it half written.
+    """
+    tmp_path = os.path.join( cache_path, MANIFEST_FILE_NAME + '.tmp' )
+    with open( tmp_path, 'w' ) as f:
+        json.dump( manifest, f, indent=1 )
+    os.replace( tmp_path, os.path.join( cache_path, MANIFEST_FILE_NAME ) )
+
+def get_dir_size( path: str ):
+    return sum( entry.stat().st_size for entry in os.scandir( path ) if entry.is_file() )
+
+def link_images( src_path: str, dst_path: str ):
+    """
+    Hard links every image in src_path into dst_path, falling back to copies across filesystems.
+    Clinical score csvs are appended to the ones in dst_path instead, skipping their header if already there.
+    """
+    for name in os.listdir( src_path ):
+        src = os.path.join( src_path, name )
+        dst = os.path.join( dst_path, name )
+
+        if name in APPENDED_FILE_NAMES:
+            has_header = os.path.exists( dst )
+            with open( src, 'r' ) as f_src, open( dst, 'a' ) as f_dst:
+                if has_header:
+                    f_src.readline()
+                shutil.copyfileobj( f_src, f_dst )
+            continue
+
+        try:
+            os.link( src, dst )
+        except OSError:
+            shutil.copyfile( src, dst )
+
+def evict( cache_path: str, manifest: dict, in_use: set ):
+    """
+    Deletes least recently used entries until the cache fits in common.COHORT_CACHE_MAX_BYTES.
+    Entries used by the current run are never evicted.
+    """
+    entries     = manifest['entries']
+    total_bytes = sum( entry['bytes'] for entry in entries.values() )
+
+    for key in sorted( entries, key=lambda k: entries[k]['last_used'] ):
+        if total_bytes <= common.COHORT_CACHE_MAX_BYTES:
+            break
+        if key in in_use:
+            continue
+
+        shutil.rmtree( os.path.join( cache_path, key ), ignore_errors=True )
+        total_bytes = total_bytes - entries[key]['bytes']
+        del entries[key]
+
+    if total_bytes > common.COHORT_CACHE_MAX_BYTES:
+        print( f"Warning: cohort cache holds {total_bytes} bytes for the current cohort, over the {common.COHORT_CACHE_MAX_BYTES} byte budget" )
+
+def build_cohort( csv_file: str, img_paths: dict, item2feature: dict, stats: np.ndarray, parse_shard ):
+    """
+    Populates each path in img_paths, which maps normalization methods to output
+    paths, with the images for every shard of csv_file. Shards found in the cache
+    are reused. For all others, parse_shard( start, end, out_paths ) is called once
+    with just the methods that missed, and the results are added to the cache.
+    """
+    cache_path = get_cache_path()
+    os.makedirs( cache_path, exist_ok=True )
+
+    manifest = load_manifest( cache_path )
+    entries  = manifest['entries']
+    params   = { method: params_digest( item2feature, stats, method ) for method in img_paths }
+
+    scan_start_time = time.time()
+    shards = scan_shards( csv_file )
+    print( "Scanned {} shards in {:.2f} sec".format( len( shards ), time.time() - scan_start_time ) )
+
+    # Start from an empty master so images of patients removed from the export don't linger
+    for img_path in img_paths.values():
+        os.makedirs( img_path, exist_ok=True )
+        for name in os.listdir( img_path ):
+            if name.endswith( '.png' ):
+                os.remove( os.path.join( img_path, name ) )
+
+    in_use   = set()
+    n_hits   = 0
+    n_shards = 0
+    for shard in shards:
+        # Shards entirely outside the patient id limits produce no images
+        if common.CSV_PARSER_PATIENTID_DO_LIMIT:
+            if shard.last_patient_id() < common.CSV_PARSER_PATIENTID_MIN or shard.first_patient_id() > common.CSV_PARSER_PATIENTID_MAX:
+                continue
+
+        keys   = { method: shard_key( shard, params[method] ) for method in img_paths }
+        missed = [ method for method in img_paths if keys[method] not in entries ]
+
+        n_shards = n_shards + 1
+        if len( missed ) == 0:
+            n_hits = n_hits + 1
+        else:
+            # Generate into temporary directories so interrupted runs never leave partial entries
+            tmp_paths = { method: os.path.join( cache_path, keys[method] + '.tmp' ) for method in missed }
+            for tmp_path in tmp_paths.values():
+                shutil.rmtree( tmp_path, ignore_errors=True )
+                os.makedirs( tmp_path )
+
+            n_images = parse_shard( shard.start, shard.end, tmp_paths )
+
+            for method in missed:
+                key_path = os.path.join( cache_path, keys[method] )
+                shutil.rmtree( key_path, ignore_errors=True )
+                os.replace( tmp_paths[method], key_path )
+
+                entries[keys[method]] = {
+                    'source':   os.path.basename( csv_file ),
+                    'shard':    shard.shard_id,
+                    'method':   method.name,
+                    'n_images': n_images,
+                    'bytes':    get_dir_size( key_path ),
+                    'created':  time.time(),
+                }
+
+        for method, img_path in img_paths.items():
+            entries[keys[method]]['last_used'] = time.time()
+            in_use.add( keys[method] )
+            link_images( os.path.join( cache_path, keys[method] ), img_path )
+
+    print( f"Reused {n_hits} of {n_shards} shards from the cohort cache" )
+
+    evict( cache_path, manifest, in_use )
+    save_manifest( cache_path, manifest )
@@ -6,9 +6,13 @@ import numpy as np
 import pandas as pd
 import os
 import datetime
+import json
+import platform
+import hashlib
 import torch
 from torch.utils.data import Dataset
 from torchvision.io import read_image
+import distributed
 from csv import writer
 from sklearn.metrics import accuracy_score, roc_auc_score, precision_recall_fscore_support
 
@@ -37,20 +41,111 @@ SPLITS_SEED = 0
 # Note: requires EVAL_EVERY_EPOCH == True, ignored otherwise
 DO_EARLY_STOPPING = False
 
+# Patience-based early stopping on the val split, applied by early_stopping.EarlyStopper. Requires EVAL_EVERY_EPOCH.
+# Stops after EARLY_STOP_PATIENCE epochs without val 'auc' or 'loss' improving by more than EARLY_STOP_MIN_DELTA,
+# then restores the best weights. None disables it
+EARLY_STOP_MONITOR = 'auc'
+EARLY_STOP_PATIENCE = None
+EARLY_STOP_MIN_DELTA = 0.0
+
+# Multiply the learning rate by LR_PLATEAU_FACTOR after LR_PLATEAU_PATIENCE epochs without val improvement. None disables it
+LR_PLATEAU_FACTOR = None
+LR_PLATEAU_PATIENCE = 2
+
+# Fraction of negative (survived) train visits drawn afresh each epoch, keeping all positives. None or 1.0 uses every visit.
+# NEG_SAMPLE_FRACTION overrides the per model fractions in NEG_SAMPLE_FRACTIONS when set
+NEG_SAMPLE_FRACTIONS = {}
+NEG_SAMPLE_FRACTION = None
+NEG_SAMPLE_SEED = 0
+
+# Directory, relative to DATA_DIR, to save each model's weights and optimizer state to after training. None to skip
+CHECKPOINT_DIR = None
+
+# Directory, relative to DATA_DIR, of checkpoints to initialize models from instead of training from scratch. None to skip.
+# Warm started runs default to WARM_START_EPOCHS epochs, and can also restore the optimizer state
+WARM_START_DIR = None
+WARM_START_OPTIMIZER = False
+WARM_START_EPOCHS = 3
+
+# Shuffled cohort, relative to IMAGES_DIR, whose train visits are replayed alongside the current train split.
+# REPLAY_FRACTION of its train visits that aren't in any split of the current cohort are sampled once per run. None to skip
+REPLAY_COHORT = None
+REPLAY_FRACTION = 0.1
+
 # Target AUCs to trigger early stopping for each model
 TARGET_AUC_CNN = 0.87
 TARGET_AUC_RNN = 0.89
 TARGET_AUC_INCEPTION = 0.90
 TARGET_AUC_CNN_RL = 0.91
+TARGET_AUC_DEEP_CNN = 0.90
+
+# Use cnn_rl.FusedConvLSTM for CNN_RL's recurrent layer instead of the ConvLSTM_pytorch submodule
+CNN_RL_FUSED_RECURRENT = True
+
+# After training, also score the val set with an int8 quantized copy of the model on CPU and compare against fp32
+QUANTIZE_EVAL = False
+
+# Number of train split samples used to calibrate static quantization of conv layers
+QUANTIZE_CALIBRATION_SAMPLES = 1024
+
+# Directory, relative to DATA_DIR, to export trained models to as TorchScript and ONNX. None to skip exporting
+EXPORT_DIR = None
+
+# Softmax temperature and soft target loss weight for distilling Inception3 into smaller models
+DISTILL_TEMPERATURE = 4.0
+DISTILL_ALPHA = 0.7
+
+# Apply batch size, thread and DataLoader settings found by autotune.py for the current machine, if any
+AUTOTUNE_ENABLED = True
+AUTOTUNE_FILE_NAME = 'autotune.json'
 
-# Batch size for number of input csv rows to parse before dumping images and deleting runtime image representations
-CSV_PARSER_BATCH_SIZE = 10000000
+# Loader settings, overwritten by apply_tuned_config. TUNED_BATCH_SIZE of None keeps each model's default batch size
+TUNED_BATCH_SIZE = None
+LOADER_NUM_WORKERS = 0
+LOADER_PIN_MEMORY = False
+
+# Bounds on the parsed visits csv_to_images holds in memory. Visits are complete once the sorted export moves past their patient,
+# and are flushed in a batch once CSV_PARSER_MAX_VISITS of them or CSV_PARSER_MAX_BYTES of their arrays are waiting.
+# Images are written on a background thread, and parsing blocks while CSV_PARSER_WRITE_QUEUE flushed batches wait for it
+CSV_PARSER_MAX_VISITS  = 2000
+CSV_PARSER_MAX_BYTES   = 256 * 1024**2
+CSV_PARSER_WRITE_QUEUE = 2
+
+# Store each visit's measured hours as sparse events instead of an image, see sparse_events.py.
+# Sparse cohorts are densified on load with SPARSE_FILL_POLICY ('forward' or 'none'), carrying values
+# for at most SPARSE_FILL_MAX_HOURS after each measurement, or until the next one when None
+SPARSE_EVENTS         = False
+SPARSE_FILL_POLICY    = 'forward'
+SPARSE_FILL_MAX_HOURS = None
+
+# Visits of each sparse batch densified right after writing and compared with the image generate_images would have written.
+# A mismatch stops the ingest. 0 skips the check
+SPARSE_CHECK_VISITS = 4
 
 # Set range of patients to process images for. Set CSV_PARSER_PATIENTID_DO_LIMIT to False to uncap limit.
 CSV_PARSER_PATIENTID_DO_LIMIT = True
 CSV_PARSER_PATIENTID_MIN      = 10000019
 CSV_PARSER_PATIENTID_MAX      = 19999987
 
+# Option to reuse images from previous runs of csv_to_images for csv shards whose contents haven't changed.
+# Shards are contiguous blocks of patients, COHORT_CACHE_SHARD_WIDTH patient ids wide.
+# Cached images are kept under IMAGES_DIR/COHORT_CACHE_DIR_NAME, and least recently used
+# entries are evicted once the cache grows past COHORT_CACHE_MAX_BYTES.
+COHORT_CACHE_ENABLED     = True
+COHORT_CACHE_DIR_NAME    = '.cohort_cache'
+COHORT_CACHE_SHARD_WIDTH = 10000
+COHORT_CACHE_MAX_BYTES   = 20 * 1024**3
+
+# Location of the SQL scripts
+SQL_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'sql' )
+
+# Settings for extract.py, which streams the export straight from PostgreSQL into images.
+# The cohort is split into EXTRACT_N_RANGES patient id ranges, extracted by EXTRACT_N_WORKERS connections at once,
+# each fetching EXTRACT_CHUNK_ROWS rows per round trip from a server-side cursor.
+EXTRACT_N_WORKERS  = 4
+EXTRACT_N_RANGES   = 16
+EXTRACT_CHUNK_ROWS = 50000
+
 # Prediction thresholds for clinical scores
 MEWS_THRESHOLD = 2.9
 SOFA_SCORE_THRESHOLD = 5.2
@@ -60,10 +155,16 @@ SOFA_EST_THRESHOLD = 10.0
 TEST_SPLIT_PCT = 0.2
 VAL_SPLIT_PCT  = 0.3
 
-# Constants as specified in the paper
-N_HOURS = 48
-N_COLS  = N_HOURS
-N_ROWS  = 120
+# Constants as specified in the paper.
+# N_HOURS is the timeline horizon and HOURS_PER_COL its resolution, so each image has N_COLS columns.
+# Use set_timeline (or --horizon/--resolution on the command line) to change them, which keeps N_COLS in sync.
+N_HOURS       = 48
+HOURS_PER_COL = 1.0
+N_COLS        = N_HOURS
+N_ROWS        = 120
+
+# Name of the file describing the horizon and resolution a cohort's images were generated with
+TIMELINE_FILE_NAME = 'timeline.json'
 
 # Normalization output range. Selected as [0,255] for openCV compatibility
 NORM_OUT_MIN = 0
@@ -72,6 +173,9 @@ NORM_OUT_MAX = 255
 # Annotiations file name
 ANNOTATIONS_FILE_NAME = 'labels.csv'
 
+# Marks a shuffled cohort whose splits are densified from the master's sparse events rather than read as images
+SPARSE_COHORT_FILE_NAME = 'sparse_events.json'
+
 # Clinical scores file names
 CS_MEWS_PREDS_FILE_NAME = 'mews_preds.csv'
 CS_SOFA_PREDS_FILE_NAME = 'sofa_preds.csv'
@@ -83,6 +187,18 @@ class Norm_method( Enum ):
     REFMINMAX = 3
 NORM_METHOD = Norm_method.MINMAX
 
+# Channels of a timeline image, as indexed after loading with read_image.
+# VALUE is the normalized forward-filled timeline, OBSERVED is NORM_OUT_MAX where a value was
+# measured that hour and NORM_OUT_MIN where it was carried over or defaulted, and RECENCY is the
+# hours since that row was last measured, scaled so N_HOURS (or never measured) maps to NORM_OUT_MAX.
+class Img_channel( IntEnum ):
+    VALUE    = 0
+    OBSERVED = 1
+    RECENCY  = 2
+
+# Channels fed to the models. Can be overridden with --channels on the command line.
+IMG_CHANNELS = [Img_channel.VALUE]
+
 # Used for indexing braden items in patient_visit
 braden_item2row = {
     224054: 0,     # Braden Sensory Perception
@@ -127,6 +243,29 @@ class SOFA_rows(IntEnum):
     EST_MORTALITY   = 3
     DIED            = 4
 
+# Components of the MEWS and SOFA scores computed by csv_to_images, numbered as in mews_score.sql and sofa_score.sql
+class MEWS_component(IntEnum):
+    RESP_RATE       = 0
+    HEART_RATE      = 1
+    SYSTOLIC_BP     = 2
+    AVPU            = 3
+    TEMPERATURE     = 4
+    URINE           = 5
+
+class SOFA_component(IntEnum):
+    RESPIRATION     = 0
+    COAGULATION     = 1
+    LIVER           = 2
+    CARDIOVASCULAR  = 3
+    CNS             = 4
+    RENAL           = 5
+
+# MEWS score at which mews_score.sql raises a warning
+MEWS_WARNING_SCORE = 4
+
+# Estimated mortality (%) for each SOFA score, as in sofa_score.sql
+SOFA_EST_MORTALITY = [ 3.3, 5.8, 3.8, 3.3, 7.0, 10, 4.5, 15.3, 22.5, 22.5, 45.8, 40, 45.8, 60, 51.5, 82.0, 87.3 ] + [ 90 ] * 8
+
 # Used for indexing columns by name in stats
 class Stats_col( IntEnum ):
     VAR_TYPE    = 0
@@ -162,18 +301,23 @@ class Var_type( IntEnum ):
 
 # Class that defines image dataset. Adapted from https://pytorch.org/tutorials/beginner/basics/data_tutorial.html
 class CustomImageDataset( Dataset ):
-    def __init__( self, annotations_file, img_dir, transform=None, target_transform=None ):
+    def __init__( self, annotations_file, img_dir, transform=None, target_transform=None, channels=None, stored_timeline=None ):
         self.img_labels       = pd.read_csv(annotations_file)
         self.img_dir          = img_dir
         self.transform        = transform
         self.target_transform = target_transform
+        self.channels         = [ int(c) for c in ( IMG_CHANNELS if channels is None else channels ) ]
+        self.stored_timeline  = stored_timeline
 
     def __len__( self ):
         return len( self.img_labels )
 
     def __getitem__( self, idx ):
         img_path = os.path.join( self.img_dir, self.img_labels.iloc[idx, 0] )
-        image    = read_image( img_path ).float()[0].unsqueeze(0) / 255.0
+        image    = read_image( img_path ).float() / 255.0
+        if self.stored_timeline is not None:
+            image = resample_timeline( image, *self.stored_timeline )
+        image    = image[self.channels]
         label    = self.img_labels.iloc[idx, 1]
         if self.transform:
             image = self.transform( image )
@@ -181,24 +325,389 @@ class CustomImageDataset( Dataset ):
             label = self.target_transform( label )
         return image, label
 
-def load_data( batch_size = 128, data_path: str = os.getenv('IMAGES_DIR') ):
+class NegativeSubsampler( torch.utils.data.Sampler ):
+    """
+    Yields every positive sample plus a fresh random neg_fraction of the negatives each epoch, in dataset order.
+    When distributed, every rank draws the same subsample and takes its own equal sized shard of it.
+    Pair with correct_class_weights so the loss stays an unbiased estimate of the full epoch's.
+    """
+    def __init__( self, dataset, neg_fraction, seed=NEG_SAMPLE_SEED ):
+        labels            = dataset.img_labels.iloc[:, 1].to_numpy()
+        self.positives    = np.flatnonzero( labels == 1 )
+        self.negatives    = np.flatnonzero( labels != 1 )
+        self.neg_fraction = neg_fraction
+        self.n_negatives  = int( round( len( self.negatives ) * neg_fraction ) )
+        self.seed         = seed
+        self.epoch        = 0
+
+    def __iter__( self ):
+        # Same generator state on every rank, so they agree on the subsample
+        rng       = np.random.default_rng( ( self.seed, self.epoch ) )
+        negatives = rng.choice( self.negatives, size=self.n_negatives, replace=False )
+        indices   = np.sort( np.concatenate( [ self.positives, negatives ] ) )
+        self.epoch = self.epoch + 1
+
+        world_size = distributed.get_world_size()
+        if world_size > 1:
+            # Pad so each rank takes the same number of steps
+            indices = np.resize( indices, -( -len( indices ) // world_size ) * world_size )
+            indices = indices[distributed.get_rank()::world_size]
+
+        return iter( indices.tolist() )
+
+    def __len__( self ):
+        return -( -( len( self.positives ) + self.n_negatives ) // distributed.get_world_size() )
+
+def get_neg_fraction( model_name: str ):
+    """
+    Negative subsampling fraction for model_name, or None to train on every visit.
+    """
+    fraction = NEG_SAMPLE_FRACTION if NEG_SAMPLE_FRACTION is not None else NEG_SAMPLE_FRACTIONS.get( model_name )
+    if fraction is None or fraction >= 1.0:
+        return None
+    if fraction <= 0.0:
+        raise ValueError( f"Negative sampling fraction must be in (0, 1], got {fraction}" )
+    return fraction
+
+def correct_class_weights( weights, train_dataloader ):
+    """
+    Scales the negative class weight by 1 / neg_fraction when train_dataloader subsamples negatives,
+    so each kept negative stands in for the ones skipped this epoch.
+    """
+    sampler = train_dataloader.sampler
+    if isinstance( sampler, NegativeSubsampler ):
+        weights = [ weights[0] / sampler.neg_fraction ] + list( weights[1:] )
+    return weights
+
+def add_replay( dataset: CustomImageDataset, data_path: str, replay_path: str, fraction: float, seed: int = 0 ):
+    """
+    Appends a random fraction of replay_path's train visits to dataset, skipping every visit in any split of
+    the cohort at data_path, so no visit held out for test or val is replayed into training.
+    Replayed images are referenced by absolute path, so they're read from the old cohort in place.
+    """
+    if get_stored_timeline( replay_path ) != get_stored_timeline( data_path ):
+        raise ValueError( f"Replay cohort {replay_path} was generated with a different timeline" )
+
+    current = pd.concat( [ pd.read_csv( os.path.join( data_path, split, ANNOTATIONS_FILE_NAME ), header=None ).iloc[:, 0]
+                           for split in [ 'train', 'test', 'val' ] ] )
+
+    replay_dir    = os.path.join( replay_path, 'train' )
+    replay_labels = pd.read_csv( os.path.join( replay_dir, ANNOTATIONS_FILE_NAME ), header=None )
+    replay_labels = replay_labels[ ~replay_labels.iloc[:, 0].isin( current ) ]
+    replay_labels = replay_labels.sample( frac=fraction, random_state=seed ).copy()
+
+    # labels.csv has no header, so take the dataset's column names for the rows to line up
+    replay_labels.columns    = dataset.img_labels.columns
+    replay_labels.iloc[:, 0] = [ os.path.join( replay_dir, name ) for name in replay_labels.iloc[:, 0] ]
+    dataset.img_labels = pd.concat( [ dataset.img_labels, replay_labels ], ignore_index=True )
+
+    print( f"          Replayed: {len(replay_labels)} train visits from {os.path.basename(os.path.normpath(replay_path))}" )
+
+def load_data( batch_size = 128, data_path: str = os.getenv('IMAGES_DIR'), channels = None, neg_fraction = None, replay = False, tuned = True ):
     '''
     input
         folder: str, 'train', 'val', or 'test'
+            channels: list of Img_channel to load, defaults to IMG_CHANNELS
+        neg_fraction: subsample train negatives each epoch with NegativeSubsampler, see get_neg_fraction
+        replay: mix REPLAY_COHORT's visits into train. Only set where the train loader is used to train
+        tuned: use TUNED_BATCH_SIZE instead of batch_size when it's set. Clear to force batch_size
+    Images stored with a longer horizon or finer resolution than N_HOURS/HOURS_PER_COL
+    are cropped and downsampled on load.
     output
            number_normal: number of normal samples in the given folder
         number_pneumonia: number of pneumonia samples in the given folder
     '''
-    trainDataset = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'train', ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'train' ) )
-    testDataset  = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'test',  ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'test'  ) )
-    valDataset   = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'val',   ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'val'   ) )
-
-    train_loader = torch.utils.data.DataLoader( trainDataset, batch_size=batch_size, shuffle=False )
-    test_loader  = torch.utils.data.DataLoader( testDataset,  batch_size=batch_size, shuffle=False )
-    val_loader   = torch.utils.data.DataLoader( valDataset,   batch_size=batch_size, shuffle=False )
+    if tuned and TUNED_BATCH_SIZE is not None:
+        batch_size = TUNED_BATCH_SIZE
+
+    stored_timeline = get_stored_timeline( data_path )
+    if stored_timeline == ( N_HOURS, HOURS_PER_COL ):
+        stored_timeline = None
+
+    sparse = os.path.exists( os.path.join( data_path, SPARSE_COHORT_FILE_NAME ) )
+    if sparse:
+        # Sparse cohorts are densified a batch at a time at the current horizon and resolution
+        import sparse_events
+        trainDataset, testDataset, valDataset = sparse_events.load_splits( data_path, channels )
+    else:
+        trainDataset = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'train', ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'train' ), channels=channels, stored_timeline=stored_timeline )
+        testDataset  = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'test',  ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'test'  ), channels=channels, stored_timeline=stored_timeline )
+        valDataset   = CustomImageDataset( os.path.join( data_path, os.path.join( data_path, 'val',   ANNOTATIONS_FILE_NAME ) ), os.path.join( data_path, 'val'   ), channels=channels, stored_timeline=stored_timeline )
+
+    # Optionally mix in old visits when fine-tuning a warm started model on a refreshed cohort
+    if replay and REPLAY_COHORT is not None:
+        if sparse:
+            raise ValueError( "Replay is only supported for image cohorts" )
+        add_replay( trainDataset, data_path, os.path.join( os.getenv('IMAGES_DIR'), REPLAY_COHORT ), REPLAY_FRACTION )
+
+    # Each rank gets its own shard of every split when training is distributed
+    loader_args  = { 'batch_size': batch_size, 'shuffle': False, 'num_workers': LOADER_NUM_WORKERS, 'pin_memory': LOADER_PIN_MEMORY }
+    train_sampler = distributed.get_train_sampler( trainDataset ) if neg_fraction is None else NegativeSubsampler( trainDataset, neg_fraction )
+    train_loader = torch.utils.data.DataLoader( trainDataset, sampler=train_sampler, **loader_args )
+    test_loader  = torch.utils.data.DataLoader( testDataset,  sampler=distributed.get_eval_sampler( testDataset ),  **loader_args )
+    val_loader   = torch.utils.data.DataLoader( valDataset,   sampler=distributed.get_eval_sampler( valDataset ),   **loader_args )
 
     return train_loader, test_loader, val_loader
 
+def get_machine_fingerprint():
+    """
+    Short id of the CPU model, core count and torch build, so tuned settings are only reused on matching machines.
+    """
+    cpu_model = platform.processor()
+    try:
+        with open( '/proc/cpuinfo', 'r' ) as f:
+            for line in f:
+                if line.startswith( 'model name' ):
+                    cpu_model = line.split( ':', 1 )[1].strip()
+                    break
+    except OSError:
+        pass
+
+    gpu_model = torch.cuda.get_device_name( 0 ) if torch.cuda.is_available() else None
+    key = repr( ( platform.machine(), cpu_model, os.cpu_count(), gpu_model, torch.__version__ ) )
+
+    return hashlib.sha256( key.encode() ).hexdigest()[:16]
+
+def get_autotune_path():
+    return os.path.join( os.getenv('DATA_DIR'), AUTOTUNE_FILE_NAME )
+
+def load_tuned_configs():
+    """
+    Loads all tuned settings, keyed by machine fingerprint, then model name, then 'train' or 'score'.
+    """
+    try:
+        with open( get_autotune_path(), 'r' ) as f:
+            return json.load( f )
+    except ( FileNotFoundError, TypeError ):
+        return dict()
+
+def apply_tuned_config( model_name: str, mode: str = 'train' ):
+    """
+    Applies the settings autotune.py found for model_name on this machine, if any.
+    mode is 'train' for training entry points or 'score' for scoring exported models.
+    Thread counts are left alone under distributed training, which splits cores between ranks itself.
+    """
+    global TUNED_BATCH_SIZE, LOADER_NUM_WORKERS, LOADER_PIN_MEMORY
+
+    # Don't carry one model's settings over to the next, e.g. under model_runner.py
+    TUNED_BATCH_SIZE   = None
+    LOADER_NUM_WORKERS = 0
+    LOADER_PIN_MEMORY  = False
+
+    if not AUTOTUNE_ENABLED:
+        return None
+
+    config = load_tuned_configs().get( get_machine_fingerprint(), dict() ).get( model_name, dict() ).get( mode )
+    if config is None:
+        return None
+
+    TUNED_BATCH_SIZE   = config['batch_size']
+    LOADER_NUM_WORKERS = config['num_workers']
+    LOADER_PIN_MEMORY  = config['pin_memory']
+    if not distributed.is_distributed():
+        torch.set_num_threads( config['num_threads'] )
+
+    print( f"    Tuned settings: batch size {TUNED_BATCH_SIZE}, {torch.get_num_threads()} threads, {LOADER_NUM_WORKERS} workers, pin_memory={LOADER_PIN_MEMORY}" )
+
+    return config
+
+def set_timeline( n_hours: float, hours_per_col: float ):
+    """
+    Sets the timeline horizon and resolution used by ingest, loaders and models.
+    """
+    global N_HOURS, HOURS_PER_COL, N_COLS
+
+    n_cols = n_hours / hours_per_col
+    if n_cols != int( n_cols ):
+        raise ValueError( f"Horizon of {n_hours}h is not a whole number of {hours_per_col}h columns" )
+
+    N_HOURS       = n_hours
+    HOURS_PER_COL = hours_per_col
+    N_COLS        = int( n_cols )
+
+def get_input_shape():
+    """
+    Returns the [channels, rows, cols] shape of a single model input.
+    """
+    return len( IMG_CHANNELS ), N_ROWS, N_COLS
+
+def save_timeline( img_path: str, point_rows=None, defaults=None ):
+    """
+    Records the horizon and resolution of images generated into img_path.
+    point_rows marks the rows whose events aren't carried forward, and defaults holds each row's
+    normalized value where nothing was measured, so a timeline can be cut short the way the ingest would.
+    """
+    timeline = { 'n_hours': N_HOURS, 'hours_per_col': HOURS_PER_COL }
+    if point_rows is not None:
+        timeline['point_rows'] = [ int(row) for row in np.flatnonzero( point_rows ) ]
+        timeline['defaults']   = [ int(default) for default in defaults ]
+
+    # Replaced rather than rewritten, since it can be a hard link into the cohort cache
+    tmp_path = os.path.join( img_path, TIMELINE_FILE_NAME + '.tmp' )
+    with open( tmp_path, 'w' ) as f:
+        json.dump( timeline, f )
+    os.replace( tmp_path, os.path.join( img_path, TIMELINE_FILE_NAME ) )
+
+def get_stored_timeline( data_path: str ):
+    """
+    Returns ( n_hours, hours_per_col ) of the images in a cohort.
+    Cohorts generated before this was recorded are 48h at 1h resolution.
+    """
+    try:
+        with open( os.path.join( data_path, TIMELINE_FILE_NAME ), 'r' ) as f:
+            timeline = json.load( f )
+        return timeline['n_hours'], timeline['hours_per_col']
+    except FileNotFoundError:
+        return 48, 1.0
+
+def get_stored_rows( data_path: str ):
+    """
+    Returns ( point_rows, defaults ) of the images in a cohort, the indices of rows that aren't carried
+    forward and the normalized default of every row, or ( None, None ) for cohorts generated before they were recorded.
+    """
+    try:
+        with open( os.path.join( data_path, TIMELINE_FILE_NAME ), 'r' ) as f:
+            timeline = json.load( f )
+    except FileNotFoundError:
+        return None, None
+
+    if 'point_rows' not in timeline:
+        return None, None
+    return timeline['point_rows'], timeline['defaults']
+
+def resample_timeline( image, stored_n_hours, stored_hours_per_col ):
+    """
+    Crops and downsamples a loaded image with every Img_channel, [channels, rows, cols], from its stored
+    horizon and resolution to N_HOURS and HOURS_PER_COL.
+    VALUE takes the last measured column in each new column's span, or its last column if none was,
+    so events in rows that aren't forward-filled aren't lost. OBSERVED is set if any stored column in the
+    span was, and RECENCY takes the span's last column.
+    """
+    step = HOURS_PER_COL / stored_hours_per_col
+    if N_HOURS > stored_n_hours or step != int( step ):
+        raise ValueError( f"Can't resample {stored_n_hours}h at {stored_hours_per_col}h columns to {N_HOURS}h at {HOURS_PER_COL}h columns" )
+    step = int( step )
+
+    # Crop to the horizon, then group columns into spans of step
+    image = image[:, :, :N_COLS * step]
+    spans = image.reshape( image.shape[0], image.shape[1], N_COLS, step )
+
+    # Last measured column of each span, falling back to the span's last column
+    observed = spans[Img_channel.OBSERVED] > 0
+    last     = torch.where( observed, torch.arange( step ), -1 ).amax( dim=-1 )
+    last     = torch.where( last >= 0, last, step - 1 )
+
+    resampled = spans[:, :, :, -1].clone()
+    resampled[Img_channel.VALUE]    = spans[Img_channel.VALUE].gather( -1, last.unsqueeze( -1 ) ).squeeze( -1 )
+    resampled[Img_channel.OBSERVED] = spans[Img_channel.OBSERVED].amax( dim=-1 )
+
+    # Recency is scaled to the stored horizon, rescale it to the new one
+    resampled[Img_channel.RECENCY] = torch.clamp( resampled[Img_channel.RECENCY] * stored_n_hours / N_HOURS, max=1.0 )
+
+    return resampled
+
+def image_to_sequence( data ):
+    """
+    Reshapes a batch of images [batch, channels, n_rows, n_cols] into sequences
+    [batch, n_rows, channels * n_cols] for the recurrent models.
+    """
+    return data.permute( 0, 2, 1, 3 ).flatten( 2 )
+
+def get_recency( observed: np.ndarray ) -> np.ndarray:
+    """
+    Given a boolean [n_rows, n_cols] mask of measured values, returns the number of
+    hours since each row was last measured, normalized from [0, N_HOURS] to [NORM_OUT_MIN, NORM_OUT_MAX].
+    Rows never measured so far read NORM_OUT_MAX.
+    """
+    cols  = np.arange( observed.shape[1] )
+    last  = np.maximum.accumulate( np.where( observed, cols, -1 ), axis=1 )
+    hours = np.where( last >= 0, ( cols - last ) * HOURS_PER_COL, N_HOURS )
+    return np.interp( hours, [0, N_HOURS], [NORM_OUT_MIN, NORM_OUT_MAX] )
+
+def add_timeline_args( parser ):
+    """
+    Adds command line options for the timeline horizon and resolution.
+    """
+    parser.add_argument('--horizon', type=float, default=N_HOURS,
+                        help='Timeline horizon in hours')
+    parser.add_argument('--resolution', type=float, default=HOURS_PER_COL,
+                        help='Timeline resolution in hours per column')
+
+def add_common_args( parser ):
+    """
+    Adds command line options shared by every model entry point.
+    """
+    parser.add_argument('--channels', type=str, nargs='+', choices=[c.name for c in Img_channel],
+                        help='Timeline image channels to feed the model. Defaults to VALUE')
+    add_timeline_args( parser )
+    parser.add_argument('--quantize', action='store_true',
+                        help='Also compare an int8 quantized copy of the model against fp32 on CPU after training')
+    parser.add_argument('--distributed', action='store_true',
+                        help='Train data parallel across the ranks launched by torchrun, using the gloo backend on CPU')
+    parser.add_argument('--patience', type=int,
+                        help='Stop after this many epochs without val improvement and restore the best weights')
+    parser.add_argument('--min_delta', type=float, default=EARLY_STOP_MIN_DELTA,
+                        help='Minimum change in the monitored val metric that counts as improvement')
+    parser.add_argument('--monitor', type=str, choices=['auc', 'loss'], default=EARLY_STOP_MONITOR,
+                        help='Val metric monitored by --patience and --lr_plateau')
+    parser.add_argument('--lr_plateau', type=float,
+                        help='Multiply the learning rate by this factor when the val metric plateaus')
+    parser.add_argument('--lr_plateau_patience', type=int, default=LR_PLATEAU_PATIENCE,
+                        help='Epochs without val improvement before --lr_plateau lowers the learning rate')
+    parser.add_argument('--neg_fraction', type=float,
+                        help='Train on all positives and this random fraction of negatives, redrawn each epoch')
+    parser.add_argument('--checkpoint', type=str, nargs=1,
+                        help='Directory, relative to DATA_DIR, to save trained weights and optimizer state to')
+    parser.add_argument('--warm_start', type=str, nargs=1,
+                        help='Directory, relative to DATA_DIR, of checkpoints to fine-tune from. Defaults to WARM_START_EPOCHS epochs')
+    parser.add_argument('--warm_start_optimizer', action='store_true',
+                        help='Also restore optimizer state from the --warm_start checkpoint')
+    parser.add_argument('--replay', type=str, nargs=1,
+                        help='Shuffled cohort, relative to IMAGES_DIR, to replay a sample of train visits from')
+    parser.add_argument('--replay_fraction', type=float, default=REPLAY_FRACTION,
+                        help='Fraction of the --replay cohort\'s train visits to add')
+    parser.add_argument('--no_autotune', action='store_true',
+                        help='Ignore batch size, thread and loader settings saved by autotune.py')
+    parser.add_argument('--export', type=str, nargs=1,
+                        help='Directory, relative to DATA_DIR, to export trained models to as TorchScript and ONNX')
+
+def apply_common_args( args ):
+    """
+    Applies options added by add_common_args to the globals in this module.
+    """
+    global IMG_CHANNELS, QUANTIZE_EVAL, EXPORT_DIR, AUTOTUNE_ENABLED, device
+    global N_EPOCH, CHECKPOINT_DIR, WARM_START_DIR, WARM_START_OPTIMIZER, REPLAY_COHORT, REPLAY_FRACTION
+    global NEG_SAMPLE_FRACTION, EARLY_STOP_MONITOR, EARLY_STOP_PATIENCE, EARLY_STOP_MIN_DELTA, LR_PLATEAU_FACTOR, LR_PLATEAU_PATIENCE
+    if args.channels is not None:
+        IMG_CHANNELS = list( dict.fromkeys( Img_channel[name] for name in args.channels ) )
+    set_timeline( args.horizon, args.resolution )
+    QUANTIZE_EVAL = QUANTIZE_EVAL or args.quantize
+    if args.export is not None:
+        EXPORT_DIR = args.export[0]
+    if args.no_autotune:
+        AUTOTUNE_ENABLED = False
+    if args.checkpoint is not None:
+        CHECKPOINT_DIR = args.checkpoint[0]
+    if args.warm_start is not None:
+        WARM_START_DIR = args.warm_start[0]
+        N_EPOCH        = WARM_START_EPOCHS
+    WARM_START_OPTIMIZER = WARM_START_OPTIMIZER or args.warm_start_optimizer
+    if args.replay is not None:
+        REPLAY_COHORT = args.replay[0]
+    REPLAY_FRACTION = args.replay_fraction
+    if args.neg_fraction is not None:
+        NEG_SAMPLE_FRACTION = args.neg_fraction
+    if args.patience is not None:
+        EARLY_STOP_PATIENCE = args.patience
+    if args.lr_plateau is not None:
+        LR_PLATEAU_FACTOR = args.lr_plateau
+    EARLY_STOP_MONITOR   = args.monitor
+    EARLY_STOP_MIN_DELTA = args.min_delta
+    LR_PLATEAU_PATIENCE  = args.lr_plateau_patience
+    if args.distributed:
+        distributed.init()
+        device = torch.device( "cpu" )
+
 def normalize(
         stats: np.ndarray, valuenum: float, ref_min: float, ref_max: float, feature_id: int, var_type: int, method: Norm_method, item_id = None
     ) -> float:
@@ -252,9 +761,11 @@ def normalize(
     return val_normalized
 
 
-def dump_outputs(y_pred, y_true):
+def dump_outputs(y_pred, y_true, y_score=None, img_names=None):
     """
     Generates a csv for quick viewing of predictions vs ground truth.
+    If y_score and img_names are supplied they are written as extra columns
+    so the outputs can be joined with clinical scores by patient/visit id.
     """
     datetime_str = datetime.datetime.now().strftime( "%Y%m%d%H%M" )
     with open( os.path.join( os.getenv('DATA_DIR'), f'output_{datetime_str}.csv'), 'a', newline='') as f:
@@ -262,8 +773,30 @@ def dump_outputs(y_pred, y_true):
 
         for i in range( y_pred.shape[0] ):
             line = [c.strip() for c in f"{y_pred[i]}, {y_true[i]}".strip(', ').split(',')]
+            if y_score is not None and img_names is not None:
+                line += [ f"{y_score[i]}", img_names[i] ]
             out_writer.writerow(line)
 
+def eval_loss( model, dataloader, criterion, prepare_input=None ):
+    """
+    Mean of criterion over every sample of dataloader, reduced across ranks when distributed.
+    """
+    model = distributed.unwrap_model( model )
+    model.eval()
+
+    losses = []
+    with torch.no_grad():
+        for data, target in dataloader:
+            data, target = data.to( device ), target.to( device )
+            if prepare_input is not None:
+                data = prepare_input( data )
+            losses.append( criterion( model( data ), target ).item() * len( target ) )
+
+    # Sum and count per rank, so shards of different sizes are weighted correctly
+    total, count = distributed.gather_outputs( np.array( [ np.sum( losses ) ] ), np.array( [ len( dataloader.sampler ) ] ) )
+
+    return np.sum( total ) / np.sum( count )
+
 def evaluate_predictions( truth, preds, score=None, average='binary' ):
 
     # Evaluate the scores' predictions against the ground truth
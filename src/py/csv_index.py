@@ -0,0 +1,165 @@
+import os
+import time
+import argparse
+import numpy as np
+import common
+
+# Index files are written next to the csv they cover
+INDEX_FILE_SUFFIX = '.index.npz'
+
+class ExportIndex:
+    """
+    Byte offsets of each block of consecutive rows sharing a patient_id and visit_id in an export csv,
+    in file order. Since the export is sorted by patient id, so are the blocks. A visit's rows are
+    normally one block, but a visit interleaved with another of the same patient gets one block per run.
+    """
+    def __init__( self, patient_id: np.ndarray, visit_id: np.ndarray, start: np.ndarray, end: np.ndarray, n_rows: np.ndarray ):
+        self.patient_id = patient_id
+        self.visit_id   = visit_id
+        self.start      = start
+        self.end        = end
+        self.n_rows     = n_rows
+
+    def __len__( self ):
+        return len( self.start )
+
+    def patient_range( self, first_patient_id: int, last_patient_id: int ):
+        """
+        Returns the byte range [start, end) holding every row of the patients in [first_patient_id, last_patient_id],
+        or None if there are none.
+        """
+        lo = np.searchsorted( self.patient_id, first_patient_id, side='left' )
+        hi = np.searchsorted( self.patient_id, last_patient_id,  side='right' )
+        if lo >= hi:
+            return None
+        return int( self.start[lo] ), int( self.end[hi - 1] )
+
+    def visit_ranges( self, visit_ids ):
+        """
+        Returns the byte ranges [start, end) holding every row of the given visits, in file order.
+        Adjacent blocks are merged so they're read in one go. Visits not in the export are ignored.
+        """
+        blocks = np.flatnonzero( np.isin( self.visit_id, np.asarray( list( visit_ids ), dtype=np.int64 ) ) )
+
+        ranges = list()
+        for i in blocks:
+            if len( ranges ) > 0 and ranges[-1][1] == self.start[i]:
+                ranges[-1][1] = int( self.end[i] )
+            else:
+                ranges.append( [ int( self.start[i] ), int( self.end[i] ) ] )
+
+        return [ tuple( r ) for r in ranges ]
+
+    def split( self, n_ranges: int ):
+        """
+        Splits the export into at most n_ranges byte ranges of roughly equal size that never split a patient,
+        for planning parallel passes over it. Returns a list of ( start, end ).
+        """
+        if len( self ) == 0:
+            return []
+
+        # Blocks where a new patient starts are the only valid cut points
+        cuts   = np.flatnonzero( np.diff( self.patient_id, prepend=-1 ) != 0 )
+        total  = self.end[-1] - self.start[0]
+        target = self.start[0] + total * np.arange( 1, n_ranges ) / n_ranges
+        cuts   = np.unique( cuts[ np.clip( np.searchsorted( self.start[cuts], target ), 0, len( cuts ) - 1 ) ] )
+
+        bounds = [ int( self.start[0] ) ] + [ int( self.start[i] ) for i in cuts if i > 0 ] + [ int( self.end[-1] ) ]
+        bounds = list( dict.fromkeys( bounds ) )
+
+        return list( zip( bounds[:-1], bounds[1:] ) )
+
+def get_index_path( csv_file: str ):
+    return csv_file + INDEX_FILE_SUFFIX
+
+def build_index( csv_file: str ):
+    """
+    Makes one pass over the raw bytes of csv_file and records the byte range and row count of
+    every patient_id/visit_id block. Header and mapping rows are left out.
+    """
+    patient_ids = list()
+    visit_ids   = list()
+    starts      = list()
+    ends        = list()
+    n_rows      = list()
+
+    with open( csv_file, 'rb' ) as f:
+        # Skip header row
+        pos = len( f.readline() )
+
+        key = None
+        for line in f:
+            fields     = line.split( b',', 2 )
+            patient_id = int( fields[common.Input_event_col.PATIENT_ID].strip( b'"' ) )
+            if patient_id != common.MAPPING_PATIENT_ID:
+                visit_id = int( fields[common.Input_event_col.VISIT_ID].strip( b'"' ) )
+
+                if key != ( patient_id, visit_id ):
+                    key = ( patient_id, visit_id )
+                    patient_ids.append( patient_id )
+                    visit_ids.append( visit_id )
+                    starts.append( pos )
+                    ends.append( pos )
+                    n_rows.append( 0 )
+
+                ends[-1]   = pos + len( line )
+                n_rows[-1] = n_rows[-1] + 1
+
+            pos = pos + len( line )
+
+    return ExportIndex(
+        np.array( patient_ids, dtype=np.int64 ),
+        np.array( visit_ids,   dtype=np.int64 ),
+        np.array( starts,      dtype=np.int64 ),
+        np.array( ends,        dtype=np.int64 ),
+        np.array( n_rows,      dtype=np.int64 ),
+    )
+
+def save_index( index: ExportIndex, csv_file: str ):
+    """
+    Saves index next to csv_file, along with the csv's size and modification time so a stale index is detected.
+    """
+    st = os.stat( csv_file )
+    # np.savez appends .npz to names without it, so write to a name that already has it
+    tmp_path = get_index_path( csv_file ) + '.tmp.npz'
+    np.savez( tmp_path, patient_id=index.patient_id, visit_id=index.visit_id, start=index.start, end=index.end, n_rows=index.n_rows,
+              csv_size=st.st_size, csv_mtime_ns=st.st_mtime_ns )
+    os.replace( tmp_path, get_index_path( csv_file ) )
+
+def load_index( csv_file: str, rebuild: bool = False ):
+    """
+    Returns the index of csv_file, building and saving it first if it's missing, stale or rebuild is set.
+    """
+    index_path = get_index_path( csv_file )
+    st = os.stat( csv_file )
+
+    if not rebuild and os.path.exists( index_path ):
+        with np.load( index_path ) as saved:
+            if int( saved['csv_size'] ) == st.st_size and int( saved['csv_mtime_ns'] ) == st.st_mtime_ns:
+                return ExportIndex( saved['patient_id'], saved['visit_id'], saved['start'], saved['end'], saved['n_rows'] )
+        print( f"{index_path} is out of date" )
+
+    print( f"Indexing {csv_file}" )
+    start_time = time.time()
+    index = build_index( csv_file )
+    save_index( index, csv_file )
+    print( "Indexed {} blocks in {:.2f} sec".format( len( index ), time.time() - start_time ) )
+
+    return index
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_file', type=str,
+                        help='Exported patient data csv, relative to DATA_DIR')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the index even if it is up to date')
+    args = parser.parse_args()
+
+    index = load_index( os.path.join( os.getenv('DATA_DIR'), args.csv_file ), args.rebuild )
+
+    print( "%d patients, %d visits, %d blocks, %d rows, %.1f MB" % (
+        len( np.unique( index.patient_id ) ), len( np.unique( index.visit_id ) ), len( index ),
+        np.sum( index.n_rows ), np.sum( index.end - index.start ) / 1024**2 ) )
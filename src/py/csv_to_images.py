@@ -3,39 +3,212 @@ from typing import Tuple
 from datetime import datetime
 import os
 import sys
+import argparse
 import patient_visit
 import common
 import numpy as np
 import cv2
 import time
+import threading
+import queue
+import cohort_cache
+import csv_index
+import export_formats
+import sparse_events
+import mews
+import sofa
 
 # Name for generated cohort
 COHORT_NAME = ''
 
-def parse_csv_to_images( csv_file: str ):
+# Clinical score trajectories written next to each cohort's images, see write_clinical_scores
+CLINICAL_SCORE_FILE_NAMES = [common.CS_MEWS_PREDS_FILE_NAME, common.CS_SOFA_PREDS_FILE_NAME]
+
+# Serializes appends to the clinical score files when several batches are parsed at once
+clinical_scores_lock = threading.Lock()
+
+def parse_csv_to_images( csv_file: str, norm_methods: list = None, patient_range: tuple = None, visit_ids: list = None ):
     """
     Top-level function that loads the provided 
     csv and saves images to disk as png.
+    The csv is read once, and one cohort is written per normalization method.
+    Given a ( first, last ) patient_range or a list of visit_ids, only those visits are
+    rebuilt, seeking straight to their rows with the csv's index. Their images and
+    clinical scores are replaced and the rest of the cohort is left as is.
+    Besides plain csv, gzip or zstd compressed csv and Parquet or Arrow exports are read,
+    see export_formats. These have no byte offsets, so they skip the cohort cache and index.
     """
-    patient_visits = dict()
-    unknown_items  = list()
+    if norm_methods is None:
+        norm_methods = [common.NORM_METHOD]
 
-    item2feature, stats = generate_stats()
+    item2feature, stats = generate_stats( csv_file )
+    img_paths = { method: get_master_path( method, norm_methods ) for method in norm_methods }
 
     print( f"Parsing {csv_file}" )
     parse_start_time = time.time()
-    with open( csv_file, 'r' ) as f:
-    
-        i             = 0
-        i_batch       = 0
-        visit_id_prev = 0
-        
-        for row in reader(f):
-            if i == 0:
-                # Skip header row, we'll parse the columns ourselves
-                i = i + 1
-                continue
 
+    if patient_range is not None or visit_ids is not None:
+        if patient_range is not None:
+            selected = lambda patient_id, visit_id: patient_range[0] <= patient_id <= patient_range[1]
+        else:
+            visit_ids = set( visit_ids )
+            selected  = lambda patient_id, visit_id: visit_id in visit_ids
+        remove_clinical_scores( img_paths, selected )
+
+        if export_formats.is_plain_csv( csv_file ):
+            index = csv_index.load_index( csv_file )
+            if patient_range is not None:
+                ranges = [ r for r in [ index.patient_range( *patient_range ) ] if r is not None ]
+            else:
+                ranges = index.visit_ranges( visit_ids )
+
+            print( "Reading {} byte ranges, {:.1f} MB".format( len( ranges ), sum( end - start for start, end in ranges ) / 1024**2 ) )
+            rows = iter_csv_ranges( csv_file, ranges )
+        else:
+            # Stream the whole export and keep the selected rows. Parquet still skips row groups outside the patient range
+            first, last = patient_range if patient_range is not None else ( None, None )
+            rows = ( row for row in export_formats.iter_rows( csv_file, first, last )
+                     if selected( int( row[common.Input_event_col.PATIENT_ID] ), int( row[common.Input_event_col.VISIT_ID] ) ) )
+
+        n_images = parse_rows( rows, item2feature, stats, img_paths )
+        print( "Rebuilt {} visits in {:.2f} sec".format( n_images, time.time() - parse_start_time ) )
+        return
+
+    reset_clinical_scores( img_paths )
+    for img_path in img_paths.values():
+        sparse_events.remove_events( img_path )
+
+    if not export_formats.is_plain_csv( csv_file ):
+        parse_rows( export_formats.iter_rows( csv_file ), item2feature, stats, img_paths )
+    elif common.COHORT_CACHE_ENABLED:
+        # Only regenerate images for shards of the csv that changed since the last run
+        cohort_cache.build_cohort(
+            csv_file, img_paths, item2feature, stats,
+            lambda start, end, out_paths: parse_rows( iter_csv_rows( csv_file, start, end ), item2feature, stats, out_paths )
+        )
+    else:
+        parse_rows( iter_csv_rows( csv_file ), item2feature, stats, img_paths )
+
+    print("Parsing took {:.2f} sec".format( time.time() - parse_start_time) )
+
+def get_cohort_name( method: common.Norm_method, norm_methods: list ):
+    """
+    Returns the cohort name for images normalized with method. When several methods
+    are generated at once, each gets its own cohort suffixed with the method name.
+    """
+    if len( norm_methods ) == 1:
+        return COHORT_NAME
+    return f"{COHORT_NAME}_{method.name.lower()}"
+
+def get_master_path( method: common.Norm_method = None, norm_methods: list = None ):
+    """
+    Returns the path that holds every image of the cohort for the given normalization method.
+    """
+    if method is None:
+        method = common.NORM_METHOD
+    if norm_methods is None:
+        norm_methods = [method]
+    return os.path.join( os.getenv( 'IMAGES_DIR' ), get_cohort_name( method, norm_methods ), 'master' )
+
+def iter_csv_rows( csv_file: str, start: int = 0, end: int = None ):
+    """
+    Yields parsed csv rows from the byte range [start, end) of csv_file.
+    The header row is skipped when reading from the start of the file.
+    Byte offsets must fall on row boundaries.
+    """
+    with open( csv_file, 'rb' ) as f:
+        f.seek( start )
+        if start == 0:
+            # Skip header row, we'll parse the columns ourselves
+            f.readline()
+
+        def lines():
+            pos = f.tell()
+            while end is None or pos < end:
+                line = f.readline()
+                if not line:
+                    break
+                pos = pos + len( line )
+                yield line.decode()
+
+        for row in reader( lines() ):
+            yield row
+
+def iter_csv_ranges( csv_file: str, ranges: list ):
+    """
+    Yields parsed csv rows from each byte range ( start, end ) of csv_file in turn.
+    """
+    for start, end in ranges:
+        yield from iter_csv_rows( csv_file, start, end )
+
+class BatchWriter:
+    """
+    Runs process_batch_images_and_clinical_scores on a background thread, so parsing the next batch
+    overlaps with writing the last one's images. submit blocks once common.CSV_PARSER_WRITE_QUEUE
+    batches are waiting, which bounds how many parsed visits are held in memory.
+    """
+    def __init__( self, stats: np.ndarray, item2feature: dict, img_paths: dict ):
+        self.stats        = stats
+        self.item2feature = item2feature
+        self.img_paths    = img_paths
+        self.batches      = queue.Queue( maxsize=common.CSV_PARSER_WRITE_QUEUE )
+        self.error        = None
+        self.n_images     = 0
+        self.thread       = threading.Thread( target=self.run, daemon=True )
+        self.thread.start()
+
+    def run( self ):
+        while True:
+            patient_visits = self.batches.get()
+            if patient_visits is None:
+                return
+
+            # After a failure keep draining the queue so submit never blocks, the error is raised on the parsing thread
+            if self.error is None:
+                try:
+                    process_batch_images_and_clinical_scores( patient_visits, self.stats, self.item2feature, self.img_paths )
+                    self.n_images = self.n_images + len( patient_visits )
+                except Exception as e:
+                    self.error = e
+
+    def submit( self, patient_visits: dict ):
+        if self.error is not None:
+            raise self.error
+        if len( patient_visits ) > 0:
+            self.batches.put( patient_visits )
+
+    def close( self ):
+        """
+        Waits for every submitted batch to be written. Returns the number of visits written.
+        """
+        self.batches.put( None )
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.n_images
+
+def parse_rows( rows, item2feature: dict, stats: np.ndarray, img_paths: dict ):
+    """
+    Parses csv rows into patient visits and saves their images.
+    img_paths maps each normalization method to generate to its output path.
+    Rows are parsed, filtered and mapped once, only normalization is repeated per method.
+    Rows must be sorted by patient id, so a patient's visits are complete once the next patient starts.
+    Completed visits are handed to a BatchWriter whenever common.CSV_PARSER_MAX_VISITS of them or
+    common.CSV_PARSER_MAX_BYTES of their arrays are waiting, so memory doesn't grow with the export.
+    Returns the number of visits generated.
+    """
+    norm_methods   = list( img_paths )
+    current        = dict()
+    completed      = dict()
+    unknown_items  = list()
+    n_bytes        = 0
+
+    i               = 0
+    patient_id_prev = None
+
+    batch_writer = BatchWriter( stats, item2feature, img_paths )
+    try:
+        for row in rows:
             if int( row[common.Input_event_col.PATIENT_ID] ) == common.MAPPING_PATIENT_ID:
                 # Skip rows with our special patient id.
                 continue
@@ -51,8 +224,24 @@ def parse_csv_to_images( csv_file: str ):
                 if patient_id > common.CSV_PARSER_PATIENTID_MAX:
                     break
 
+            # The stream has moved past the previous patient, so their visits are complete
+            if patient_id != patient_id_prev:
+                for visit in current.values():
+                    completed[visit.visit_id] = visit
+                    n_bytes = n_bytes + visit.nbytes()
+                current = dict()
+                patient_id_prev = patient_id
+
+                # Flush once the completed visits reach either budget
+                if len( completed ) >= common.CSV_PARSER_MAX_VISITS or n_bytes >= common.CSV_PARSER_MAX_BYTES:
+                    print( f"\nDone {i} rows" )
+                    batch_writer.submit( completed )
+                    completed = dict()
+                    n_bytes   = 0
+
             # If the hour is out of the range we care about, skip this row
-            if hour >= common.N_HOURS:
+            col = int( hour / common.HOURS_PER_COL )
+            if col >= common.N_COLS:
                 continue
 
             # If we don't have a row mapping for this itemid, note that down
@@ -62,9 +251,9 @@ def parse_csv_to_images( csv_file: str ):
                 continue
 
             # Get the object for this patient, creating one if we haven't seen them before
-            if not visit_id in patient_visits:
-                patient_visits[visit_id] = patient_visit.Patient_visit( patient_id, visit_id, hospital_expire_flag, stats, item2feature )
-            subject = patient_visits[visit_id]
+            if not visit_id in current:
+                current[visit_id] = patient_visit.Patient_visit( patient_id, visit_id, hospital_expire_flag, stats, item2feature, norm_methods )
+            subject = current[visit_id]
 
             # Lookup Feature ID
             feature_id = item2feature[itemid]
@@ -73,95 +262,101 @@ def parse_csv_to_images( csv_file: str ):
             if itemid in [item.value for item in common.Special_itemids]:
                 handle_special_itemid( itemid, val_num, subject, stats, item2feature )
             else:
-                # Otherwise, normalize valuenum
-                valuenum_norm = common.normalize( stats, val_num, ref_min, ref_max, feature_id, var_type, common.NORM_METHOD, itemid )
-
-                if var_type == common.Var_type.BINARY_POINT:
-                    # Write valuenum to specified hour without carry-over
-                    subject.img[feature_id, hour] = valuenum_norm
-                else:
-                    # Write valuenum to the remainder of the appropriate row
-                    subject.img[feature_id, hour:] = valuenum_norm
+                # Otherwise, normalize valuenum with each method
+                for method, img in subject.imgs.items():
+                    valuenum_norm = common.normalize( stats, val_num, ref_min, ref_max, feature_id, var_type, method, itemid )
 
-            # Record clinical score component vals if relevant to this itemid
-            record_clinical_score_component(itemid, val_num, hour, subject, item2feature)
+                    if var_type == common.Var_type.BINARY_POINT:
+                        # Write valuenum to specified hour without carry-over
+                        img[feature_id, col] = valuenum_norm
+                    else:
+                        # Write valuenum to the remainder of the appropriate row
+                        img[feature_id, col:] = valuenum_norm
 
-            # Generate images if we've completed a batch
-            if (i_batch >= common.CSV_PARSER_BATCH_SIZE) and (visit_id_prev != visit_id):
-                print(f"\nDone {i} rows")
-                process_batch_images_and_clinical_scores(patient_visits, stats, item2feature)
-                patient_visits.clear()
-                i_batch = 0
+                # Only this hour was measured, the rest of the row is carried over
+                subject.observed[feature_id, col] = True
 
-            # Update visit_id_prev so we can track whether visit_id changes on next iter
-            visit_id_prev = visit_id
+            # Record clinical score component vals if relevant to this itemid
+            record_clinical_score_component(itemid, val_num, col, subject, item2feature)
 
             # Print progress indicator
             if (i % 500000) == 0:
                 print('.', end='', flush=True)
 
             i = i + 1
-            i_batch = i_batch + 1
 
-    # Report any itemids encountered on input that we don't have a stats mapping for
-    if len(unknown_items) > 0:
-        print(f"Skipped unknown items:")
-        for item in unknown_items:
-            print(item)
+        # Report any itemids encountered on input that we don't have a stats mapping for
+        if len(unknown_items) > 0:
+            print(f"Skipped unknown items:")
+            for item in unknown_items:
+                print(item)
 
-    # Process the final partial batch
-    process_batch_images_and_clinical_scores( patient_visits, stats, item2feature )
+        # Process the final partial batch, including the last patient
+        completed.update( current )
+        batch_writer.submit( completed )
+    finally:
+        n_images = batch_writer.close()
 
-    print("Parsing took {:.2f} sec".format( time.time() - parse_start_time) )
+    return n_images
 
-def process_batch_images_and_clinical_scores( patient_visits, stats, item2feature ):
+def process_batch_images_and_clinical_scores( patient_visits, stats, item2feature, img_paths ):
     """
-    Function to process a batch. Generates images, tallies braden/morse, and computes MEWS/SOFA.
+    Function to process a batch. Generates images, tallies braden/morse, and writes MEWS/SOFA.
     """
-    # Generate images
+    # Generate images, or their sparse events
     print( f"Generating {len(patient_visits)} images" )
     gen_start_time = time.time()
-    generate_images( patient_visits )
+    if common.SPARSE_EVENTS:
+        sparse_events.write_events( patient_visits, stats, img_paths )
+    else:
+        generate_images( patient_visits, stats, img_paths )
     print("Image generation took {:.2f} sec".format( time.time() - gen_start_time) )
 
     # Tally braden/morse
-    tally_clinical_scores( patient_visits, stats, item2feature )
+    tally_clinical_scores( patient_visits, stats, item2feature, list( img_paths ) )
+
+    # Write MEWS/SOFA trajectories
+    write_clinical_scores( patient_visits, img_paths )
 
 
-def generate_stats():
+def generate_stats( csv_file: str ):
     """
     Function to build up stats based on embedded mapping info
     """
+    rows = export_formats.iter_rows( csv_file )
+    try:
+        return build_stats( rows )
+    finally:
+        rows.close()
+
+def build_stats( rows ):
+    """
+    Builds item2feature and stats from the mapping rows at the start of rows,
+    an iterable of row sequences in Input_event_col order.
+    """
     item2feature = dict()
     stats = np.zeros((common.N_ROWS, common.Stats_col.N_COLS), dtype=np.float64)
 
-    parse_start_time = time.time()
     i = 0
-    with open(csv_file, 'r') as f:
-        for row in reader(f):
-            if i == 0:
-                # Skip header row, we'll parse the columns ourselves
-                i = i + 1
-                continue
+    for row in rows:
+        if int(row[common.Input_event_col.PATIENT_ID]) == common.MAPPING_PATIENT_ID:
+            # We only care about rows with our special patient id.
+            # In this special case, treat the visit_id column as row_id.
+            row_id = int(row[common.Input_event_col.VISIT_ID])
+            item2feature[int(row[common.Input_event_col.EVENT_ID])] = row_id
+
+            stats[row_id][common.Stats_col.VAR_TYPE]    = float( row[common.Input_event_col.VAR_TYPE]    )
+            stats[row_id][common.Stats_col.VAL_NUM ]    = float( row[common.Input_event_col.VAL_NUM ]    )
+            stats[row_id][common.Stats_col.VAL_MIN ]    = float( row[common.Input_event_col.VAL_MIN ]    )
+            stats[row_id][common.Stats_col.VAL_MAX ]    = float( row[common.Input_event_col.VAL_MAX ]    )
+            stats[row_id][common.Stats_col.REF_MIN ]    = float( row[common.Input_event_col.REF_MIN ]    )
+            stats[row_id][common.Stats_col.REF_MAX ]    = float( row[common.Input_event_col.REF_MAX ]    )
+            stats[row_id][common.Stats_col.VAL_DEFAULT] = float( row[common.Input_event_col.VAL_DEFAULT] )
 
-            if int(row[common.Input_event_col.PATIENT_ID]) == common.MAPPING_PATIENT_ID:
-                # We only care about rows with our special patient id.
-                # In this special case, treat the visit_id column as row_id.
-                row_id = int(row[common.Input_event_col.VISIT_ID])
-                item2feature[int(row[common.Input_event_col.EVENT_ID])] = row_id
-
-                stats[row_id][common.Stats_col.VAR_TYPE]    = float( row[common.Input_event_col.VAR_TYPE]    )
-                stats[row_id][common.Stats_col.VAL_NUM ]    = float( row[common.Input_event_col.VAL_NUM ]    )
-                stats[row_id][common.Stats_col.VAL_MIN ]    = float( row[common.Input_event_col.VAL_MIN ]    )
-                stats[row_id][common.Stats_col.VAL_MAX ]    = float( row[common.Input_event_col.VAL_MAX ]    )
-                stats[row_id][common.Stats_col.REF_MIN ]    = float( row[common.Input_event_col.REF_MIN ]    )
-                stats[row_id][common.Stats_col.REF_MAX ]    = float( row[common.Input_event_col.REF_MAX ]    )
-                stats[row_id][common.Stats_col.VAL_DEFAULT] = float( row[common.Input_event_col.VAL_DEFAULT] )
-
-                i = i + 1
-            else:
-                # We've finished reading the special mapping rows, so we're done here.
-                break
+            i = i + 1
+        else:
+            # We've finished reading the special mapping rows, so we're done here.
+            break
 
     print(f"Generated stats for {i} itemids")
 
@@ -174,7 +369,7 @@ def cast_csv_row(row: list):
     patient_id  = int(   row[common.Input_event_col.PATIENT_ID]  )
     visit_id    = int(   row[common.Input_event_col.VISIT_ID]    )
     itemid      = int(   row[common.Input_event_col.EVENT_ID]    )
-    hour        = int(   row[common.Input_event_col.HOUR]        )
+    hour        = float( row[common.Input_event_col.HOUR]        )
     var_type    = int(   row[common.Input_event_col.VAR_TYPE]    )
     val_num     = float( row[common.Input_event_col.VAL_NUM]     )
     val_min     = float( row[common.Input_event_col.VAL_MIN]     )
@@ -189,78 +384,160 @@ def cast_csv_row(row: list):
 
 def record_clinical_score_component(itemid, val_num, hour, visit, item2feature):
     """
-    Record the value of a clinical score component for a given patient on a given hour
+    Record the value of a clinical score component for a given patient on a given hour.
+    hour is the timeline column, which only differs from the hour when HOURS_PER_COL != 1
     """
     if itemid in common.braden_item2row:
-        visit.braden[ common.braden_item2row[itemid], hour ] = val_num
+        for braden in visit.braden.values():
+            braden[ common.braden_item2row[itemid], hour ] = val_num
 
     if itemid in common.morse_item2row:
-        visit.morse[ common.morse_item2row[itemid], hour ] = val_num
+        for morse in visit.morse.values():
+            morse[ common.morse_item2row[itemid], hour ] = val_num
+
+    if itemid in mews.item2component:
+        mews.record_component( itemid, val_num, hour, visit )
 
+    if itemid in sofa.ITEMIDS:
+        sofa.record_component( itemid, val_num, hour, visit )
 
-def tally_clinical_scores( patient_visits, stats, item2feature ):
+def reset_clinical_scores( img_paths: dict ):
+    """
+    Removes clinical score files left in img_paths by a previous run, since batches append to them.
+    """
+    for img_path in img_paths.values():
+        for name in CLINICAL_SCORE_FILE_NAMES:
+            try:
+                os.remove( os.path.join( img_path, name ) )
+            except FileNotFoundError:
+                pass
+
+def remove_clinical_scores( img_paths: dict, predicate ):
+    """
+    Drops the rows of visits for which predicate( patient_id, visit_id ) holds from the clinical
+    score files in img_paths, so rebuilding a subset of visits doesn't leave duplicates.
+    """
+    with clinical_scores_lock:
+        for img_path in img_paths.values():
+            for name in CLINICAL_SCORE_FILE_NAMES:
+                path = os.path.join( img_path, name )
+                if not os.path.exists( path ):
+                    continue
+
+                with open( path, 'r', newline='' ) as f:
+                    rows = list( reader( f ) )
+
+                kept = rows[:1] + [ row for row in rows[1:] if not predicate( int( row[0] ), int( row[1] ) ) ]
+
+                with open( path, 'w', newline='' ) as f:
+                    writer( f ).writerows( kept )
+
+def write_clinical_scores( patient_visits: dict, img_paths: dict ):
+    """
+    Appends each visit's MEWS and SOFA scores to mews_preds.csv and sofa_preds.csv in each of img_paths.
+    The leading columns match the exports of mews_score.sql and sofa_score.sql, so mews.py and sofa.py
+    read either, and are followed by the score at each hour of the timeline.
+    Scores only cover events within the timeline, so they can differ from the exports for longer visits.
+    """
+    hour_cols = [ f"h{col}" for col in range( common.N_COLS ) ]
+    mews_rows = list()
+    sofa_rows = list()
+
+    for visit in patient_visits.values():
+        mews_trajectory = mews.get_trajectory( visit )
+        sofa_trajectory = sofa.get_trajectory( visit )
+
+        mews_score = mews_trajectory[-1]
+        sofa_score = sofa_trajectory[-1]
+
+        mews_rows.append( [ visit.patient_id, visit.visit_id, mews_score, int( mews_score >= common.MEWS_WARNING_SCORE ), visit.hospital_expire_flag ] + mews_trajectory.tolist() )
+        sofa_rows.append( [ visit.patient_id, visit.visit_id, sofa_score, sofa.get_est_mortality( sofa_score ), visit.hospital_expire_flag ] + sofa_trajectory.tolist() )
+
+    outputs = [
+        ( common.CS_MEWS_PREDS_FILE_NAME, [ 'patient_id', 'visit_id', 'mews_score', 'mews_warning', 'died' ] + hour_cols, mews_rows ),
+        ( common.CS_SOFA_PREDS_FILE_NAME, [ 'patient_id', 'visit_id', 'sofa_score', 'est_mortality', 'died' ] + hour_cols, sofa_rows ),
+    ]
+
+    with clinical_scores_lock:
+        for img_path in img_paths.values():
+            os.makedirs( img_path, exist_ok=True )
+            for name, header, rows in outputs:
+                path = os.path.join( img_path, name )
+                write_header = not os.path.exists( path )
+                with open( path, 'a', newline='' ) as f:
+                    score_writer = writer( f )
+                    if write_header:
+                        score_writer.writerow( header )
+                    score_writer.writerows( rows )
+
+
+def tally_clinical_scores( patient_visits, stats, item2feature, norm_methods ):
     """
     Handles itemids that have special meanings. Often involves directly updating
     the image for the given patient. 
     """
-    braden_cumulative_default_normalized = common.normalize(
-        stats,
-        stats[common.BRADEN_ROWID, common.Stats_col.VAL_DEFAULT],
-        stats[common.BRADEN_ROWID, common.Stats_col.REF_MIN],
-        stats[common.BRADEN_ROWID, common.Stats_col.REF_MAX],
-        common.BRADEN_ROWID,
-        stats[common.BRADEN_ROWID, common.Stats_col.VAR_TYPE],
-        common.NORM_METHOD
-    )
-
-    morse_cumulative_default_normalized = common.normalize(
-        stats,
-        stats[common.MORSE_ROWID, common.Stats_col.VAL_DEFAULT],
-        stats[common.MORSE_ROWID, common.Stats_col.REF_MIN],
-        stats[common.MORSE_ROWID, common.Stats_col.REF_MAX],
-        common.MORSE_ROWID,
-        stats[common.MORSE_ROWID, common.Stats_col.VAR_TYPE],
-        common.NORM_METHOD
-    )
-
-    # Compute bounds for normalization
-    for key in patient_visits:
-        visit = patient_visits[key]
-
-        # Assign cumulative sum of braden/morse scores for each hour
-        braden = visit.braden.sum(axis=0)
-        morse = visit.morse.sum(axis=0)
-
-        braden_normalized = np.zeros_like(braden)
-        morse_normalized = np.zeros_like(morse)
-        for hour in range(common.N_HOURS):
-            # Normalize
-            braden_normalized[hour] = common.normalize(
-                stats,
-                braden[hour],
-                stats[common.BRADEN_ROWID, common.Stats_col.REF_MIN],
-                stats[common.BRADEN_ROWID, common.Stats_col.REF_MAX],
-                common.BRADEN_ROWID,
-                stats[common.BRADEN_ROWID, common.Stats_col.VAR_TYPE],
-                common.NORM_METHOD
-            )
+    for method in norm_methods:
+        braden_cumulative_default_normalized = common.normalize(
+            stats,
+            stats[common.BRADEN_ROWID, common.Stats_col.VAL_DEFAULT],
+            stats[common.BRADEN_ROWID, common.Stats_col.REF_MIN],
+            stats[common.BRADEN_ROWID, common.Stats_col.REF_MAX],
+            common.BRADEN_ROWID,
+            stats[common.BRADEN_ROWID, common.Stats_col.VAR_TYPE],
+            method
+        )
 
-            morse_normalized[hour] = common.normalize(
-                stats,
-                morse[hour],
-                stats[common.MORSE_ROWID, common.Stats_col.REF_MIN],
-                stats[common.MORSE_ROWID, common.Stats_col.REF_MAX],
-                common.MORSE_ROWID,
-                stats[common.MORSE_ROWID, common.Stats_col.VAR_TYPE],
-                common.NORM_METHOD
-            )
+        morse_cumulative_default_normalized = common.normalize(
+            stats,
+            stats[common.MORSE_ROWID, common.Stats_col.VAL_DEFAULT],
+            stats[common.MORSE_ROWID, common.Stats_col.REF_MIN],
+            stats[common.MORSE_ROWID, common.Stats_col.REF_MAX],
+            common.MORSE_ROWID,
+            stats[common.MORSE_ROWID, common.Stats_col.VAR_TYPE],
+            method
+        )
 
-            # Write morse/braden timelines to image
-            if braden[hour] != braden_cumulative_default_normalized:
-                visit.img[common.BRADEN_ROWID, hour:] = braden_normalized[hour]
+        # Compute bounds for normalization
+        for key in patient_visits:
+            visit = patient_visits[key]
+            img   = visit.imgs[method]
+
+            # Assign cumulative sum of braden/morse scores for each hour
+            braden = visit.braden[method].sum(axis=0)
+            morse = visit.morse[method].sum(axis=0)
+
+            braden_normalized = np.zeros_like(braden)
+            morse_normalized = np.zeros_like(morse)
+            for hour in range(common.N_COLS):
+                # Normalize
+                braden_normalized[hour] = common.normalize(
+                    stats,
+                    braden[hour],
+                    stats[common.BRADEN_ROWID, common.Stats_col.REF_MIN],
+                    stats[common.BRADEN_ROWID, common.Stats_col.REF_MAX],
+                    common.BRADEN_ROWID,
+                    stats[common.BRADEN_ROWID, common.Stats_col.VAR_TYPE],
+                    method
+                )
+
+                morse_normalized[hour] = common.normalize(
+                    stats,
+                    morse[hour],
+                    stats[common.MORSE_ROWID, common.Stats_col.REF_MIN],
+                    stats[common.MORSE_ROWID, common.Stats_col.REF_MAX],
+                    common.MORSE_ROWID,
+                    stats[common.MORSE_ROWID, common.Stats_col.VAR_TYPE],
+                    method
+                )
+
+                # Write morse/braden timelines to image
+                if braden[hour] != braden_cumulative_default_normalized:
+                    img[common.BRADEN_ROWID, hour:] = braden_normalized[hour]
+                    visit.observed[common.BRADEN_ROWID, hour] = True
                 
-            if morse[hour] != morse_cumulative_default_normalized:
-                visit.img[common.MORSE_ROWID, hour:] = morse_normalized[hour]
+                if morse[hour] != morse_cumulative_default_normalized:
+                    img[common.MORSE_ROWID, hour:] = morse_normalized[hour]
+                    visit.observed[common.MORSE_ROWID, hour] = True
 
 def handle_special_itemid(itemid, val_num, visit, stats, item2feature):
     """
@@ -269,67 +546,91 @@ def handle_special_itemid(itemid, val_num, visit, stats, item2feature):
     """
 
     if itemid == common.Special_itemids.ADMIT_HOUR:
-        hour_reel = np.mod(np.arange(visit.img.shape[1]), 24)
-        hour_reel = np.roll(hour_reel, int(-val_num))
+        hour_reel = np.mod(np.floor(np.arange(common.N_COLS) * common.HOURS_PER_COL) + int(val_num), 24)
         hour_reel = (hour_reel / 23.0) * common.NORM_OUT_MAX
-        visit.img[itemid, :] = hour_reel
+        for img in visit.imgs.values():
+            img[itemid, :] = hour_reel
+
+        # The hour of day is known for the whole timeline
+        visit.observed[itemid, :] = True
 
-def generate_images(patient_visits: dict):
+def generate_images(patient_visits: dict, stats: np.ndarray, img_paths: dict = None):
     """
     Generates an image for each patientvisit using OpenCV.
-    Images are saved in the following structure:
+    Each image carries the normalized timeline, the observation mask and the
+    recency of the last observation in its 3 channels, see common.Img_channel.
+    img_paths maps each normalization method to the folder its images are written to.
+    By default images are saved in the following structure:
     <repo>/images/<orig_cohort_name>/master/<all_the_images>
     """
-    i = 0
-    img_path = os.getenv( 'IMAGES_DIR' )
+    if img_paths is None:
+        img_paths = { common.NORM_METHOD: get_master_path() }
 
-    img_path = os.path.join( img_path, COHORT_NAME, 'master' )
+    point_rows = stats[:, common.Stats_col.VAR_TYPE] == common.Var_type.BINARY_POINT
 
-    try:
-        os.makedirs(img_path)
-    except:
-        pass
+    for method, img_path in img_paths.items():
+        try:
+            os.makedirs(img_path)
+        except:
+            pass
+        common.save_timeline(img_path, point_rows, sparse_events.get_row_defaults(stats, method))
 
-    for key in patient_visits:
-        visit = patient_visits[key]
+        for key in patient_visits:
+            visit = patient_visits[key]
 
-        # Name image based on patient, visit, ground truth
-        img_name = os.path.join( 
-            img_path, 
-            f"{visit.patient_id}_{visit.visit_id}_{visit.hospital_expire_flag}.png" 
-        )
+            observed = visit.observed * common.NORM_OUT_MAX
+            recency  = common.get_recency( visit.observed )
 
-        # Create 3-channel image
-        img = np.zeros((common.N_ROWS, common.N_COLS, 3), dtype=int)
+            # Name image based on patient, visit, ground truth
+            img_name = os.path.join( 
+                img_path, 
+                f"{visit.patient_id}_{visit.visit_id}_{visit.hospital_expire_flag}.png" 
+            )
 
-        # Populate it with patient timeline, duplicated in all 3 channels
-        visit.img = visit.img
-        img[:, :, 0] = visit.img
-        img[:, :, 1] = visit.img
-        img[:, :, 2] = visit.img
+            # Create 3-channel image
+            img = np.zeros((common.N_ROWS, common.N_COLS, 3), dtype=np.uint8)
 
-        cv2.imwrite(img_name, img)
+            # Populate it with patient timeline, observation mask and recency.
+            # OpenCV writes BGR while read_image loads RGB, so channels are stored in reverse.
+            img[:, :, 2 - common.Img_channel.VALUE]    = visit.imgs[method]
+            img[:, :, 2 - common.Img_channel.OBSERVED] = observed
+            img[:, :, 2 - common.Img_channel.RECENCY]  = recency
 
-        i = i + 1
+            # Master images can be hard links into the cohort cache, shared by other cohorts.
+            # Unlink first so a rebuild writes a new file instead of through the link.
+            if os.path.lexists(img_name):
+                os.unlink(img_name)
+            cv2.imwrite(img_name, img)
 
 if __name__ == "__main__":
     """
     Main section for when this file is invoked directly. Should only
     be used for debugging csv parsing down to image generation.
     """
-    # Store csv_filename, and fail if not supplied
-    try:
-        csv_file = sys.argv[1]
-    except:
-        print("Usage: python csv_to_images.py <csv_file> <cohort_name>")
-        raise
-
-    # Store output image name suffix if supplied, but carry on if not
-    try:
-        COHORT_NAME = sys.argv[2]
-    except:
-        print("Usage: python csv_to_images.py <csv_file> <cohort_name>")
-        raise
-
-    path = os.path.join( os.getenv('DATA_DIR'), csv_file )
-    parse_csv_to_images( path )
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_file', type=str,
+                        help='Exported patient data, relative to DATA_DIR. Plain, .gz or .zst csv, .parquet or .arrow')
+    parser.add_argument('cohort_name', type=str,
+                        help='Name of the cohort to generate. Suffixed with the method name when several norm methods are given')
+    parser.add_argument('-m', '--norm_methods', type=str, nargs='+', choices=[method.name for method in common.Norm_method],
+                        help='Normalization methods to generate from a single pass over the csv. Defaults to common.NORM_METHOD')
+    parser.add_argument('--patients', type=int, nargs=2, metavar=('FIRST', 'LAST'),
+                        help='Only rebuild the visits of patients with ids in [FIRST, LAST], using the csv\'s index')
+    parser.add_argument('--visits', type=int, nargs='+',
+                        help='Only rebuild these visit ids, using the csv\'s index')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Store each visit\'s measured hours as sparse events instead of an image')
+    common.add_timeline_args(parser)
+    args = parser.parse_args()
+
+    common.set_timeline( args.horizon, args.resolution )
+
+    COHORT_NAME = args.cohort_name
+    common.SPARSE_EVENTS = common.SPARSE_EVENTS or args.sparse
+
+    norm_methods = None
+    if args.norm_methods is not None:
+        norm_methods = list( dict.fromkeys( common.Norm_method[name] for name in args.norm_methods ) )
+
+    path = os.path.join( os.getenv('DATA_DIR'), args.csv_file )
+    parse_csv_to_images( path, norm_methods, args.patients, args.visits )
@@ -0,0 +1,291 @@
+import numpy as np
+import common
+import checkpoint
+import early_stopping
+import distributed
+import export
+import quantize
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import time
+import argparse
+
+class BasicConv2d( nn.Module ):
+    """
+    Conv2d followed by batch norm and ReLU, as in torchvision's Inception3.
+    """
+    def __init__( self, in_channels, out_channels, **kwargs ):
+        super( BasicConv2d, self ).__init__()
+        self.conv = nn.Conv2d( in_channels, out_channels, bias=False, **kwargs )
+        self.bn   = nn.BatchNorm2d( out_channels, eps=0.001 )
+
+    def forward( self, x ):
+        return F.relu( self.bn( self.conv(x) ) )
+
+class InceptionBlock( nn.Module ):
+    """
+    Inception-style block with four parallel branches concatenated along channels:
+    1x1, 1x1 then a 1x3 conv along hours, 1x1 then a 3x3 conv across features and hours,
+    and 3x3 max pool then 1x1. All branches keep the spatial size.
+    """
+    def __init__( self, in_channels, branch_channels ):
+        super( InceptionBlock, self ).__init__()
+        self.branch1x1 = BasicConv2d( in_channels, branch_channels, kernel_size=1 )
+
+        self.branch1x3_1 = BasicConv2d( in_channels, branch_channels, kernel_size=1 )
+        self.branch1x3_2 = BasicConv2d( branch_channels, branch_channels, kernel_size=(1,3), padding=(0,1) )
+
+        self.branch3x3_1 = BasicConv2d( in_channels, branch_channels, kernel_size=1 )
+        self.branch3x3_2 = BasicConv2d( branch_channels, branch_channels, kernel_size=3, padding=1 )
+
+        self.branch_pool = BasicConv2d( in_channels, branch_channels, kernel_size=1 )
+
+        self.out_channels = 4 * branch_channels
+
+    def forward( self, x ):
+        branch1x1   = self.branch1x1(x)
+        branch1x3   = self.branch1x3_2( self.branch1x3_1(x) )
+        branch3x3   = self.branch3x3_2( self.branch3x3_1(x) )
+        branch_pool = self.branch_pool( F.max_pool2d( x, kernel_size=3, stride=1, padding=1 ) )
+        return torch.cat( [ branch1x1, branch1x3, branch3x3, branch_pool ], 1 )
+
+class DeepCNN( nn.Module ):
+    def __init__( self, input_shape=None ):
+        # Deep CNN built for the native [channels, N_ROWS, N_COLS] timeline instead of upsampling it to 299x299 for Inception3.
+        # Each stage halves rows and hours, e.g. 120x48 -> 60x24 -> 30x12 -> 15x6, before global average pooling.
+        super( DeepCNN, self ).__init__()
+        in_channels, n_rows, n_cols = common.get_input_shape() if input_shape is None else input_shape
+        self.stem     = BasicConv2d( in_channels, 32, kernel_size=3, padding=1 )
+        self.block1   = InceptionBlock( 32, 16 )
+        self.block2   = InceptionBlock( self.block1.out_channels, 32 )
+        self.block3   = InceptionBlock( self.block2.out_channels, 48 )
+        self.block4   = InceptionBlock( self.block3.out_channels, 64 )
+        self.pool     = nn.MaxPool2d( kernel_size=2, stride=2, ceil_mode=True )
+        self.avgpool  = nn.AdaptiveAvgPool2d( (1, 1) )
+        self.dropout  = nn.Dropout( p=0.5 )
+        self.fc1      = nn.Linear( in_features=self.block4.out_channels, out_features=2 )
+
+    def forward( self, x ):
+        x = self.stem(x)
+        x = self.block1(x)
+        x = self.pool(x)
+        x = self.block2(x)
+        x = self.pool(x)
+        x = self.block3(x)
+        x = self.pool(x)
+        x = self.block4(x)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)    # flatten all dimensions except batch
+        x = self.dropout(x)
+        x = self.fc1(x)
+        x = F.softmax( x, dim=1 )
+        return x
+
+def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
+    """
+    Main function.
+    Creates a model, trains it, and evaluates it against test set and val set.
+    """
+    print( f"\nRunning Deep CNN on CUDA device: {common.device}" )
+    print( f"            Cohort: {os.path.basename(data_path)}")
+
+
+    # Use batch size, thread and loader settings tuned for this machine, if any
+    common.apply_tuned_config( 'deep_cnn' )
+
+    # Load images and labels for each split
+    train_loader, test_loader, val_loader = common.load_data(data_path=data_path, neg_fraction=common.get_neg_fraction( 'deep_cnn' ), replay=True)
+
+    # Create and train the model
+    model = distributed.wrap_model( DeepCNN().to( common.device ) )
+    model = train_deep_cnn( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+    model = distributed.unwrap_model( model )
+
+    # Evaluate the model's predictions against the ground truth
+    y_score_test, y_pred_test, y_test = eval_model( model, test_loader )
+    y_score_val,  y_pred_val,  y_val  = eval_model( model, val_loader  )
+
+    # Evaluate the scores' predictions against the ground truth
+    auc, acc, p, r, f = common.evaluate_predictions( y_test, y_pred_test, score=y_score_test )
+    common.print_scores( "test", acc, auc, p, r, f )   
+
+    auc, acc, p, r, f = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
+    common.print_scores( "val", acc, auc, p, r, f )
+
+    # Only rank 0 writes outputs when training is distributed
+    if not distributed.is_main_rank():
+        return
+
+    common.dump_outputs( y_pred_val, y_val, y_score_val, val_loader.dataset.img_labels.iloc[:, 0].values )
+
+    # Optionally export the trained model for the TorchScript/ONNX scoring backend
+    if common.EXPORT_DIR is not None:
+        export.export_model( model, 'deep_cnn', os.path.join( os.getenv('DATA_DIR'), common.EXPORT_DIR ) )
+
+    # Optionally compare int8 quantized inference against fp32 on CPU
+    if common.QUANTIZE_EVAL:
+        quantize.report_quantized( model, train_loader, val_loader )
+
+def eval_model( model, dataloader ):
+    """
+    :return:
+        Y_pred_test: prediction of model on the test dataloder.
+            Should be an 2D numpy float array where the second dimension has length 2.
+        Y_pred_val: prediction of model on the validation dataloder.
+            Should be an 2D numpy float array where the second dimension has length 2.
+        Y_test: truth labels for the test set. Should be an numpy array of ints
+        Y_val: truth labels for the val set. Should be an numpy array of ints
+    """
+    # Eval runs on each rank's shard without DDP, which would sync on every forward pass
+    model = distributed.unwrap_model( model )
+    model.eval()
+    
+    Y_score = torch.FloatTensor()
+    Y_pred  = []
+    Y_true  = []
+    
+    for data, target in dataloader:
+        data           = data.to( common.device )
+        outputs        = model( data )
+        _, predictions = torch.max( outputs, 1 )
+        predictions    = predictions.to( 'cpu' )
+        y_hat          = outputs[:,1]
+
+        Y_score = np.concatenate( (Y_score, y_hat.to('cpu').detach().numpy() ), axis=0 )
+        Y_pred.append( predictions )
+        Y_true.append( target      )
+
+    Y_pred = distributed.concatenate( Y_pred )
+    Y_true = distributed.concatenate( Y_true )
+
+    # Collect every rank's shard of the split when distributed
+    return distributed.gather_outputs( Y_score, Y_pred, Y_true )
+
+def train_deep_cnn( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learn_rate=1e-3 ):
+    """
+    :param model: A DeepCNN model
+    :param train_dataloader: the DataLoader of the training data
+    :param n_epoch: number of epochs to train
+    :return:
+        model: trained model
+    """
+    # Assign class weights and create 2-class criterion
+    class_weight_ratio = common.CLASS_WEIGHT_RATIO if common.FORCE_CLASS_WEIGHT else class_weight
+    
+    print( f"     Number epochs: {n_epoch}"    )  
+    print( f"     Learning rate: {learn_rate}" )   
+    print( f"Class weight ratio: {class_weight_ratio}" )
+    common.print_output_header()
+
+    weights       = common.correct_class_weights( [1.0/class_weight_ratio, 1.0-(1.0/class_weight_ratio) ], train_dataloader )
+    class_weights = torch.FloatTensor( weights ).to( common.device )
+    criterion     = torch.nn.modules.loss.CrossEntropyLoss( weight=class_weights )
+
+    # Same optimizer and default LR as StandardCNN
+    optimizer = torch.optim.RMSprop( model.parameters(), lr=learn_rate )
+
+    # Optionally continue from a previous run's checkpoint
+    checkpoint.warm_start( 'deep_cnn', model, optimizer )
+
+    # Stop once the val metric stops improving, see early_stopping.EarlyStopper
+    stopper = early_stopping.EarlyStopper( model, optimizer, n_epoch )
+
+    model.train() # prep model for training
+
+    train_start_time = time.time()
+    for epoch in range(n_epoch):
+
+        curr_epoch_loss  = []
+        epoch_start_time = time.time()
+        i                = 0
+        
+        for data, target in train_dataloader:
+            # Transfer tensors to GPU
+            data, target = data.to(common.device), target.to(common.device)
+
+            # zero the parameter gradients
+            optimizer.zero_grad()
+
+            # forward + backward + optimize
+            outputs = model( data )
+            loss    = criterion( outputs, target )
+            loss.backward()
+            optimizer.step()
+
+            curr_epoch_loss.append(loss.cpu().data.numpy())
+
+            # Print progress indicator
+            if (i % 10) == 0:
+                print('.', end='', flush=True)
+            i = i + 1
+
+        epoch_time      = time.time() - epoch_start_time
+        curr_epoch_loss = np.mean( curr_epoch_loss )
+
+        # Optionally make predictions and evaluate between every epoch.
+        # Adds a lot of time, but is worth it to get intermediate readouts when training epochs are very slow
+        if ( common.EVAL_EVERY_EPOCH ):
+            with torch.no_grad():
+                # Put model in eval mode temporarily
+                model.eval()
+
+                # Get entire dataloader
+                _, test_loader, val_loader = common.load_data(data_path=data_path)
+                # Evaluate the model's predictions against the ground truth
+                y_score_test, y_pred_test, y_test = eval_model( model, test_loader )
+                y_score_val,  y_pred_val,  y_val  = eval_model( model, val_loader  )
+
+                # Evaluate the scores' predictions against the ground truth
+                auc,  acc,  p,  r,  f  = common.evaluate_predictions( y_test, y_pred_test, score=y_score_test )
+                auc2, acc2, p2, r2, f2 = common.evaluate_predictions( y_val,  y_pred_val,  score=y_score_val  )
+
+                common.print_epoch_output( epoch+1, epoch_time, curr_epoch_loss, acc, auc, p, r, f, acc2, auc2, p2, r2, f2 )
+
+                # Stop early if we hit our target
+                if common.DO_EARLY_STOPPING and auc >= common.TARGET_AUC_DEEP_CNN:
+                    stopper.reached_target( epoch+1 )
+                    break
+
+                # Stop once val AUC or loss stops improving
+                val_loss = common.eval_loss( model, val_loader, criterion ) if stopper.needs_loss() else None
+                if stopper.step( epoch+1, auc2, val_loss ):
+                    break
+
+            # Put model back in training mode
+            model.train()
+
+    stopper.finish()
+
+    # Optionally save weights and optimizer state for warm starting later runs
+    checkpoint.save( 'deep_cnn', model, optimizer, data_path )
+
+    print("Training took {:.2f} sec".format( time.time() - train_start_time) )
+
+    return model
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR')
+    parser.add_argument('-n', '--n_epochs', type=int, nargs=1,
+                        help='Number of training epochs')
+    parser.add_argument('-w', '--class_weight', type=float, nargs=1,
+                        help='Class weight ratio to use for training')
+    parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
+                        help='Learning rate to use for training')
+    common.add_common_args(parser)
+    args = parser.parse_args()
+    common.apply_common_args(args)
+
+    cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+    n_epochs = common.N_EPOCH
+    if args.n_epochs is not None:
+        n_epochs = args.n_epochs[0]
+
+    main(cohort_path, n_epochs, args.class_weight[0], args.learning_rate[0])
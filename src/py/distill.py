@@ -0,0 +1,319 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+import time
+import argparse
+import common
+import early_stopping
+import export
+import cnn
+import rnn
+import rnn_gru
+import inceptionv3
+from torchvision import models
+
+# Student models: module holding eval_model, model class, optimizer, input preparation and target AUC for early stopping
+STUDENTS = {
+    'cnn':     ( cnn,     cnn.StandardCNN,     lambda p, lr: torch.optim.RMSprop( p, lr=lr ),                 None,                     common.TARGET_AUC_CNN ),
+    'rnn':     ( rnn,     rnn.StandardRNN,     lambda p, lr: torch.optim.Adam( p, lr=lr, weight_decay=1e-6 ), common.image_to_sequence, common.TARGET_AUC_RNN ),
+    'rnn_gru': ( rnn_gru, rnn_gru.StandardRNN, lambda p, lr: torch.optim.Adam( p, lr=lr, weight_decay=1e-6 ), common.image_to_sequence, common.TARGET_AUC_RNN ),
+}
+
+class SoftTargetDataset( torch.utils.data.Dataset ):
+    """
+    Pairs each sample of a dataset with the teacher's cached logits for it.
+    """
+    def __init__( self, dataset, soft_targets ):
+        assert len( dataset ) == len( soft_targets )
+        self.dataset      = dataset
+        self.soft_targets = torch.from_numpy( soft_targets ).float()
+
+    def __len__( self ):
+        return len( self.dataset )
+
+    def __getitem__( self, idx ):
+        image, label = self.dataset[idx]
+        return image, label, self.soft_targets[idx]
+
+def get_soft_target_path( data_path: str, teacher_path: str ):
+    """
+    Cache file for a teacher's logits over the train split. The name covers the teacher
+    file's identity and the input layout, so retrained teachers or other channels miss.
+    """
+    stat   = os.stat( teacher_path )
+    hasher = hashlib.sha256()
+    hasher.update( repr( (
+        os.path.abspath( teacher_path ),
+        stat.st_size,
+        stat.st_mtime_ns,
+        [ c.name for c in common.IMG_CHANNELS ],
+        common.N_HOURS,
+        common.HOURS_PER_COL,
+    ) ).encode() )
+    return os.path.join( data_path, 'train', f'soft_targets_{hasher.hexdigest()[:16]}.npy' )
+
+def run_teacher( run, train_loader ):
+    """
+    Runs the teacher over the train split once, in loader order. Returns [n_train, 2] logits.
+    """
+    logits = []
+    i      = 0
+    for data, _ in train_loader:
+        logits.append( run( data ) )
+
+        # Print progress indicator
+        if (i % 100) == 0:
+            print('.', end='', flush=True)
+        i = i + 1
+    print()
+
+    return np.concatenate( logits, axis=0 ).astype( np.float32 )
+
+def get_soft_targets( data_path: str, train_loader, teacher_path=None, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
+    """
+    Returns the teacher's logits for every train sample.
+    With teacher_path, an Inception3 exported by export.py is run and its logits are cached in the cohort.
+    Without it, an Inception3 teacher is trained here first.
+    """
+    teacher_start_time = time.time()
+
+    if teacher_path is not None:
+        # Soft targets are matched to the student's images, so the teacher must have seen the same layout
+        metadata = export.read_metadata( teacher_path )
+        if tuple( metadata['input_shape'] ) != common.get_input_shape() or metadata['channels'] != [ c.name for c in common.IMG_CHANNELS ]:
+            raise ValueError( f"Teacher {os.path.basename(teacher_path)} expects {metadata['channels']} {metadata['input_shape']} inputs, "
+                              f"rerun with matching --channels/--horizon/--resolution" )
+        print( f"           Teacher: {os.path.basename(teacher_path)}" )
+
+        cache_path = get_soft_target_path( data_path, teacher_path )
+        if os.path.exists( cache_path ):
+            soft_targets = np.load( cache_path )
+            if len( soft_targets ) == len( train_loader.dataset ):
+                print( f"Loaded cached soft targets from {os.path.basename(cache_path)}" )
+                return soft_targets
+
+        soft_targets = run_teacher( export.load_backend( teacher_path ), train_loader )
+        np.save( cache_path, soft_targets )
+    else:
+        print( "           Teacher: Inception3, trained from scratch" )
+
+        # Same small batches as inceptionv3.main, in the same order as train_loader. The student's tuned batch size doesn't apply
+        teacher_loader, _, _ = common.load_data( batch_size=16, data_path=data_path, replay=True, tuned=False )
+
+        teacher = models.Inception3( num_classes=2 ).to( common.device )
+        teacher = inceptionv3.train_inceptionv3( teacher, teacher_loader, data_path, n_epoch, class_weight, learning_rate )
+        teacher.eval()
+
+        def run( data ):
+            with torch.no_grad():
+                return teacher( inceptionv3.to_inception_input( data ).to( common.device ) ).cpu().numpy()
+
+        soft_targets = run_teacher( run, teacher_loader )
+
+    print( "Computing soft targets took {:.2f} sec".format( time.time() - teacher_start_time ) )
+
+    return soft_targets
+
+def distillation_loss( outputs, target, teacher_logits, criterion, temperature=None, alpha=None ):
+    """
+    alpha * T^2 * KL( teacher || student ) at temperature T plus ( 1 - alpha ) * the usual hard label loss.
+    Students output softmax probabilities, and log( softmax( z ) ) only differs from z by a per-sample
+    constant, so dividing the log probabilities by T gives the student's tempered distribution.
+    Temperature and alpha default to common.DISTILL_TEMPERATURE and common.DISTILL_ALPHA.
+    """
+    temperature = common.DISTILL_TEMPERATURE if temperature is None else temperature
+    alpha       = common.DISTILL_ALPHA       if alpha       is None else alpha
+
+    student_log_probs = F.log_softmax( torch.log( outputs.clamp_min( 1e-12 ) ) / temperature, dim=1 )
+    teacher_probs     = F.softmax( teacher_logits / temperature, dim=1 )
+
+    soft_loss = F.kl_div( student_log_probs, teacher_probs, reduction='batchmean' ) * temperature * temperature
+    hard_loss = criterion( outputs, target )
+
+    return alpha * soft_loss + ( 1.0 - alpha ) * hard_loss
+
+def train_student( student, model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learn_rate=1e-3 ):
+    """
+    :param student: key of STUDENTS
+    :param model: the student model
+    :param train_dataloader: DataLoader over a SoftTargetDataset of the training data
+    :param n_epoch: number of epochs to train
+    :return:
+        model: trained model
+    """
+    module, _, make_optimizer, prepare_input, target_auc = STUDENTS[student]
+
+    # Assign class weights and create 2-class criterion
+    class_weight_ratio = common.CLASS_WEIGHT_RATIO if common.FORCE_CLASS_WEIGHT else class_weight
+    weights            = [1.0 / class_weight_ratio, 1.0 - (1.0 / class_weight_ratio) ]
+    class_weights      = torch.FloatTensor( weights ).to( common.device )
+    criterion          = torch.nn.modules.loss.CrossEntropyLoss( weight=class_weights )
+    print( f"     Number epochs: {n_epoch}"    )
+    print( f"     Learning rate: {learn_rate}" )
+    print( f"Class weight ratio: {class_weight_ratio}" )
+    print( f"       Temperature: {common.DISTILL_TEMPERATURE}" )
+    print( f"   Soft loss alpha: {common.DISTILL_ALPHA}" )
+    common.print_output_header()
+
+    optimizer = make_optimizer( model.parameters(), learn_rate )
+
+    # Stop once the val metric stops improving, see early_stopping.EarlyStopper
+    stopper = early_stopping.EarlyStopper( model, optimizer, n_epoch )
+
+    model.train() # prep model for training
+
+    train_start_time = time.time()
+
+    for epoch in range(n_epoch):
+
+        curr_epoch_loss  = []
+        epoch_start_time = time.time()
+        i                = 0
+
+        for data, target, teacher_logits in train_dataloader:
+            # Transfer tensors to GPU
+            data, target, teacher_logits = data.to( common.device ), target.to( common.device ), teacher_logits.to( common.device )
+            if prepare_input is not None:
+                data = prepare_input( data )
+
+            # zero the parameter gradients
+            optimizer.zero_grad()
+
+            # forward + backward + optimize
+            outputs = model( data )
+            loss    = distillation_loss( outputs, target, teacher_logits, criterion )
+            loss.backward()
+            optimizer.step()
+
+            curr_epoch_loss.append( loss.cpu().data.numpy() )
+
+            # Print progress indicator
+            if (i % 10) == 0:
+                print('.', end='', flush=True)
+            i = i + 1
+
+        epoch_time      = time.time() - epoch_start_time
+        curr_epoch_loss = np.mean( curr_epoch_loss )
+
+        # Optionally make predictions and evaluate between every epoch.
+        if ( common.EVAL_EVERY_EPOCH ):
+            with torch.no_grad():
+                # Put model in eval mode temporarily
+                model.eval()
+
+                # Get entire dataloader
+                _, test_loader, val_loader = common.load_data(data_path=data_path)
+                # Evaluate the model's predictions against the ground truth
+                y_score_test, y_pred_test, y_test = module.eval_model( model, test_loader )
+                y_score_val,  y_pred_val,  y_val  = module.eval_model( model, val_loader  )
+
+                # Evaluate the scores' predictions against the ground truth
+                auc,  acc,  p,  r,  f  = common.evaluate_predictions( y_test, y_pred_test, score=y_score_test )
+                auc2, acc2, p2, r2, f2 = common.evaluate_predictions( y_val,  y_pred_val,  score=y_score_val  )
+
+                common.print_epoch_output( epoch+1, epoch_time, curr_epoch_loss, acc, auc, p, r, f, acc2, auc2, p2, r2, f2 )
+
+                # Stop early if we hit our target
+                if common.DO_EARLY_STOPPING and auc >= target_auc:
+                    stopper.reached_target( epoch+1 )
+                    break
+
+                # Stop once val AUC or loss stops improving
+                val_loss = common.eval_loss( model, val_loader, criterion, prepare_input ) if stopper.needs_loss() else None
+                if stopper.step( epoch+1, auc2, val_loss ):
+                    break
+
+            # Put model back in training mode
+            model.train()
+
+    stopper.finish()
+
+    print( "Training took {:.2f} sec".format( time.time() - train_start_time ) )
+
+    return model
+
+def main( data_path, student='cnn', teacher_path=None, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
+    """
+    Main function.
+    Gets the teacher's soft targets for the train split, trains the student against
+    them and the labels, and evaluates the student against test set and val set.
+    """
+    print( f"\nDistilling into {student} on CUDA device: {common.device}" )
+    print( f"            Cohort: {os.path.basename(data_path)}")
+
+    module, model_class, _, prepare_input, _ = STUDENTS[student]
+
+    # Use the student's batch size, thread and loader settings tuned for this machine, if any
+    common.apply_tuned_config( student )
+
+    # Load images and labels for each split
+    train_loader, test_loader, val_loader = common.load_data(data_path=data_path, replay=True)
+
+    # Run the teacher over the train split once
+    soft_targets = get_soft_targets( data_path, train_loader, teacher_path, n_epoch, class_weight )
+    distill_loader = torch.utils.data.DataLoader( SoftTargetDataset( train_loader.dataset, soft_targets ), batch_size=train_loader.batch_size, shuffle=False )
+
+    # Create and train the student
+    model = model_class().to( common.device )
+    model = train_student( student, model, distill_loader, data_path, n_epoch, class_weight, learning_rate )
+
+    # Evaluate the model's predictions against the ground truth
+    y_score_test, y_pred_test, y_test = module.eval_model( model, test_loader )
+    y_score_val,  y_pred_val,  y_val  = module.eval_model( model, val_loader  )
+
+    # Evaluate the scores' predictions against the ground truth
+    auc, acc, p, r, f = common.evaluate_predictions( y_test, y_pred_test, score=y_score_test )
+    common.print_scores( "test", acc, auc, p, r, f )
+
+    auc, acc, p, r, f = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
+    common.print_scores( "val", acc, auc, p, r, f )
+
+    common.dump_outputs( y_pred_val, y_val, y_score_val, val_loader.dataset.img_labels.iloc[:, 0].values )
+
+    # Optionally export the trained student for the TorchScript/ONNX scoring backend
+    if common.EXPORT_DIR is not None:
+        export.export_model( model, f'{student}_distilled', os.path.join( os.getenv('DATA_DIR'), common.EXPORT_DIR ), prepare_input=prepare_input )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR')
+    parser.add_argument('-s', '--student', type=str, default='cnn', choices=list(STUDENTS),
+                        help='Student model to distill into')
+    parser.add_argument('-t', '--teacher', type=str, nargs=1,
+                        help='Inception3 exported with --export, relative to DATA_DIR. Trains a teacher first if omitted')
+    parser.add_argument('-n', '--n_epochs', type=int, nargs=1,
+                        help='Number of training epochs')
+    parser.add_argument('-w', '--class_weight', type=float, nargs=1,
+                        help='Class weight ratio to use for training')
+    parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
+                        help='Learning rate to use for training the student')
+    parser.add_argument('-T', '--temperature', type=float, nargs=1,
+                        help='Softmax temperature applied to teacher and student')
+    parser.add_argument('-a', '--alpha', type=float, nargs=1,
+                        help='Weight of the soft target loss, the hard label loss gets 1 - alpha')
+    common.add_common_args(parser)
+    args = parser.parse_args()
+    common.apply_common_args(args)
+
+    cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+    teacher_path = None
+    if args.teacher is not None:
+        teacher_path = os.path.join(os.getenv('DATA_DIR'), args.teacher[0])
+
+    n_epochs = common.N_EPOCH
+    if args.n_epochs is not None:
+        n_epochs = args.n_epochs[0]
+
+    if args.temperature is not None:
+        common.DISTILL_TEMPERATURE = args.temperature[0]
+    if args.alpha is not None:
+        common.DISTILL_ALPHA = args.alpha[0]
+
+    main(cohort_path, args.student, teacher_path, n_epochs, args.class_weight[0], args.learning_rate[0])
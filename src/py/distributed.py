@@ -0,0 +1,108 @@
+import os
+import sys
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+BACKEND = 'gloo'
+
+class ShardSampler( torch.utils.data.Sampler ):
+    """
+    Gives each rank one contiguous block of the dataset, without the padding DistributedSampler adds.
+    Gathering per-rank outputs in rank order then reproduces the dataset's order exactly,
+    so eval metrics and dumped outputs match a single process run.
+    """
+    def __init__( self, dataset, rank=None, world_size=None ):
+        rank       = get_rank() if rank is None else rank
+        world_size = get_world_size() if world_size is None else world_size
+        self.indices = np.array_split( np.arange( len( dataset ) ), world_size )[rank].tolist()
+
+    def __iter__( self ):
+        return iter( self.indices )
+
+    def __len__( self ):
+        return len( self.indices )
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_rank():
+    return get_rank() == 0
+
+def init():
+    """
+    Joins the process group described by the environment torchrun sets up
+    (RANK, WORLD_SIZE, LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT).
+    Splits the machine's cores between local ranks and silences stdout on all but rank 0.
+    """
+    if is_distributed():
+        return
+
+    dist.init_process_group( backend=BACKEND )
+
+    # Ranks on one box share its cores rather than each spawning a thread per core
+    local_world_size = int( os.getenv( 'LOCAL_WORLD_SIZE', get_world_size() ) )
+    torch.set_num_threads( max( 1, os.cpu_count() // local_world_size ) )
+
+    if not is_main_rank():
+        sys.stdout = open( os.devnull, 'w' )
+
+    print( f"Distributed training on {get_world_size()} ranks with {torch.get_num_threads()} threads each" )
+
+def get_train_sampler( dataset ):
+    """
+    Shards the train split across ranks. Padded so every rank takes the same number of steps,
+    as each step all-reduces gradients. Returns None when not distributed.
+    """
+    if not is_distributed():
+        return None
+    return torch.utils.data.distributed.DistributedSampler( dataset, shuffle=False )
+
+def get_eval_sampler( dataset ):
+    """
+    Shards an eval split across ranks. Returns None when not distributed.
+    """
+    if not is_distributed():
+        return None
+    return ShardSampler( dataset )
+
+def wrap_model( model, find_unused_parameters=False ):
+    """
+    Wraps model so gradients are all-reduced across ranks on every backward pass.
+    Returns model unchanged when not distributed.
+    """
+    if not is_distributed():
+        return model
+    return DistributedDataParallel( model, find_unused_parameters=find_unused_parameters )
+
+def unwrap_model( model ):
+    return model.module if isinstance( model, DistributedDataParallel ) else model
+
+def concatenate( arrays, dtype=np.int64 ):
+    """
+    Concatenates a rank's per batch eval outputs. A split with fewer visits than ranks leaves some
+    ranks an empty shard, which gives an empty array of dtype rather than failing.
+    """
+    if len( arrays ) == 0:
+        return np.zeros( 0, dtype=dtype )
+    return np.concatenate( arrays, axis=0 )
+
+def gather_outputs( *arrays ):
+    """
+    Concatenates each rank's shard of eval outputs in rank order, so every rank
+    ends up with the outputs for the whole split. Returns arrays unchanged when not distributed.
+    """
+    if not is_distributed():
+        return arrays
+
+    gathered = [ None ] * get_world_size()
+    dist.all_gather_object( gathered, [ np.asarray( a ) for a in arrays ] )
+
+    return tuple( np.concatenate( [ g[i] for g in gathered ], axis=0 ) for i in range( len( arrays ) ) )
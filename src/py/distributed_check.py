@@ -0,0 +1,126 @@
+import os
+import socket
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import common
+import distributed
+import cnn
+
+# Visits in the toy train split, split evenly between ranks so each step's all-reduced gradient matches a single full batch
+N_TRAIN_VISITS = 8
+
+# Visits in each toy eval split. One is smaller than any world size above 1, so some ranks get an empty shard
+N_EVAL_VISITS = [ 7, 1 ]
+
+class ToyDataset( torch.utils.data.Dataset ):
+    """
+    Random images and labels of the current input shape, the same in every process for a given seed.
+    """
+    def __init__( self, n_visits, seed ):
+        generator    = torch.Generator().manual_seed( seed )
+        self.data    = torch.rand( ( n_visits, ) + tuple( common.get_input_shape() ), generator=generator )
+        self.targets = torch.randint( 0, 2, ( n_visits, ), generator=generator )
+
+    def __len__( self ):
+        return len( self.targets )
+
+    def __getitem__( self, idx ):
+        return self.data[idx], self.targets[idx]
+
+def run_toy( world_size ):
+    """
+    Takes one training step of a StandardCNN on the toy train split, then evaluates it on each toy eval split.
+    Returns the trained parameters and the gathered ( Y_score, Y_pred, Y_true ) of each eval split.
+    Dropout is off, so the model is the same function on every rank and in a single process.
+    """
+    common.device = torch.device( "cpu" )
+
+    torch.manual_seed( 0 )
+    model = distributed.wrap_model( cnn.StandardCNN() )
+    model.eval()
+
+    train = ToyDataset( N_TRAIN_VISITS, 0 )
+    train_loader = torch.utils.data.DataLoader( train, batch_size=N_TRAIN_VISITS // world_size, sampler=distributed.get_train_sampler( train ) )
+
+    optimizer = torch.optim.SGD( model.parameters(), lr=0.1 )
+    for data, target in train_loader:
+        optimizer.zero_grad()
+        F.nll_loss( torch.log( model( data ) ), target ).backward()
+        optimizer.step()
+
+    params = torch.cat( [ p.detach().flatten() for p in distributed.unwrap_model( model ).parameters() ] ).numpy()
+
+    outputs = list()
+    for i, n_visits in enumerate( N_EVAL_VISITS ):
+        split = ToyDataset( n_visits, i + 1 )
+        loader = torch.utils.data.DataLoader( split, batch_size=4, sampler=distributed.get_eval_sampler( split ) )
+        outputs.append( cnn.eval_model( model, loader ) )
+
+    return params, outputs
+
+def check_outputs( actual, expected ):
+    """
+    Raises ValueError if a distributed run's parameters or gathered eval outputs differ from the single process run's.
+    """
+    params, outputs = actual
+    expected_params, expected_outputs = expected
+
+    if not np.allclose( params, expected_params, atol=1e-6 ):
+        raise ValueError( "Parameters after a distributed training step differ from a single process step, max diff {:.2e}".format(
+            np.max( np.abs( params - expected_params ) ) ) )
+
+    for n_visits, split, expected_split in zip( N_EVAL_VISITS, outputs, expected_outputs ):
+        Y_score, Y_pred, Y_true = split
+        if len( Y_true ) != n_visits or not np.allclose( Y_score, expected_split[0], atol=1e-6 ) \
+                or not np.array_equal( Y_pred, expected_split[1] ) or not np.array_equal( Y_true, expected_split[2] ):
+            raise ValueError( f"Gathered eval outputs of the {n_visits} visit split differ from a single process run" )
+
+def run_rank( rank, world_size, port, expected ):
+    """
+    Joins a local gloo process group as rank, the way torchrun would set it up, and checks its results against expected.
+    """
+    os.environ.update( {
+        'MASTER_ADDR': '127.0.0.1',
+        'MASTER_PORT': str( port ),
+        'RANK': str( rank ),
+        'WORLD_SIZE': str( world_size ),
+        'LOCAL_WORLD_SIZE': str( world_size ),
+    } )
+    distributed.init()
+
+    try:
+        check_outputs( run_toy( world_size ), expected )
+        print( f"Rank outputs match a single process run on {world_size} ranks" )
+    finally:
+        dist.destroy_process_group()
+
+def get_free_port():
+    with socket.socket( socket.AF_INET, socket.SOCK_STREAM ) as s:
+        s.bind( ( '127.0.0.1', 0 ) )
+        return s.getsockname()[1]
+
+def check( world_size=2 ):
+    """
+    Smoke test of data parallel training: runs the toy cohort in a single process, then on world_size local CPU
+    ranks, and checks every rank ends up with the same parameters and gathered eval outputs.
+    """
+    if N_TRAIN_VISITS % world_size != 0:
+        raise ValueError( f"World size must divide the {N_TRAIN_VISITS} toy train visits" )
+
+    expected = run_toy( 1 )
+    mp.spawn( run_rank, args=( world_size, get_free_port(), expected ), nprocs=world_size, join=True )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--world_size', type=int, default=2,
+                        help='Number of local CPU ranks to spawn')
+    args = parser.parse_args()
+
+    check( args.world_size )
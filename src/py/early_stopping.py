@@ -0,0 +1,109 @@
+import time
+import torch
+import common
+
+class EarlyStopper:
+    """
+    Tracks a val metric across epochs for a model's train loop.
+    Stops training once it hasn't improved by more than common.EARLY_STOP_MIN_DELTA for
+    common.EARLY_STOP_PATIENCE epochs, and restores the best weights when training ends.
+    Optionally lowers the learning rate on plateaus, as in torch's ReduceLROnPlateau.
+    Patience of None keeps the previous behaviour of always training for n_epoch epochs.
+    """
+    def __init__( self, model, optimizer, n_epoch ):
+        self.model      = model
+        self.n_epoch    = n_epoch
+        self.monitor    = common.EARLY_STOP_MONITOR
+        self.patience   = common.EARLY_STOP_PATIENCE
+        self.min_delta  = common.EARLY_STOP_MIN_DELTA
+        self.mode       = 'max' if self.monitor == 'auc' else 'min'
+
+        self.best_value = None
+        self.best_epoch = 0
+        self.best_state = None
+        self.n_bad      = 0
+        self.epoch      = 0
+        self.stopped    = False
+        self.on_target  = False
+        self.start_time = time.time()
+
+        self.scheduler = None
+        if common.LR_PLATEAU_FACTOR is not None:
+            self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+                optimizer, mode=self.mode, factor=common.LR_PLATEAU_FACTOR, patience=common.LR_PLATEAU_PATIENCE, threshold=self.min_delta, threshold_mode='abs' )
+
+    def enabled( self ):
+        return self.patience is not None or self.scheduler is not None
+
+    def needs_loss( self ):
+        """
+        Whether step() needs the val loss, which costs an extra pass over the val split.
+        """
+        return self.enabled() and self.monitor == 'loss'
+
+    def improved( self, value ):
+        if self.best_value is None:
+            return True
+        if self.mode == 'max':
+            return value > self.best_value + self.min_delta
+        return value < self.best_value - self.min_delta
+
+    def step( self, epoch, val_auc, val_loss=None ):
+        """
+        Records the val metrics after an epoch. Returns True when training should stop.
+        """
+        self.epoch = epoch
+        if not self.enabled():
+            return False
+
+        value = val_auc if self.monitor == 'auc' else val_loss
+
+        if self.scheduler is not None:
+            self.scheduler.step( value )
+
+        if self.improved( value ):
+            self.best_value = value
+            self.best_epoch = epoch
+            self.best_state = { k: v.detach().to( 'cpu', copy=True ) for k, v in self.model.state_dict().items() }
+            self.n_bad      = 0
+        else:
+            self.n_bad = self.n_bad + 1
+
+        self.stopped = self.patience is not None and self.n_bad >= self.patience
+        return self.stopped
+
+    def reached_target( self, epoch ):
+        """
+        Records that training stopped after epoch on reaching its target AUC, so finish() keeps that epoch's weights.
+        """
+        self.epoch      = epoch
+        self.best_epoch = epoch
+        self.on_target  = True
+
+    def finish( self ):
+        """
+        Restores the best weights seen, unless training stopped on its target AUC, and reports how much training early stopping saved.
+        Returns a dict with the best epoch, epochs run, and epochs and estimated seconds saved.
+        """
+        summary = { 'best_epoch': self.best_epoch, 'epochs_run': self.epoch, 'epochs_saved': 0, 'seconds_saved': 0.0 }
+
+        if self.on_target:
+            print( f"Stopped on target AUC after epoch {self.epoch} of {self.n_epoch}, keeping its weights" )
+            return summary
+
+        if self.patience is None or self.best_state is None:
+            return summary
+
+        self.model.load_state_dict( self.best_state )
+
+        # Estimate the time of the skipped epochs from the average of the ones that ran, including eval
+        epoch_seconds = ( time.time() - self.start_time ) / max( self.epoch, 1 )
+        summary['epochs_saved']  = self.n_epoch - self.epoch
+        summary['seconds_saved'] = summary['epochs_saved'] * epoch_seconds
+
+        if self.stopped:
+            print( f"Early stopped after epoch {self.epoch} of {self.n_epoch}, no val {self.monitor} improvement in {self.patience} epochs" )
+        print( "Restored weights from epoch {} (val {} {:.6f})".format( self.best_epoch, self.monitor, self.best_value ) )
+        print( "Saved {} epochs, ~{:.2f} sec".format( summary['epochs_saved'], summary['seconds_saved'] ) )
+
+        return summary
@@ -0,0 +1,201 @@
+import os
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import common
+
+TORCHSCRIPT_EXT = '.pt'
+ONNX_EXT        = '.onnx'
+METADATA_EXT    = '.json'
+
+ONNX_OPSET = 17
+
+class ExportWrapper( nn.Module ):
+    """
+    Folds a model's input preparation, e.g. common.image_to_sequence for the RNNs,
+    into the exported graph so every export takes [batch, channels, N_ROWS, N_COLS] images.
+    """
+    def __init__( self, model, prepare_input=None ):
+        super( ExportWrapper, self ).__init__()
+        self.model         = model
+        self.prepare_input = prepare_input
+
+    def forward( self, x ):
+        if self.prepare_input is not None:
+            x = self.prepare_input( x )
+        return self.model( x )
+
+def get_export_path( export_dir: str, name: str, ext: str ):
+    return os.path.join( export_dir, name + ext )
+
+def save_metadata( export_dir: str, name: str ):
+    """
+    Records the input layout the model was trained on, so scoring loads matching images.
+    """
+    metadata = {
+        'input_shape':   list( common.get_input_shape() ),
+        'channels':      [ c.name for c in common.IMG_CHANNELS ],
+        'n_hours':       common.N_HOURS,
+        'hours_per_col': common.HOURS_PER_COL,
+    }
+    with open( get_export_path( export_dir, name, METADATA_EXT ), 'w' ) as f:
+        json.dump( metadata, f, indent=1 )
+
+def read_metadata( model_path: str ):
+    with open( os.path.splitext( model_path )[0] + METADATA_EXT, 'r' ) as f:
+        return json.load( f )
+
+def load_metadata( model_path: str ):
+    """
+    Applies the metadata saved next to an exported model to the globals in common.
+    """
+    metadata = read_metadata( model_path )
+
+    common.IMG_CHANNELS = [ common.Img_channel[name] for name in metadata['channels'] ]
+    common.set_timeline( metadata['n_hours'], metadata['hours_per_col'] )
+
+    return metadata
+
+def has_onnxruntime():
+    try:
+        import onnxruntime
+        return True
+    except ImportError:
+        return False
+
+def load_backend( model_path: str ):
+    """
+    Loads an exported model and returns a function mapping a batch of images to a numpy array of outputs.
+    .pt files run on the TorchScript runtime and .onnx files on onnxruntime.
+    """
+    if model_path.endswith( ONNX_EXT ):
+        import onnxruntime
+        session    = onnxruntime.InferenceSession( model_path, providers=[ 'CPUExecutionProvider' ] )
+        input_name = session.get_inputs()[0].name
+        return lambda data: session.run( None, { input_name: data.numpy() } )[0]
+
+    module = torch.jit.load( model_path, map_location='cpu' )
+    module.eval()
+
+    def run( data ):
+        with torch.no_grad():
+            return module( data ).numpy()
+
+    return run
+
+def export_model( model, name: str, export_dir: str, prepare_input=None, batch_size=4 ):
+    """
+    Writes model to <export_dir>/<name>.pt as TorchScript and <export_dir>/<name>.onnx as ONNX,
+    both with a fixed [channels, N_ROWS, N_COLS] input and a dynamic batch dimension.
+    Each export is loaded back and checked against the eager model on a random batch.
+    Returns the max abs difference from eager for each written file.
+    """
+    os.makedirs( export_dir, exist_ok=True )
+
+    wrapper = ExportWrapper( copy.deepcopy( model ).to( 'cpu' ).eval(), prepare_input ).eval()
+    example = torch.rand( ( batch_size, ) + common.get_input_shape() )
+
+    written = dict()
+
+    # TorchScript
+    ts_path = get_export_path( export_dir, name, TORCHSCRIPT_EXT )
+    with torch.no_grad():
+        traced = torch.jit.trace( wrapper, example )
+    traced = torch.jit.freeze( traced )
+    torch.jit.save( traced, ts_path )
+    written[ts_path] = None
+
+    # ONNX, which not every op used by the models may support
+    onnx_path = get_export_path( export_dir, name, ONNX_EXT )
+    try:
+        torch.onnx.export( wrapper, example, onnx_path,
+                           input_names=[ 'image' ], output_names=[ 'output' ],
+                           dynamic_axes={ 'image': { 0: 'batch' }, 'output': { 0: 'batch' } },
+                           opset_version=ONNX_OPSET )
+        written[onnx_path] = None
+    except Exception as e:
+        print( f"ONNX export of {name} failed: {e}" )
+
+    save_metadata( export_dir, name )
+
+    # Parity against eager, on a different batch size than the one traced with
+    check = torch.rand( ( batch_size + 1, ) + common.get_input_shape() )
+    with torch.no_grad():
+        expected = wrapper( check ).numpy()
+
+    for path in written:
+        if path.endswith( ONNX_EXT ) and not has_onnxruntime():
+            print( f"Exported {path} (onnxruntime not installed, parity not checked)" )
+            continue
+
+        written[path] = float( np.max( np.abs( load_backend( path )( check ) - expected ) ) )
+        print( "Exported %s (max abs diff from eager: %.3e)" % ( path, written[path] ) )
+
+    return written
+
+def score( model_path: str, data_path: str, split: str = 'val', batch_size: int = None ):
+    """
+    Scores a split of a shuffled cohort with an exported model, printing metrics and latency.
+    """
+    load_metadata( model_path )
+    run = load_backend( model_path )
+
+    # Exports are named after their model, so scoring settings tuned for that model apply.
+    # An explicit batch_size takes precedence over the tuned one
+    common.apply_tuned_config( os.path.splitext( os.path.basename( model_path ) )[0], 'score' )
+    if batch_size is not None:
+        common.TUNED_BATCH_SIZE = batch_size
+
+    train_loader, test_loader, val_loader = common.load_data( data_path=data_path )
+    loader = { 'train': train_loader, 'test': test_loader, 'val': val_loader }[split]
+
+    Y_score   = []
+    Y_pred    = []
+    Y_true    = []
+    latencies = []
+
+    for data, target in loader:
+        start_time = time.perf_counter()
+        outputs    = run( data )
+        latencies.append( time.perf_counter() - start_time )
+
+        Y_score.append( outputs[:,1] )
+        Y_pred.append( np.argmax( outputs, axis=1 ) )
+        Y_true.append( target.numpy() )
+
+    Y_score = np.concatenate( Y_score )
+    Y_pred  = np.concatenate( Y_pred  )
+    Y_true  = np.concatenate( Y_true  )
+
+    print( f"\nScored {split} split of {os.path.basename(data_path)} with {os.path.basename(model_path)}" )
+    print( "Batch latency ms p50: %.3f p95: %.3f, %.1f visits/sec" % (
+        np.percentile( latencies, 50 ) * 1000, np.percentile( latencies, 95 ) * 1000, len( Y_true ) / np.sum( latencies ) ) )
+
+    auc, acc, p, r, f = common.evaluate_predictions( Y_true, Y_pred, score=Y_score )
+    common.print_scores( split, acc, auc, p, r, f )
+
+    common.dump_outputs( Y_pred, Y_true, Y_score, loader.dataset.img_labels.iloc[:, 0].values )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str,
+                        help='Exported .pt or .onnx model, relative to DATA_DIR')
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR')
+    parser.add_argument('-s', '--split', type=str, default='val', choices=['train', 'test', 'val'],
+                        help='Which split to score')
+    parser.add_argument('-b', '--batch_size', type=int,
+                        help='Scoring batch size. Defaults to the autotuned one, or 128')
+    args = parser.parse_args()
+
+    model_path  = os.path.join(os.getenv('DATA_DIR'), args.model)
+    cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+    score(model_path, cohort_path, args.split, args.batch_size)
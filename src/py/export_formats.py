@@ -0,0 +1,227 @@
+import os
+import gzip
+import time
+import queue
+import argparse
+import threading
+from csv import reader
+import common
+
+# Extensions of the export formats the ingest reads, besides plain .csv
+GZIP_EXTS    = [ '.gz' ]
+ZSTD_EXTS    = [ '.zst', '.zstd' ]
+PARQUET_EXTS = [ '.parquet' ]
+ARROW_EXTS   = [ '.arrow', '.feather' ]
+
+# Compressed csvs are decompressed on a background thread, READ_CHUNK_BYTES at a time,
+# with up to READ_QUEUE_CHUNKS decompressed chunks waiting to be parsed
+READ_CHUNK_BYTES  = 4 * 1024**2
+READ_QUEUE_CHUNKS = 8
+
+# Rows per row group when converting a csv to Parquet
+PARQUET_ROW_GROUP_ROWS = 1000000
+
+# Column names of the export, in Input_event_col order, as written by export_patient_data.sql
+COLUMN_NAMES = [ col.name.lower() for col in common.Input_event_col if col != common.Input_event_col.N_COLS ]
+
+def get_extension( path: str ):
+    return os.path.splitext( path )[1].lower()
+
+def is_plain_csv( path: str ):
+    """
+    Whether path is an uncompressed csv, the only format that supports byte offsets for the cohort cache and csv_index.
+    """
+    return get_extension( path ) not in GZIP_EXTS + ZSTD_EXTS + PARQUET_EXTS + ARROW_EXTS
+
+def open_compressed( path: str ):
+    """
+    Opens a gzip or zstd compressed file for streaming reads of its decompressed bytes.
+    """
+    if get_extension( path ) in GZIP_EXTS:
+        return gzip.open( path, 'rb' )
+
+    # zstandard is only needed for .zst exports
+    import zstandard
+    f = open( path, 'rb' )
+    return zstandard.ZstdDecompressor().stream_reader( f, closefd=True )
+
+def iter_decompressed_lines( path: str ):
+    """
+    Yields the decoded lines of a compressed file. Decompression runs on a background thread,
+    which both zlib and zstandard release the GIL for, so it overlaps with parsing the lines.
+    """
+    chunks = queue.Queue( maxsize=READ_QUEUE_CHUNKS )
+    stop   = threading.Event()
+
+    def put( item ):
+        # Give up if the consumer stopped reading, rather than blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                chunks.put( item, timeout=0.1 )
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def decompress():
+        try:
+            with open_compressed( path ) as f:
+                while True:
+                    chunk = f.read( READ_CHUNK_BYTES )
+                    if not chunk or not put( chunk ):
+                        break
+            put( None )
+        except Exception as e:
+            put( e )
+
+    thread = threading.Thread( target=decompress, daemon=True )
+    thread.start()
+
+    try:
+        tail = b''
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance( chunk, Exception ):
+                raise chunk
+
+            lines = ( tail + chunk ).split( b'\n' )
+            tail  = lines.pop()
+            for line in lines:
+                yield line.decode() + '\n'
+
+        if tail:
+            yield tail.decode()
+    finally:
+        stop.set()
+        thread.join()
+
+def iter_columnar_batches( path: str, first_patient_id: int = None, last_patient_id: int = None ):
+    """
+    Yields record batches of a Parquet or Arrow file in file order, projected onto the export's columns.
+    Parquet is read one row group at a time, skipping row groups whose patient_id statistics show they
+    hold no patient in [first_patient_id, last_patient_id]. Arrow files are memory mapped.
+    """
+    import pyarrow as pa
+
+    if get_extension( path ) in ARROW_EXTS:
+        with pa.memory_map( path, 'r' ) as source:
+            batches = pa.ipc.open_file( source )
+            for i in range( batches.num_record_batches ):
+                yield batches.get_batch( i ).select( COLUMN_NAMES )
+        return
+
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile( path )
+    patient_col = parquet.schema_arrow.get_field_index( COLUMN_NAMES[common.Input_event_col.PATIENT_ID] )
+
+    for i in range( parquet.num_row_groups ):
+        if first_patient_id is not None:
+            col_stats = parquet.metadata.row_group( i ).column( patient_col ).statistics
+            # Mapping rows come first and must always be read
+            if col_stats is not None and col_stats.has_min_max and col_stats.min != common.MAPPING_PATIENT_ID:
+                if col_stats.max < first_patient_id or col_stats.min > last_patient_id:
+                    continue
+
+        yield from parquet.read_row_group( i, columns=COLUMN_NAMES ).to_batches()
+
+def iter_rows( path: str, first_patient_id: int = None, last_patient_id: int = None ):
+    """
+    Yields the rows of an export in any supported format, as sequences in Input_event_col order.
+    Csv rows hold strings and columnar rows hold numbers, and cast_csv_row handles both.
+    Parquet row groups outside [first_patient_id, last_patient_id] are skipped, other formats
+    yield every row and leave filtering to the caller.
+    """
+    ext = get_extension( path )
+
+    if ext in PARQUET_EXTS + ARROW_EXTS:
+        for batch in iter_columnar_batches( path, first_patient_id, last_patient_id ):
+            yield from zip( *[ col.to_pylist() for col in batch.columns ] )
+        return
+
+    if ext in GZIP_EXTS + ZSTD_EXTS:
+        lines = iter_decompressed_lines( path )
+    else:
+        lines = open( path, 'r' )
+
+    try:
+        rows = reader( lines )
+
+        # Skip header row, we'll parse the columns ourselves
+        next( rows, None )
+
+        yield from rows
+    finally:
+        lines.close()
+
+def csv_to_parquet( csv_file: str, parquet_file: str, row_group_rows: int = PARQUET_ROW_GROUP_ROWS ):
+    """
+    Converts a csv export, optionally gzip or zstd compressed, to Parquet in one streaming pass.
+    Row order is kept, so row groups cover contiguous patient id ranges the ingest can skip.
+    """
+    import pyarrow as pa
+    import pyarrow.csv
+    import pyarrow.parquet as pq
+
+    int_cols    = [ common.Input_event_col.PATIENT_ID, common.Input_event_col.VISIT_ID, common.Input_event_col.EVENT_ID,
+                    common.Input_event_col.VAR_TYPE, common.Input_event_col.DIED ]
+    column_types = { name: ( pa.int64() if i in int_cols else pa.float64() ) for i, name in enumerate( COLUMN_NAMES ) }
+
+    # Name the columns ourselves, in case the header differs in case or quoting
+    batches = pyarrow.csv.open_csv(
+        csv_file,
+        read_options=pyarrow.csv.ReadOptions( column_names=COLUMN_NAMES, skip_rows=1 ),
+        convert_options=pyarrow.csv.ConvertOptions( column_types=column_types ),
+    )
+
+    print( f"Converting {csv_file} to {parquet_file}" )
+    start_time = time.time()
+
+    n_rows = 0
+    with pq.ParquetWriter( parquet_file + '.tmp', batches.schema, compression='zstd' ) as out:
+        pending = list()
+        n_pending = 0
+        for batch in batches:
+            pending.append( batch )
+            n_pending = n_pending + batch.num_rows
+
+            if n_pending >= row_group_rows:
+                out.write_table( pa.Table.from_batches( pending ), row_group_size=row_group_rows )
+                n_rows = n_rows + n_pending
+                pending.clear()
+                n_pending = 0
+
+        if n_pending > 0:
+            out.write_table( pa.Table.from_batches( pending ), row_group_size=row_group_rows )
+            n_rows = n_rows + n_pending
+
+    os.replace( parquet_file + '.tmp', parquet_file )
+
+    print( "Converted {} rows in {:.2f} sec, {:.1f} MB -> {:.1f} MB".format(
+        n_rows, time.time() - start_time, os.path.getsize( csv_file ) / 1024**2, os.path.getsize( parquet_file ) / 1024**2 ) )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_file', type=str,
+                        help='Exported patient data csv to convert, optionally .gz or .zst compressed, relative to DATA_DIR')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Parquet file to write, relative to DATA_DIR. Defaults to the csv name with a .parquet extension')
+    parser.add_argument('--row_group_rows', type=int, default=PARQUET_ROW_GROUP_ROWS,
+                        help='Rows per Parquet row group')
+    args = parser.parse_args()
+
+    csv_file = os.path.join( os.getenv('DATA_DIR'), args.csv_file )
+    if args.output is not None:
+        parquet_file = os.path.join( os.getenv('DATA_DIR'), args.output )
+    else:
+        parquet_file = csv_file
+        while not is_plain_csv( parquet_file ) or get_extension( parquet_file ) == '.csv':
+            parquet_file = os.path.splitext( parquet_file )[0]
+        parquet_file = parquet_file + PARQUET_EXTS[0]
+
+    csv_to_parquet( csv_file, parquet_file, args.row_group_rows )
@@ -0,0 +1,304 @@
+import os
+import time
+import random
+import argparse
+from csv import writer
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import common
+import csv_index
+import csv_to_images
+import export_formats
+
+# Items kept per level of each quantile sketch. Rank error is around 1 / STATS_SKETCH_CAPACITY
+STATS_SKETCH_CAPACITY = 512
+
+# Percentiles proposed as each continuous row's val_min and val_max, robust to the outliers in raw min and max
+STATS_LOW_PERCENTILE  = 1
+STATS_HIGH_PERCENTILE = 99
+
+# Percentiles reported for each itemid
+REPORT_PERCENTILES = [ 1, 5, 25, 50, 75, 95, 99 ]
+
+# Rows whose bounds are binary and shouldn't be replaced by percentiles
+BINARY_VAR_TYPES = [ common.Var_type.BINARY, common.Var_type.BINARY_POINT ]
+
+class QuantileSketch:
+    """
+    Mergeable approximate quantile sketch, a simplified KLL sketch. Level h holds values standing in for
+    2**h values each. Once a level fills up it's sorted and every other value, from a random offset,
+    is promoted to the next level, so memory stays logarithmic in the number of values added.
+    """
+    def __init__( self, capacity: int = STATS_SKETCH_CAPACITY, seed: int = 0 ):
+        self.capacity = capacity
+        self.levels   = [ [] ]
+        self.rng      = random.Random( seed )
+
+    def add( self, value: float ):
+        self.levels[0].append( value )
+        if len( self.levels[0] ) >= self.capacity:
+            self.compress()
+
+    def compress( self ):
+        # Promotions can fill the level above, so keep going up until every level fits
+        h = 0
+        while h < len( self.levels ):
+            if len( self.levels[h] ) < self.capacity:
+                h = h + 1
+                continue
+            if h + 1 == len( self.levels ):
+                self.levels.append( [] )
+
+            # An odd value out stays behind so the total weight is kept
+            values = sorted( self.levels[h] )
+            self.levels[h] = [ values.pop() ] if len( values ) % 2 == 1 else []
+            self.levels[h + 1].extend( values[self.rng.randint( 0, 1 )::2] )
+            h = h + 1
+
+    def merge( self, other ):
+        for h, values in enumerate( other.levels ):
+            if h == len( self.levels ):
+                self.levels.append( [] )
+            self.levels[h].extend( values )
+        self.compress()
+
+    def percentiles( self, percentiles ):
+        """
+        Approximate values at the given percentiles, in [0, 100]. NaN if nothing was added.
+        """
+        values  = np.concatenate( [ np.asarray( level, dtype=np.float64 ) for level in self.levels ] )
+        weights = np.concatenate( [ np.full( len( level ), 2.0**h ) for h, level in enumerate( self.levels ) ] )
+        if len( values ) == 0:
+            return np.full( len( percentiles ), np.nan )
+
+        order      = np.argsort( values, kind='stable' )
+        values     = values[order]
+        cumulative = np.cumsum( weights[order] )
+
+        ranks = np.asarray( percentiles, dtype=np.float64 ) / 100.0 * cumulative[-1]
+        return values[ np.clip( np.searchsorted( cumulative, ranks ), 0, len( values ) - 1 ) ]
+
+class ItemStats:
+    """
+    Streaming count, min, max, mean and variance (Welford) of one itemid's values, plus a quantile sketch.
+    Stats of separate shards merge into the stats of their union.
+    """
+    def __init__( self ):
+        self.count  = 0
+        self.min    = np.inf
+        self.max    = -np.inf
+        self.mean   = 0.0
+        self.m2     = 0.0
+        self.sketch = QuantileSketch()
+
+    def add( self, value: float ):
+        self.count = self.count + 1
+        self.min   = min( self.min, value )
+        self.max   = max( self.max, value )
+        delta      = value - self.mean
+        self.mean  = self.mean + delta / self.count
+        self.m2    = self.m2 + delta * ( value - self.mean )
+        self.sketch.add( value )
+
+    def merge( self, other ):
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+
+        self.mean  = self.mean + delta * other.count / count
+        self.m2    = self.m2 + other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min   = min( self.min, other.min )
+        self.max   = max( self.max, other.max )
+        self.sketch.merge( other.sketch )
+
+    def std( self ):
+        return np.sqrt( self.m2 / ( self.count - 1 ) ) if self.count > 1 else 0.0
+
+def accumulate( rows ):
+    """
+    Accumulates an ItemStats per itemid over the value of every non-mapping row in rows.
+    """
+    items = dict()
+    for row in rows:
+        if int( row[common.Input_event_col.PATIENT_ID] ) == common.MAPPING_PATIENT_ID:
+            continue
+
+        itemid = int( row[common.Input_event_col.EVENT_ID] )
+        if not itemid in items:
+            items[itemid] = ItemStats()
+        items[itemid].add( float( row[common.Input_event_col.VAL_NUM] ) )
+
+    return items
+
+def accumulate_range( csv_file: str, byte_range: tuple ):
+    """
+    Accumulates one byte range of a plain csv. Runs in a worker process.
+    """
+    return accumulate( csv_to_images.iter_csv_rows( csv_file, *byte_range ) )
+
+def merge_items( into: dict, items: dict ):
+    for itemid, item in items.items():
+        if itemid in into:
+            into[itemid].merge( item )
+        else:
+            into[itemid] = item
+    return into
+
+def scan( csv_file: str, n_workers: int = None ):
+    """
+    Accumulates per itemid stats over an export in one pass. Plain csvs are split into n_workers
+    patient aligned byte ranges with their index and scanned in parallel processes, then merged.
+    Other formats are scanned in a single stream.
+    """
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+
+    if not export_formats.is_plain_csv( csv_file ) or n_workers <= 1:
+        return accumulate( export_formats.iter_rows( csv_file ) )
+
+    ranges = csv_index.load_index( csv_file ).split( n_workers )
+    print( f"Scanning {len( ranges )} shards with {n_workers} workers" )
+
+    items = dict()
+    with ProcessPoolExecutor( max_workers=n_workers ) as executor:
+        for shard_items in executor.map( accumulate_range, [ csv_file ] * len( ranges ), ranges ):
+            merge_items( items, shard_items )
+
+    return items
+
+def read_item_ranges( csv_file: str ):
+    """
+    The ( val_min, val_max ) each itemid's mapping row gives. Itemids of a row in different units,
+    like temperature in C and F, have different ranges.
+    """
+    item_ranges = dict()
+    rows = export_formats.iter_rows( csv_file )
+    try:
+        for row in rows:
+            if int( row[common.Input_event_col.PATIENT_ID] ) != common.MAPPING_PATIENT_ID:
+                break
+            item_ranges[int( row[common.Input_event_col.EVENT_ID] )] = ( float( row[common.Input_event_col.VAL_MIN] ), float( row[common.Input_event_col.VAL_MAX] ) )
+    finally:
+        rows.close()
+
+    return item_ranges
+
+def get_mixed_rows( item2feature: dict, item_ranges: dict ):
+    """
+    Rows mapped from several itemids whose mapping ranges differ, which are taken to be in different units.
+    """
+    row_ranges = dict()
+    for itemid, row in item2feature.items():
+        row_ranges.setdefault( row, set() ).add( item_ranges.get( itemid ) )
+    return set( row for row, ranges in row_ranges.items() if len( ranges ) > 1 )
+
+def propose_stats( items: dict, item2feature: dict, stats: np.ndarray, mixed_rows: set = None ):
+    """
+    Returns a copy of stats with each continuous row's val_num set to the mean of its values and
+    val_min/val_max set to the STATS_LOW_PERCENTILE and STATS_HIGH_PERCENTILE percentiles, merging the
+    stats of every itemid mapped to the row. Binary rows, rows without values and mixed_rows, whose
+    itemids are in different units and would give bounds spanning both, are left as they are.
+    Also returns the merged ItemStats of each row.
+    """
+    mixed_rows = set() if mixed_rows is None else mixed_rows
+
+    rows = dict()
+    for itemid, item in items.items():
+        if not itemid in item2feature:
+            continue
+        row = item2feature[itemid]
+        if not row in rows:
+            rows[row] = ItemStats()
+        rows[row].merge( item )
+
+    proposed = stats.copy()
+    for row, item in rows.items():
+        if int( stats[row, common.Stats_col.VAR_TYPE] ) in BINARY_VAR_TYPES or item.count == 0 or row in mixed_rows:
+            continue
+
+        low, high = item.sketch.percentiles( [ STATS_LOW_PERCENTILE, STATS_HIGH_PERCENTILE ] )
+        proposed[row, common.Stats_col.VAL_NUM] = item.mean
+        proposed[row, common.Stats_col.VAL_MIN] = low
+        proposed[row, common.Stats_col.VAL_MAX] = high
+
+    return proposed, rows
+
+def print_multi_item_rows( items: dict, item2feature: dict, item_ranges: dict, mixed_rows: set ):
+    """
+    Prints each itemid's count and percentiles for every row mapped from several itemids, so their
+    proposed bounds can be checked before adopting them. Rows in mixed units are marked as skipped.
+    """
+    itemids = dict()
+    for itemid, row in item2feature.items():
+        itemids.setdefault( row, list() ).append( itemid )
+
+    for row in sorted( itemids ):
+        if len( itemids[row] ) < 2:
+            continue
+        print( f"Row {row}{' (mixed units, bounds not proposed)' if row in mixed_rows else ''}:" )
+        for itemid in sorted( itemids[row] ):
+            item = items.get( itemid, ItemStats() )
+            p1, p50, p99 = item.sketch.percentiles( [ 1, 50, 99 ] )
+            print( "    {:>8}  mapped range {}  count {:>10}  p1 {:10.2f}  p50 {:10.2f}  p99 {:10.2f}".format(
+                itemid, item_ranges.get( itemid ), item.count, p1, p50, p99 ) )
+
+def write_item_stats( items: dict, item2feature: dict, path: str ):
+    """
+    Writes count, min, max, mean, std and REPORT_PERCENTILES of each itemid.
+    """
+    with open( path, 'w', newline='' ) as f:
+        out = writer( f )
+        out.writerow( [ 'itemid', 'rid', 'count', 'min', 'max', 'mean', 'std' ] + [ f'p{p}' for p in REPORT_PERCENTILES ] )
+        for itemid in sorted( items ):
+            item = items[itemid]
+            out.writerow( [ itemid, item2feature.get( itemid, '' ), item.count, item.min, item.max, item.mean, item.std() ]
+                          + item.sketch.percentiles( REPORT_PERCENTILES ).tolist() )
+
+def write_stats( proposed: np.ndarray, stats: np.ndarray, rows: dict, mixed_rows: set, path: str ):
+    """
+    Writes the proposed stats table, one line per row in Stats_col order, next to the current bounds and the row's count and median.
+    mixed_units marks rows left as they are because their itemids are in different units.
+    """
+    cols = [ col for col in common.Stats_col if col != common.Stats_col.N_COLS ]
+    with open( path, 'w', newline='' ) as f:
+        out = writer( f )
+        out.writerow( [ 'rid' ] + [ col.name.lower() for col in cols ] + [ 'count', 'median', 'current_val_min', 'current_val_max', 'mixed_units' ] )
+        for row in range( common.N_ROWS ):
+            count, median = 0, np.nan
+            if row in rows:
+                count  = rows[row].count
+                median = rows[row].sketch.percentiles( [ 50 ] )[0]
+            out.writerow( [ row ] + [ proposed[row, col] for col in cols ]
+                          + [ count, median, stats[row, common.Stats_col.VAL_MIN], stats[row, common.Stats_col.VAL_MAX], int( row in mixed_rows ) ] )
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('csv_file', type=str,
+                        help='Exported patient data, relative to DATA_DIR, in any format csv_to_images reads')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Prefix of the output files, relative to DATA_DIR. Defaults to the export\'s name')
+    parser.add_argument('-j', '--n_workers', type=int, default=os.cpu_count(),
+                        help='Number of shards to scan in parallel. Plain csv only')
+    args = parser.parse_args()
+
+    csv_file = os.path.join( os.getenv('DATA_DIR'), args.csv_file )
+    prefix   = os.path.splitext( csv_file )[0] if args.output is None else os.path.join( os.getenv('DATA_DIR'), args.output )
+
+    item2feature, stats = csv_to_images.generate_stats( csv_file )
+    item_ranges = read_item_ranges( csv_file )
+    mixed_rows  = get_mixed_rows( item2feature, item_ranges )
+
+    start_time = time.time()
+    items = scan( csv_file, args.n_workers )
+    print( "Scanned {} values of {} itemids in {:.2f} sec".format( sum( item.count for item in items.values() ), len( items ), time.time() - start_time ) )
+
+    proposed, rows = propose_stats( items, item2feature, stats, mixed_rows )
+    print_multi_item_rows( items, item2feature, item_ranges, mixed_rows )
+
+    write_item_stats( items, item2feature, prefix + '_item_stats.csv' )
+    write_stats( proposed, stats, rows, mixed_rows, prefix + '_proposed_stats.csv' )
+    print( f"Wrote {prefix}_item_stats.csv and {prefix}_proposed_stats.csv" )
@@ -0,0 +1,220 @@
+import os
+import re
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import psycopg2
+import psycopg2.pool
+import common
+import csv_to_images
+import materialize
+import sparse_events
+
+# Export query and cohort script names in common.SQL_DIR
+EXPORT_SCRIPT_NAME = 'export_patient_data.sql'
+COHORT_SCRIPT_NAME = 'set_cohort_icu.sql'
+
+# Each worker points the export query at a per-session view of one range of the cohort
+COHORT_TABLE      = 'mimic_derived.cohort'
+COHORT_RANGE_VIEW = 'cohort_range'
+
+def run_script( conn, script_path: str ):
+    """
+    Runs a SQL script, such as one of the set_cohort_xxx.sql scripts, and commits it.
+    """
+    print( f"Running {script_path}" )
+    start_time = time.time()
+
+    with open( script_path, 'r' ) as f:
+        script = f.read()
+
+    with conn.cursor() as cur:
+        cur.execute( script )
+    conn.commit()
+
+    print( "Took {:.2f} sec".format( time.time() - start_time ) )
+
+def load_export_query( script_path: str ):
+    """
+    Splits export_patient_data.sql into its leading set statements and the export query,
+    with the cohort table swapped for the per-session range view.
+    The query's trailing semicolon is dropped so it can be declared as a cursor.
+    """
+    with open( script_path, 'r' ) as f:
+        script = f.read()
+
+    setup = re.findall( r'^\s*set\s+[^;]*;', script, flags=re.IGNORECASE | re.MULTILINE )
+    query = re.sub( r'^\s*set\s+[^;]*;', '', script, flags=re.IGNORECASE | re.MULTILINE )
+    query = query.strip().rstrip( ';' )
+    query = re.sub( r'\b' + re.escape( COHORT_TABLE ) + r'\b', 'pg_temp.' + COHORT_RANGE_VIEW, query )
+
+    return [ s.strip() for s in setup ], query
+
+def get_patient_ranges( conn, n_ranges: int ):
+    """
+    Splits the cohort's patient ids into at most n_ranges contiguous ranges holding
+    roughly the same number of patients. Honours the csv parser's patient id limits.
+    Returns a list of ( first_patient_id, last_patient_id ).
+    """
+    where = ''
+    if common.CSV_PARSER_PATIENTID_DO_LIMIT:
+        where = f'where subject_id between {int( common.CSV_PARSER_PATIENTID_MIN )} and {int( common.CSV_PARSER_PATIENTID_MAX )}'
+
+    with conn.cursor() as cur:
+        cur.execute( f"""
+            select min( subject_id ), max( subject_id )
+            from (
+                select subject_id, ntile( %s ) over ( order by subject_id ) as bucket
+                from ( select distinct subject_id from {COHORT_TABLE} {where} ) s
+            ) b
+            group by bucket
+            order by 1
+        """, ( n_ranges, ) )
+        ranges = cur.fetchall()
+    conn.rollback()
+
+    return ranges
+
+def stream_rows( conn, setup: list, query: str, first_patient_id: int, last_patient_id: int, chunk_rows: int ):
+    """
+    Yields export rows for the patients in [first_patient_id, last_patient_id], in the
+    export's sort order. Rows are fetched chunk_rows at a time from a server-side cursor,
+    so only one chunk is held in memory. The mapping rows are always included.
+    The caller ends the transaction once done with the rows, which drops the view.
+    """
+    with conn.cursor() as cur:
+        for statement in setup:
+            cur.execute( statement )
+        cur.execute( f"create or replace temp view {COHORT_RANGE_VIEW} as "
+                     f"select * from {COHORT_TABLE} where subject_id between %s and %s", ( first_patient_id, last_patient_id ) )
+
+    with conn.cursor( name=f'export_{first_patient_id}_{last_patient_id}' ) as cur:
+        cur.itersize = chunk_rows
+        cur.execute( query )
+        for row in cur:
+            yield row
+
+def get_stats( conn, setup: list, query: str ):
+    """
+    Builds item2feature and stats from the export's mapping rows, by running the
+    export over an empty range of patients so the mapping rows are all that's returned.
+    """
+    rows = stream_rows( conn, setup, query, -1, -1, common.EXTRACT_CHUNK_ROWS )
+    try:
+        return csv_to_images.build_stats( rows )
+    finally:
+        rows.close()
+        conn.rollback()
+
+def extract_range( pool, setup: list, query: str, patient_range: tuple, item2feature: dict, stats, img_paths: dict, chunk_rows: int ):
+    """
+    Streams one patient range from the database into images. Returns the number of visits generated.
+    """
+    first_patient_id, last_patient_id = patient_range
+
+    conn = pool.getconn()
+    rows = stream_rows( conn, setup, query, first_patient_id, last_patient_id, chunk_rows )
+    try:
+        return csv_to_images.parse_rows( rows, item2feature, stats, img_paths )
+    finally:
+        # parse_rows may stop early at the patient id limit, so close the cursor before ending the transaction
+        rows.close()
+        conn.rollback()
+        pool.putconn( conn )
+
+def extract_to_images( dsn: str, norm_methods: list = None, cohort_script: str = None, sql_dir: str = common.SQL_DIR,
+                       n_workers: int = None, n_ranges: int = None, chunk_rows: int = None ):
+    """
+    Top-level function that runs the cohort script, if given, and refreshes the materialized
+    event tables, then streams the export query straight into images without writing a csv. The cohort is split into patient id ranges,
+    each extracted over its own pooled connection, n_workers at a time.
+    """
+    n_workers  = common.EXTRACT_N_WORKERS  if n_workers  is None else n_workers
+    n_ranges   = common.EXTRACT_N_RANGES   if n_ranges   is None else n_ranges
+    chunk_rows = common.EXTRACT_CHUNK_ROWS if chunk_rows is None else chunk_rows
+
+    if norm_methods is None:
+        norm_methods = [common.NORM_METHOD]
+
+    pool = psycopg2.pool.ThreadedConnectionPool( 1, n_workers, dsn )
+    try:
+        conn = pool.getconn()
+        try:
+            if cohort_script is not None:
+                run_script( conn, os.path.join( sql_dir, cohort_script ) )
+
+            # The export reads the cohort's events from the materialized tables, so bring them up to date
+            materialize.refresh( conn, sql_dir )
+
+            setup, query = load_export_query( os.path.join( sql_dir, EXPORT_SCRIPT_NAME ) )
+            item2feature, stats = get_stats( conn, setup, query )
+            ranges = get_patient_ranges( conn, n_ranges )
+        finally:
+            pool.putconn( conn )
+
+        img_paths = { method: csv_to_images.get_master_path( method, norm_methods ) for method in norm_methods }
+
+        # Start from an empty master so images of patients no longer in the cohort don't linger
+        for img_path in img_paths.values():
+            os.makedirs( img_path, exist_ok=True )
+            for name in os.listdir( img_path ):
+                if name.endswith( '.png' ):
+                    os.remove( os.path.join( img_path, name ) )
+            sparse_events.remove_events( img_path )
+        csv_to_images.reset_clinical_scores( img_paths )
+
+        print( f"Extracting {len( ranges )} patient ranges with {n_workers} workers" )
+        extract_start_time = time.time()
+
+        with ThreadPoolExecutor( max_workers=n_workers ) as executor:
+            n_images = sum( executor.map(
+                lambda patient_range: extract_range( pool, setup, query, patient_range, item2feature, stats, img_paths, chunk_rows ),
+                ranges
+            ) )
+    finally:
+        pool.closeall()
+
+    print( "Extracted {} visits in {:.2f} sec".format( n_images, time.time() - extract_start_time ) )
+
+    return n_images
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cohort_name', type=str,
+                        help='Name of the cohort to generate. Suffixed with the method name when several norm methods are given')
+    parser.add_argument('--dsn', type=str, default='',
+                        help='libpq connection string, e.g. "dbname=mimic user=postgres". Defaults to the PG* environment variables')
+    parser.add_argument('-c', '--cohort_script', type=str, default=COHORT_SCRIPT_NAME,
+                        help='set_cohort_xxx.sql script to run first, relative to --sql_dir')
+    parser.add_argument('--skip_cohort', action='store_true',
+                        help='Use the existing mimic_derived.cohort instead of running the cohort script')
+    parser.add_argument('--sql_dir', type=str, default=common.SQL_DIR,
+                        help='Directory holding the SQL scripts')
+    parser.add_argument('-j', '--n_workers', type=int, default=common.EXTRACT_N_WORKERS,
+                        help='Number of patient ranges to extract at once, each over its own connection')
+    parser.add_argument('-r', '--n_ranges', type=int, default=common.EXTRACT_N_RANGES,
+                        help='Number of patient id ranges to split the cohort into')
+    parser.add_argument('--chunk_rows', type=int, default=common.EXTRACT_CHUNK_ROWS,
+                        help='Rows fetched per round trip from each server-side cursor')
+    parser.add_argument('-m', '--norm_methods', type=str, nargs='+', choices=[method.name for method in common.Norm_method],
+                        help='Normalization methods to generate from a single pass over the export. Defaults to common.NORM_METHOD')
+    parser.add_argument('--sparse', action='store_true',
+                        help='Store each visit\'s measured hours as sparse events instead of an image')
+    common.add_timeline_args(parser)
+    args = parser.parse_args()
+
+    common.set_timeline( args.horizon, args.resolution )
+
+    csv_to_images.COHORT_NAME = args.cohort_name
+    common.SPARSE_EVENTS = common.SPARSE_EVENTS or args.sparse
+
+    norm_methods = None
+    if args.norm_methods is not None:
+        norm_methods = list( dict.fromkeys( common.Norm_method[name] for name in args.norm_methods ) )
+
+    cohort_script = None if args.skip_cohort else args.cohort_script
+
+    extract_to_images( args.dsn, norm_methods, cohort_script, args.sql_dir, args.n_workers, args.n_ranges, args.chunk_rows )
@@ -1,5 +1,9 @@
 import numpy as np
 import common
+import checkpoint
+import early_stopping
+import distributed
+import export
 import os
 import numpy as np
 import torch
@@ -62,6 +66,22 @@ def run_tutorial():
     for i in range(top5_prob.size(0)):
         print(categories[top5_catid[i]], top5_prob[i].item())
 
+def to_inception_input( data ):
+    """
+    Manipulates a batch of timeline images to the [batch, 3, 299, 299] shape Inceptionv3 expects.
+    Single channel timelines are replicated across all 3 channels, and selections
+    of 2 channels are padded with an empty third channel.
+    """
+    if data.shape[1] == 1:
+        data = data.expand( data.shape[0], 3, data.shape[2], data.shape[3] )
+    elif data.shape[1] < 3:
+        data = F.pad( data, ( 0, 0, 0, 0, 0, 3 - data.shape[1] ) )
+
+    preprocess = transforms.Compose([
+                    transforms.Resize(299),
+                 ])
+    return preprocess( data )
+
 def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learning_rate=1e-3 ):
     """
     Main function.
@@ -72,14 +92,20 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     print( f"            Cohort: {os.path.basename(data_path)}")
 
 
+    # Use thread and loader settings tuned for this machine, if any. Inception keeps its small batches of 16
+    common.apply_tuned_config( 'inceptionv3' )
+
     # Load images and labels for each split
-    train_loader, test_loader, val_loader = common.load_data( batch_size=16, data_path=data_path )
+    train_loader, test_loader, val_loader = common.load_data( batch_size=16, data_path=data_path, neg_fraction=common.get_neg_fraction( 'inceptionv3' ), replay=True, tuned=False )
 
     # Create and train the model
     model = models.Inception3( num_classes=2 )
     model.to( common.device )
 
+    # The aux classifier's output isn't part of the loss, so its parameters get no gradients
+    model = distributed.wrap_model( model, find_unused_parameters=True )
     model = train_inceptionv3( model, train_loader, data_path, n_epoch, class_weight, learning_rate )
+    model = distributed.unwrap_model( model )
 
     # Evaluate the model's predictions against the ground truth
     with torch.no_grad():
@@ -93,7 +119,15 @@ def main( data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RA
     auc, acc, p, r, f = common.evaluate_predictions( y_val, y_pred_val, score=y_score_val )
     common.print_scores( "val", acc, auc, p, r, f )
 
-    common.dump_outputs(y_pred_val, y_val)
+    # Only rank 0 writes outputs when training is distributed
+    if not distributed.is_main_rank():
+        return
+
+    common.dump_outputs( y_pred_val, y_val, y_score_val, val_loader.dataset.img_labels.iloc[:, 0].values )
+
+    # Optionally export the trained model for the TorchScript/ONNX scoring backend
+    if common.EXPORT_DIR is not None:
+        export.export_model( model, 'inceptionv3', os.path.join( os.getenv('DATA_DIR'), common.EXPORT_DIR ), prepare_input=to_inception_input )
 
 def eval_model( model, dataloader ):
     """
@@ -105,6 +139,8 @@ def eval_model( model, dataloader ):
         Y_test: truth labels for the test set. Should be an numpy array of ints
         Y_val: truth labels for the val set. Should be an numpy array of ints
     """
+    # Eval runs on each rank's shard without DDP, which would sync on every forward pass
+    model = distributed.unwrap_model( model )
     model.eval()
     
     Y_score = torch.FloatTensor()
@@ -114,11 +150,7 @@ def eval_model( model, dataloader ):
     
     for data, target in dataloader:
         # Manipulate image to shape [batch, 3, 299, 299] that Inceptionv3 expects
-        data           = data.expand( data.shape[0], 3, data.shape[2], data.shape[3] )
-        preprocess     = transforms.Compose([
-                            transforms.Resize(299),
-                        ])
-        data           = preprocess( data )
+        data           = to_inception_input( data )
         data           = data.to( common.device )
         outputs        = model( data )
         _, predictions = torch.max( outputs, 1 )
@@ -134,10 +166,11 @@ def eval_model( model, dataloader ):
             print('.', end='', flush=True)
         i = i + 1
 
-    Y_pred = np.concatenate( Y_pred, axis=0 )
-    Y_true = np.concatenate( Y_true, axis=0 )
+    Y_pred = distributed.concatenate( Y_pred )
+    Y_true = distributed.concatenate( Y_true )
 
-    return Y_score, Y_pred, Y_true
+    # Collect every rank's shard of the split when distributed
+    return distributed.gather_outputs( Y_score, Y_pred, Y_true )
 
 def train_inceptionv3( model, train_dataloader, data_path, n_epoch=common.N_EPOCH, class_weight=common.CLASS_WEIGHT_RATIO, learn_rate=1e-3 ):
     """
@@ -154,13 +187,19 @@ def train_inceptionv3( model, train_dataloader, data_path, n_epoch=common.N_EPOC
     print( f"Class weight ratio: {class_weight_ratio}" )
     common.print_output_header()
     
-    weights       = [1.0 / class_weight_ratio, 1.0 - (1.0 / class_weight_ratio) ]
+    weights       = common.correct_class_weights( [1.0 / class_weight_ratio, 1.0 - (1.0 / class_weight_ratio) ], train_dataloader )
     class_weights = torch.FloatTensor( weights ).to( common.device )
     criterion     = torch.nn.modules.loss.CrossEntropyLoss( weight=class_weights )
 
     # Assign LR=1e-3 taken from the paper
     optimizer = torch.optim.RMSprop( model.parameters(), lr=learn_rate )
 
+    # Optionally continue from a previous run's checkpoint
+    checkpoint.warm_start( 'inceptionv3', model, optimizer )
+
+    # Stop once the val metric stops improving, see early_stopping.EarlyStopper
+    stopper = early_stopping.EarlyStopper( model, optimizer, n_epoch )
+
     model.train() # prep model for training
 
     train_start_time = time.time()
@@ -176,11 +215,7 @@ def train_inceptionv3( model, train_dataloader, data_path, n_epoch=common.N_EPOC
             data, target = data.to( common.device ), target.to( common.device )
 
             # Manipulate image to shape [batch, 3, 299, 299] that Inceptionv3 expects
-            data       = data.expand( data.shape[0], 3, data.shape[2], data.shape[3] )
-            preprocess = transforms.Compose([
-                            transforms.Resize(299),
-                         ])
-            data = preprocess(data)
+            data = to_inception_input( data )
 
             # zero the parameter gradients
             optimizer.zero_grad()
@@ -210,7 +245,7 @@ def train_inceptionv3( model, train_dataloader, data_path, n_epoch=common.N_EPOC
                 model.eval()
 
                 # Get entire dataloader
-                _, test_loader, val_loader = common.load_data(batch_size=16, data_path=data_path)
+                _, test_loader, val_loader = common.load_data(batch_size=16, data_path=data_path, tuned=False)
                 # Evaluate the model's predictions against the ground truth
                 y_score_test, y_pred_test, y_test = eval_model( model, test_loader )
                 y_score_val,  y_pred_val,  y_val  = eval_model( model, val_loader  )
@@ -223,11 +258,22 @@ def train_inceptionv3( model, train_dataloader, data_path, n_epoch=common.N_EPOC
 
                 # Stop early if we hit our target
                 if common.DO_EARLY_STOPPING and auc >= common.TARGET_AUC_INCEPTION:
+                    stopper.reached_target( epoch+1 )
+                    break
+
+                # Stop once val AUC or loss stops improving
+                val_loss = common.eval_loss( model, val_loader, criterion, to_inception_input ) if stopper.needs_loss() else None
+                if stopper.step( epoch+1, auc2, val_loss ):
                     break
     
             # Put model back in training mode
             model.train()
 
+    stopper.finish()
+
+    # Optionally save weights and optimizer state for warm starting later runs
+    checkpoint.save( 'inceptionv3', model, optimizer, data_path )
+
     print( "Training took {:.2f} sec".format( time.time() - train_start_time ) )
 
     return model
@@ -245,7 +291,9 @@ if __name__ == "__main__":
                         help='Class weight ratio to use for training')
     parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
                         help='Learning rate to use for training')
+    common.add_common_args(parser)
     args = parser.parse_args()
+    common.apply_common_args(args)
 
     cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
 
@@ -0,0 +1,113 @@
+import os
+import time
+import argparse
+import psycopg2
+import common
+
+# Setup script in common.SQL_DIR that creates and incrementally refreshes the materialized tables
+MATERIALIZE_SCRIPT_NAME = 'materialize_events.sql'
+
+# Tables the setup script maintains. Visits are tracked in the first one
+VISITS_TABLE = 'mimic_derived.cohort_materialized_visits'
+MATERIALIZED_TABLES = [
+    VISITS_TABLE,
+    'mimic_derived.cohort_chartevents',
+    'mimic_derived.cohort_labevents',
+    'mimic_derived.cohort_inputevents',
+    'mimic_derived.cohort_outputevents',
+    'mimic_derived.cohort_ed_vitalsign',
+    'mimic_derived.cohort_ed_diagnosis',
+]
+
+def drop_tables( conn ):
+    """
+    Drops every materialized table, so the next refresh rebuilds them from scratch.
+    """
+    with conn.cursor() as cur:
+        for table in MATERIALIZED_TABLES:
+            cur.execute( f"drop table if exists {table}" )
+    conn.commit()
+
+def count_visits( conn ):
+    """
+    Number of visits currently materialized, 0 if the tables don't exist yet.
+    """
+    with conn.cursor() as cur:
+        cur.execute( "select to_regclass( %s ) is not null", ( VISITS_TABLE, ) )
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return 0
+        cur.execute( f"select count(*) from {VISITS_TABLE}" )
+        n_visits = cur.fetchone()[0]
+    conn.rollback()
+
+    return n_visits
+
+def get_table_sizes( conn ):
+    """
+    Returns { table: ( estimated rows, bytes including indexes ) } for each materialized table,
+    using the planner statistics the setup script refreshes rather than counting rows.
+    """
+    sizes = dict()
+    with conn.cursor() as cur:
+        for table in MATERIALIZED_TABLES:
+            cur.execute( "select reltuples::bigint, pg_total_relation_size( oid ) from pg_class where oid = to_regclass( %s )", ( table, ) )
+            row = cur.fetchone()
+            if row is not None:
+                sizes[table] = row
+    conn.rollback()
+
+    return sizes
+
+def refresh( conn, sql_dir: str = common.SQL_DIR, rebuild: bool = False ):
+    """
+    Brings the materialized event tables in line with mimic_derived.cohort. Only visits added
+    to the cohort since the last refresh are copied in, and visits removed from it are deleted.
+    With rebuild, the tables are dropped and rebuilt from scratch instead, which is needed after
+    the scripts' itemid lists change or the source tables are reloaded.
+    Returns the number of visits materialized.
+    """
+    if rebuild:
+        print( "Dropping materialized tables" )
+        drop_tables( conn )
+
+    n_before = count_visits( conn )
+
+    script_path = os.path.join( sql_dir, MATERIALIZE_SCRIPT_NAME )
+    print( f"Refreshing materialized tables with {script_path}" )
+    start_time = time.time()
+
+    with open( script_path, 'r' ) as f:
+        script = f.read()
+
+    with conn.cursor() as cur:
+        cur.execute( script )
+    conn.commit()
+
+    n_after = count_visits( conn )
+    print( "Materialized {} visits ({:+d}) in {:.2f} sec".format( n_after, n_after - n_before, time.time() - start_time ) )
+
+    return n_after
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', type=str, default='',
+                        help='libpq connection string, e.g. "dbname=mimic user=postgres". Defaults to the PG* environment variables')
+    parser.add_argument('--sql_dir', type=str, default=common.SQL_DIR,
+                        help='Directory holding the SQL scripts')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Drop and rebuild the tables from scratch instead of refreshing incrementally')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect( args.dsn )
+    try:
+        refresh( conn, args.sql_dir, args.rebuild )
+
+        print( "%40s %14s %14s" % ( "table", "rows", "MB" ) )
+        for table, ( n_rows, n_bytes ) in get_table_sizes( conn ).items():
+            print( "%40s %14d %14.1f" % ( table, n_rows, n_bytes / 1024**2 ) )
+    finally:
+        conn.close()
@@ -1,34 +1,127 @@
 import os
 import sys
+import numpy as np
 import common
-from csv import writer, reader
+import baseline_eval
 
-def evaluate_mews(csv_file_path):
+# Urine output itemids. The export only carries whether no output was measured, see export_patient_data.sql
+URINE_ITEMIDS = [226627, 226631, 227489, 226559]
+
+# Itemids scored by get_points, for each MEWS component
+ITEMIDS = {
+    common.MEWS_component.RESP_RATE:   [220210],
+    common.MEWS_component.HEART_RATE:  [220045],
+    common.MEWS_component.SYSTOLIC_BP: [220179, 220050],
+    common.MEWS_component.AVPU:        [226104],
+    common.MEWS_component.TEMPERATURE: [223762, 223761],
+    common.MEWS_component.URINE:       URINE_ITEMIDS,
+}
+item2component = {itemid: component for component, itemids in ITEMIDS.items() for itemid in itemids}
+
+# The export writes ED temperatures, which are in F, under the C itemid 223762. Values above this can't be C
+CELSIUS_MAX = 50.0
+
+def get_points(itemid, val_num):
+    """
+    MEWS points for a single exported measurement, following mews_score.sql.
+    """
+    if itemid == 220210:
+        # respiratory rate (breaths per minute)
+        if val_num <= 0:  return 0
+        if val_num <= 8:  return 2
+        if val_num < 15:  return 0
+        if val_num < 21:  return 1
+        if val_num < 30:  return 2
+        return 3
+
+    if itemid == 220045:
+        # heart rate (beats per minute)
+        if val_num < 0:   return 0
+        if val_num < 40:  return 2
+        if val_num < 51:  return 1
+        if val_num < 101: return 0
+        if val_num < 111: return 1
+        if val_num < 130: return 2
+        return 3
+
+    if itemid in (220179, 220050):
+        # blood pressure, systolic
+        if val_num <= 0:   return 0
+        if val_num < 71:   return 3
+        if val_num <= 80:  return 2
+        if val_num <= 100: return 1
+        if val_num <= 200: return 0
+        return 3
+
+    if itemid == 226104:
+        # Conscious level (AVPU), already exported as its score
+        return val_num
+
+    if itemid == 223762 and val_num > CELSIUS_MAX:
+        # ED temperature in F, scored like 223761
+        itemid = 223761
+
+    if itemid == 223762:
+        # temperature C
+        if val_num < 35.0:  return 2
+        if val_num <= 36.0: return 1
+        if val_num <= 38.0: return 0
+        if val_num <= 38.6: return 1
+        return 2
+
+    if itemid == 223761:
+        # temperature F
+        if val_num < 95.0:   return 2
+        if val_num <= 96.8:  return 1
+        if val_num <= 100.4: return 0
+        if val_num <= 101.48: return 1
+        return 2
+
+    # Urine output is exported as 1 when there was no output, which scores as < 10 mL.
+    # Any output counts as normal, since the export doesn't carry the volume
+    return 3 if val_num > 0 else 0
+
+def record_component(itemid, val_num, hour, visit):
+    """
+    Records the MEWS points of a measurement for the visit, keeping the worst per hour.
+    hour is the timeline column
+    """
+    component = item2component[itemid]
+    visit.mews[component, hour] = max(visit.mews[component, hour], get_points(itemid, val_num))
+
+def get_trajectory(visit):
     """
-    Evaluates MEWS prediction metrics. Reads MEWS predictions
-    and ground truth from mews_preds.csv
+    MEWS score at each hour of the visit. As in mews_score.sql, each component contributes
+    its worst points so far, so the last hour holds the score over the whole timeline.
     """
-    Y_pred_thresh = []
-    Y_pred_warning = []
-    Y_true = []
+    return np.maximum.accumulate(visit.mews, axis=1).sum(axis=0)
 
-    # Read MEWS prediction and ground truth from csv
-    i = 0
-    with open(csv_file_path, 'r') as f:
-        for row in reader(f):
-            if i == 0:
-                i = i + 1
-                continue
-            Y_pred_thresh.append(int(int(row[common.MEWS_rows.MEWS_SCORE]) > common.MEWS_THRESHOLD))
-            Y_pred_warning.append(int(row[common.MEWS_rows.MEWS_WARNING]))
-            Y_true.append(int(row[common.MEWS_rows.DIED]))
-            i = i + 1
+def evaluate_mews(csv_file_path, output_csv_path=None):
+    """
+    Evaluates MEWS prediction metrics. Reads MEWS scores, warnings
+    and ground truth from mews_score.sql's export or the mews_preds.csv written
+    by csv_to_images. The raw MEWS score is treated as a continuous predictor,
+    swept over every threshold and compared against common.MEWS_THRESHOLD.
+    """
+    rows = common.MEWS_rows
+    cols = baseline_eval.load_score_columns(csv_file_path, [rows.PATIENT_ID, rows.VISIT_ID, rows.MEWS_SCORE, rows.MEWS_WARNING, rows.DIED])
+    patient_ids = cols[rows.PATIENT_ID].astype(int)
+    visit_ids   = cols[rows.VISIT_ID].astype(int)
+    score       = cols[rows.MEWS_SCORE]
+    warning     = cols[rows.MEWS_WARNING].astype(int)
+    died        = cols[rows.DIED].astype(int)
 
     # Evaluate the scores' predictions against the ground truth
-    print(f"\nMEWS Scores Thresholded at {common.MEWS_THRESHOLD}:")
-    common.evaluate_predictions(Y_true, Y_pred_thresh, score=Y_pred_thresh)
+    print(f"\nMEWS Scores swept over all thresholds (fixed threshold {common.MEWS_THRESHOLD}):")
+    baseline_eval.print_sweep("MEWS", died, score, common.MEWS_THRESHOLD)
+    baseline_eval.print_calibration("MEWS", died, score)
+
     print(f"\n\nMEWS Scores as predicted by MEWS Warning Score:")
-    common.evaluate_predictions(Y_true, Y_pred_warning, score=Y_pred_warning)
+    auc, acc, p, r, f = common.evaluate_predictions(died, warning, score=warning)
+    common.print_scores("warning", acc, auc, p, r, f)
+
+    if output_csv_path is not None:
+        baseline_eval.compare_with_model("MEWS", patient_ids, visit_ids, score, died, output_csv_path)
 
 
 if __name__ == "__main__":
@@ -38,15 +131,16 @@ if __name__ == "__main__":
     try:
         csv_file = sys.argv[1]
     except:
-        print("Usage: python mews.py <csv_file>")
+        print("Usage: python mews.py <csv_file> <optional_model_output_csv>")
         raise
 
-    # Store output image name suffix if supplied, but carry on if not
+    # Store model output csv to compare against if supplied, but carry on if not
+    output_path = None
     try:
-        OUT_IMG_SUFFIX = sys.argv[2]
+        output_path = os.path.join( os.getenv('DATA_DIR'), sys.argv[2])
     except:
         pass
 
     path = os.path.join( os.getenv('DATA_DIR'), csv_file)
 
-    evaluate_mews(path)
\ No newline at end of file
+    evaluate_mews(path, output_path)
@@ -3,6 +3,7 @@ import cnn
 import cnn_rl
 import rnn
 import inceptionv3
+import deep_cnn
 import common
 import os
 import argparse
@@ -32,6 +33,11 @@ def main( data_path, n_epoch, class_weight, learning_rate ):
     inceptionv3.main(data_path, n_epoch, class_weight, learning_rate)
     print("###############################\n")
 
+    print("###############################")
+    print("\n Running Deep CNN")
+    deep_cnn.main(data_path, n_epoch, class_weight, learning_rate)
+    print("###############################\n")
+
 
 if __name__ == "__main__":
     """
@@ -46,7 +52,9 @@ if __name__ == "__main__":
                         help='Class weight ratio to use for training')
     parser.add_argument('-l', '--learning_rate', type=float, nargs=1,
                         help='Learning rate to use for training')
+    common.add_common_args(parser)
     args = parser.parse_args()
+    common.apply_common_args(args)
 
     cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
 
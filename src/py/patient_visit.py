@@ -3,15 +3,35 @@ import numpy as np
 import common
 
 class Patient_visit:
-    def __init__(self, patient_id: int, visit_id: int, hospital_expire_flag: int, stats: np.ndarray, item2feature: np.ndarray):
+    def __init__(self, patient_id: int, visit_id: int, hospital_expire_flag: int, stats: np.ndarray, item2feature: np.ndarray, norm_methods: list = None):
         self.patient_id = patient_id
         self.visit_id = visit_id
         self.hospital_expire_flag = hospital_expire_flag
-        self.img = self.init_img(stats)
-        self.braden = self.init_braden(stats, item2feature)
-        self.morse = self.init_braden(stats, item2feature)
 
-    def init_img(self, stats: np.ndarray):
+        # One image and set of score component records per normalization method
+        if norm_methods is None:
+            norm_methods = [common.NORM_METHOD]
+        self.imgs = {method: self.init_img(stats, method) for method in norm_methods}
+        self.braden = {method: self.init_braden(stats, item2feature, method) for method in norm_methods}
+        self.morse = {method: self.init_braden(stats, item2feature, method) for method in norm_methods}
+
+        # Marks which hours had a measured value for each row, shared by all methods
+        self.observed = np.zeros((common.N_ROWS, common.N_COLS), dtype=bool)
+
+        # Worst MEWS/SOFA points recorded each hour per component, and the latest values of
+        # inputs SOFA combines, e.g. PaO2 and FiO2. See mews.py and sofa.py
+        self.mews = np.zeros((len(common.MEWS_component), common.N_COLS), dtype=np.float64)
+        self.sofa = np.zeros((len(common.SOFA_component), common.N_COLS), dtype=np.float64)
+        self.sofa_inputs = dict()
+
+    def nbytes(self):
+        """
+        Bytes held by this visit's arrays, used to bound the memory of visits waiting to be written
+        """
+        arrays = list(self.imgs.values()) + list(self.braden.values()) + list(self.morse.values()) + [self.observed, self.mews, self.sofa]
+        return sum(array.nbytes for array in arrays)
+
+    def init_img(self, stats: np.ndarray, method: common.Norm_method):
         """
         Initialize default values per row in img
         """
@@ -27,17 +47,17 @@ class Patient_visit:
                 stats[row, common.Stats_col.VAL_MAX],
                 row,
                 stats[row, common.Stats_col.VAR_TYPE],
-                common.NORM_METHOD
+                method
             )
             # Assign normalized default value to entire row
             img[row, :] = val_default_normalized
         return img
 
-    def init_braden(self, stats, item2feature):
+    def init_braden(self, stats, item2feature, method: common.Norm_method):
         """
         Initialize default values per row in braden score component records
         """
-        braden = np.zeros((len(common.braden_item2row), common.N_HOURS), dtype=np.float64)
+        braden = np.zeros((len(common.braden_item2row), common.N_COLS), dtype=np.float64)
         for itemid in common.braden_item2row:
             featureid = item2feature[itemid]
             val_default_normalized = common.normalize(
@@ -47,16 +67,16 @@ class Patient_visit:
                 stats[featureid, common.Stats_col.REF_MAX],
                 featureid,
                 stats[featureid, common.Stats_col.VAR_TYPE],
-                common.NORM_METHOD
+                method
             )
             braden[common.braden_item2row[itemid], :] = val_default_normalized
         return braden
 
-    def init_morse(self, stats, item2feature):
+    def init_morse(self, stats, item2feature, method: common.Norm_method):
         """
         Initialize default values per row in morse score component records
         """
-        morse = np.zeros((len(common.morse_item2row), common.N_HOURS), dtype=np.float64)
+        morse = np.zeros((len(common.morse_item2row), common.N_COLS), dtype=np.float64)
         for itemid in common.morse_item2row:
             featureid = item2feature[itemid]
             val_default_normalized = common.normalize(
@@ -66,7 +86,7 @@ class Patient_visit:
                 stats[featureid, common.Stats_col.REF_MAX],
                 featureid,
                 stats[featureid, common.Stats_col.VAR_TYPE],
-                common.NORM_METHOD
+                method
             )
             morse[common.morse_item2row[itemid], :] = val_default_normalized
         return morse
@@ -0,0 +1,141 @@
+import io
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+import common
+
+class QuantizedConv( nn.Module ):
+    """
+    Wraps a Conv2d between quant/dequant stubs so it can be statically quantized
+    on its own while the rest of the model stays in float.
+    """
+    def __init__( self, conv ):
+        super( QuantizedConv, self ).__init__()
+        self.quant   = tq.QuantStub()
+        self.conv    = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward( self, x ):
+        return self.dequant( self.conv( self.quant( x ) ) )
+
+def get_backend():
+    """
+    Picks fbgemm on x86 and falls back to qnnpack elsewhere.
+    """
+    engines = torch.backends.quantized.supported_engines
+    return 'fbgemm' if 'fbgemm' in engines else 'qnnpack'
+
+def wrap_convs( module ):
+    """
+    Replaces every Conv2d below module with a QuantizedConv in place.
+    Returns the number of convs wrapped.
+    """
+    n_wrapped = 0
+    for name, child in module.named_children():
+        if isinstance( child, nn.Conv2d ):
+            setattr( module, name, QuantizedConv( child ) )
+            n_wrapped = n_wrapped + 1
+        else:
+            n_wrapped = n_wrapped + wrap_convs( child )
+    return n_wrapped
+
+def quantize_model( model, calibration_loader, prepare_input=None, n_samples=common.QUANTIZE_CALIBRATION_SAMPLES ):
+    """
+    Returns an int8 copy of model for CPU inference. Conv layers are statically
+    quantized using activation ranges observed on the first n_samples of
+    calibration_loader. LSTM, GRU and Linear layers are dynamically quantized, except recurrent layers without biases.
+    prepare_input maps a batch of images to the model's input, as in each model's eval_model.
+    """
+    backend = get_backend()
+    torch.backends.quantized.engine = backend
+
+    qmodel = copy.deepcopy( model ).to( 'cpu' ).eval()
+
+    # Static quantization of convs, calibrated on a sample of the train split
+    if wrap_convs( qmodel ) > 0:
+        qconfig = tq.get_default_qconfig( backend )
+        for module in qmodel.modules():
+            if isinstance( module, QuantizedConv ):
+                module.qconfig = qconfig
+        tq.prepare( qmodel, inplace=True )
+
+        n_seen = 0
+        with torch.no_grad():
+            for data, _ in calibration_loader:
+                if prepare_input is not None:
+                    data = prepare_input( data )
+                qmodel( data )
+                n_seen = n_seen + len( data )
+                if n_seen >= n_samples:
+                    break
+
+        tq.convert( qmodel, inplace=True )
+
+    # Dynamic quantization of recurrent and linear layers. Quantized recurrent layers need biases,
+    # so ones built without, like CNN_RL's FusedConvLSTM, stay in float
+    dynamic = [ name for name, module in qmodel.named_modules()
+                if isinstance( module, nn.Linear ) or ( isinstance( module, ( nn.LSTM, nn.GRU ) ) and module.bias ) ]
+    qmodel = tq.quantize_dynamic( qmodel, { name: tq.default_dynamic_qconfig for name in dynamic }, dtype=torch.qint8 )
+
+    return qmodel
+
+def score_cpu( model, dataloader, prepare_input=None ):
+    """
+    Scores every batch of dataloader on CPU, timing only the forward passes.
+    Returns scores, ground truth, total forward seconds and per-batch latencies.
+    """
+    model.eval()
+
+    Y_score   = []
+    Y_true    = []
+    latencies = []
+
+    with torch.no_grad():
+        for data, target in dataloader:
+            if prepare_input is not None:
+                data = prepare_input( data )
+
+            start_time = time.perf_counter()
+            outputs    = model( data )
+            latencies.append( time.perf_counter() - start_time )
+
+            Y_score.append( outputs[:,1].numpy() )
+            Y_true.append( target.numpy() )
+
+    return np.concatenate( Y_score ), np.concatenate( Y_true ), np.sum( latencies ), np.array( latencies )
+
+def get_size_bytes( model ):
+    """
+    Serialized size of the model's state dict.
+    """
+    buffer = io.BytesIO()
+    torch.save( model.state_dict(), buffer )
+    return buffer.getbuffer().nbytes
+
+def report_quantized( model, train_loader, val_loader, prepare_input=None ):
+    """
+    Quantizes model and compares it against its fp32 version on CPU over val_loader,
+    printing AUC delta, per-batch latency and throughput.
+    """
+    fp32_model = copy.deepcopy( model ).to( 'cpu' ).eval()
+    int8_model = quantize_model( model, train_loader, prepare_input )
+
+    print( f"\nQuantized inference on CPU ({torch.backends.quantized.engine}, {torch.get_num_threads()} threads):" )
+    print( "%6s %-12s %-14s %-14s %-14s %-10s" % ( " ", "AUC", "batch ms p50", "batch ms p95", "visits/sec", "size MB" ) )
+
+    aucs = dict()
+    for name, m in ( ( 'fp32', fp32_model ), ( 'int8', int8_model ) ):
+        y_score, y_true, seconds, latencies = score_cpu( m, val_loader, prepare_input )
+        y_pred = ( y_score > 0.5 ).astype( np.int64 )
+
+        aucs[name], _, _, _, _ = common.evaluate_predictions( y_true, y_pred, score=y_score )
+        print( "%6s %.10f %-14.3f %-14.3f %-14.1f %-10.2f" % (
+            name, aucs[name], np.percentile( latencies, 50 ) * 1000, np.percentile( latencies, 95 ) * 1000,
+            len( y_true ) / seconds, get_size_bytes( m ) / 1024**2 ) )
+
+    print( "%6s %+.10f" % ( "delta", aucs['int8'] - aucs['fp32'] ) )
+
+    return int8_model
@@ -1,13 +1,72 @@
 from csv import reader, writer
 import os
-import sys
+import json
+import hashlib
+import argparse
 import common
 import numpy as np
 import shutil
+import sparse_events
 
-def shuffle_images(orig_name, shuffled_name, seed, n):
+# Records how a shuffled cohort's splits were assigned, so new visits can be appended to it later
+SPLITS_FILE_NAME = 'splits.json'
+
+# Splits in the order their fractions are given
+SPLITS = [ 'train', 'test', 'val' ]
+
+def get_default_fractions():
+    """
+    Train, test and val fractions matching TEST_SPLIT_PCT and VAL_SPLIT_PCT in common.
+    """
+    val  = common.VAL_SPLIT_PCT
+    test = ( 1 - common.VAL_SPLIT_PCT ) * common.TEST_SPLIT_PCT
+    return [ 1 - val - test, test, val ]
+
+def get_patient_position( patient_id: int, seed: int ):
+    """
+    Stable pseudo random position of a patient in [0, 1), the same on every run and machine for a given seed.
+    """
+    digest = hashlib.sha256( f"{seed}:{patient_id}".encode() ).digest()
+    return int.from_bytes( digest[:8], 'big' ) / 2**64
+
+def get_split( patient_id: int, seed: int, fractions: list ):
+    """
+    Split a patient falls into. Depends only on the patient id, seed and fractions, so every visit
+    of a patient lands in the same split and adding patients never moves existing ones.
+    """
+    position = get_patient_position( patient_id, seed )
+    bounds   = np.cumsum( fractions ) / np.sum( fractions )
+    for split, bound in zip( SPLITS, bounds ):
+        if position < bound:
+            return split
+    return SPLITS[-1]
+
+def get_patient_id( img_name: str ):
+    return int( img_name.split( '_' )[0] )
+
+def get_hash_key( img_name: str, seed: int ):
+    """
+    Position of a visit in hash order, which size limits cut the cohort in.
+    """
+    return ( get_patient_position( get_patient_id( img_name ), seed ), img_name )
+
+def read_split_names( split_path: str ):
+    """
+    Names of the visits already listed in a split's labels.csv.
+    """
+    labels_path = os.path.join( split_path, common.ANNOTATIONS_FILE_NAME )
+    if not os.path.exists( labels_path ):
+        return []
+    with open( labels_path, 'r', newline='' ) as f:
+        return [ row[0] for row in reader( f ) if len( row ) > 0 ]
+
+def shuffle_images(orig_name, shuffled_name, seed, n=None, fractions=None, append=False):
     """
     Shuffles an existing cohort of images into splits.
+    Each visit's split is drawn from a hash of its patient id and seed rather than its position in a shuffled
+    list, so all of a patient's visits share a split. With append, visits added to the master since the
+    shuffled cohort was created are added to the splits they hash to, and existing visits stay where they are.
+    A cohort limited to n visits records the hash position of its last one, and only takes new visits before it.
     Pre:
         Folder structure must be <repo>/images/<orig_cohort_name>/master/<all_the_images>
     Post:
@@ -17,76 +76,102 @@ def shuffle_images(orig_name, shuffled_name, seed, n):
     # Get list of images in master path
     img_path = os.getenv( 'IMAGES_DIR' )
     master_img_path = os.path.join( img_path, orig_name, 'master' )
-    master_imgs = os.listdir(master_img_path)
-
-    # Shuffle images
-    np.random.seed(seed)
-    np.random.shuffle(master_imgs)
-
-    # Set n to full cohort if not supplied
-    if n is None:
-        n = len(master_imgs)
-
-    # Create output directories for shuffled splits
-    train_path = os.path.join( img_path, orig_name, shuffled_cohort_name, 'train' )
-    test_path = os.path.join( img_path, orig_name, shuffled_cohort_name, 'test' )
-    val_path = os.path.join( img_path, orig_name, shuffled_cohort_name, 'val' )
-    os.makedirs(train_path)
-    os.makedirs(test_path)
-    os.makedirs(val_path)
-
-    for i in range(n):
-        # Determine which split this patient will fall into and set the path accordingly.
-        split    = common.get_split_as_string( i, n )
-        shuffled_img_path = os.path.join( img_path, orig_name, shuffled_cohort_name, split )
-
-        # Get the ground truth from the last character of the filename
-        died = master_imgs[i][master_imgs[i].find('.') - 1]
-
-        # Copy image to the correct split
-        src = os.path.join(master_img_path, master_imgs[i])
-        dst = os.path.join(shuffled_img_path, master_imgs[i])
-        shutil.copyfile(src, dst)
-
-        # Write label for this patient into labels.csv
-        with open( os.path.join( shuffled_img_path, common.ANNOTATIONS_FILE_NAME), 'a', newline='' ) as f:
+    master_imgs = [name for name in os.listdir(master_img_path) if name.endswith('.png')]
+
+    # Sparse cohorts have no images, their splits just list visits of the master's events
+    sparse = len(master_imgs) == 0
+    if sparse:
+        master_imgs = sparse_events.list_visit_names(master_img_path)
+
+    shuffled_path = os.path.join( img_path, orig_name, shuffled_name )
+    splits_path   = os.path.join( shuffled_path, SPLITS_FILE_NAME )
+
+    if append:
+        # Keep assigning with the seed and fractions the cohort was created with
+        with open( splits_path, 'r' ) as f:
+            assignment = json.load( f )
+        if assignment['seed'] != seed:
+            raise ValueError( f"{shuffled_name} was shuffled with seed {assignment['seed']}, not {seed}" )
+        fractions = assignment['fractions']
+
+        existing    = set( name for split in SPLITS for name in read_split_names( os.path.join( shuffled_path, split ) ) )
+        master_imgs = [ name for name in master_imgs if name not in existing ]
+
+        # A size limited cohort only takes new visits up to its last kept one in hash order, so visits its limit cut off stay out
+        cutoff = assignment.get( 'cutoff' )
+        if cutoff is not None:
+            master_imgs = [ name for name in master_imgs if get_hash_key( name, seed ) <= tuple( cutoff ) ]
+        elif assignment.get( 'n' ) is not None:
+            master_imgs = []
+    else:
+        if fractions is None:
+            fractions = get_default_fractions()
+
+        # Limit the cohort to the n visits first in hash order, which keeps patients together
+        master_imgs = sorted( master_imgs, key=lambda name: get_hash_key( name, seed ) )
+        cutoff = None
+        if n is not None:
+            master_imgs = master_imgs[:n]
+            if len( master_imgs ) > 0:
+                cutoff = list( get_hash_key( master_imgs[-1], seed ) )
+
+        # Create output directories for shuffled splits
+        for split in SPLITS:
+            os.makedirs( os.path.join( shuffled_path, split ) )
+
+        with open( splits_path, 'w' ) as f:
+            json.dump( { 'seed': seed, 'fractions': list( fractions ), 'n': n, 'cutoff': cutoff }, f )
+
+        # Carry over the horizon and resolution the images were generated with
+        timeline_path = os.path.join( master_img_path, common.TIMELINE_FILE_NAME )
+        if os.path.exists( timeline_path ):
+            shutil.copyfile( timeline_path, os.path.join( shuffled_path, common.TIMELINE_FILE_NAME ) )
+
+        if sparse:
+            sparse_events.write_sparse_cohort( shuffled_path, master_img_path )
+
+    # Group visits by split, in a stable order
+    split_imgs = { split: list() for split in SPLITS }
+    for name in sorted( master_imgs ):
+        split_imgs[get_split( get_patient_id( name ), seed, fractions )].append( name )
+
+    for split, names in split_imgs.items():
+        shuffled_img_path = os.path.join( shuffled_path, split )
+
+        # Write labels for this split's visits into labels.csv
+        with open( os.path.join( shuffled_img_path, common.ANNOTATIONS_FILE_NAME ), 'a', newline='' ) as f:
             label_writer = writer( f, delimiter=',' )
 
-            line = [c.strip() for c in f"{master_imgs[i]}, {died}".strip(', ').split(',')]
-            label_writer.writerow(line)
+            for name in names:
+                # Get the ground truth from the last character of the filename
+                died = name[name.find('.') - 1]
+
+                # Copy image to the correct split
+                if not sparse:
+                    shutil.copyfile( os.path.join( master_img_path, name ), os.path.join( shuffled_img_path, name ) )
+
+                label_writer.writerow( [ name, died ] )
+
+        print( f"{'Appended' if append else 'Assigned'} {len( names )} visits to {split}" )
 
 
 if __name__ == "__main__":
     """
-    Main section for when this file is invoked directly. Should only
-    be used for debugging csv parsing down to image generation.
+    Main section for when this file is invoked directly.
     """
-    # Store orig_cohort_name, and fail if not supplied
-    try:
-        orig_cohort_name = sys.argv[1]
-    except:
-        print("Usage: python csv_to_images.py <csv_file> <cohort_name> <seed> <n=full>")
-        raise
-
-    # Store shuffled_cohort_name if supplied, and fail if not supplied
-    try:
-        shuffled_cohort_name = sys.argv[2]
-    except:
-        print("Usage: python csv_to_images.py <csv_file> <cohort_name> <seed> <n=full>")
-        raise
-
-    # Store seed if supplied, and fail if not supplied
-    try:
-        seed = int(sys.argv[3])
-    except:
-        print("Usage: python csv_to_images.py <csv_file> <cohort_name> <seed> <n=full>")
-        raise
-
-    # Store output image name suffix if supplied, but carry on if not
-    n = None
-    try:
-        n = int(sys.argv[4])
-    except:
-        pass
-
-    shuffle_images(orig_cohort_name, shuffled_cohort_name, seed, n)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('orig_cohort_name', type=str,
+                        help='Cohort generated by csv_to_images.py, relative to IMAGES_DIR')
+    parser.add_argument('shuffled_cohort_name', type=str,
+                        help='Name of the shuffled cohort to create, or append to')
+    parser.add_argument('seed', type=int,
+                        help='Seed hashed with each patient id to pick its split')
+    parser.add_argument('n', type=int, nargs='?',
+                        help='Optional limit on the number of visits. Ignored with --append, which keeps the cohort\'s own cutoff')
+    parser.add_argument('-f', '--fractions', type=float, nargs=3, metavar=('TRAIN', 'TEST', 'VAL'),
+                        help='Split fractions. Defaults to those given by TEST_SPLIT_PCT and VAL_SPLIT_PCT. --append keeps the cohort\'s own')
+    parser.add_argument('--append', action='store_true',
+                        help='Add visits new to the master to an existing shuffled cohort, leaving existing visits in place')
+    args = parser.parse_args()
+
+    shuffle_images(args.orig_cohort_name, args.shuffled_cohort_name, args.seed, args.n, args.fractions, args.append)
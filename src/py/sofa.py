@@ -1,34 +1,174 @@
 import os
 import sys
+import numpy as np
 import common
-from csv import writer, reader
+import baseline_eval
 
-def evaluate_sofa(csv_file_path):
+# Inputs to SOFA components, following sofa_score.sql.
+# Items the export doesn't carry never reach record_component, see export_patient_data.sql
+PAO2_ITEMIDS          = [50821]
+FIO2_ITEMIDS          = [223835]
+PLATELET_ITEMIDS      = [51265]
+BILIRUBIN_ITEMIDS     = [50885, 225690]
+MAP_ITEMIDS           = [220052, 225312]
+SYSTOLIC_BP_ITEMIDS   = [220179, 220050]
+DIASTOLIC_BP_ITEMIDS  = [220180, 220051]
+VASOPRESSOR_ITEMIDS   = [221653, 221662, 221906]
+GCS_ITEMIDS           = [220739, 223901, 223900]
+CREATININE_ITEMIDS    = [50912]
+URINE_ITEMIDS         = [226627, 226631, 227489]
+
+ITEMIDS = PAO2_ITEMIDS + FIO2_ITEMIDS + PLATELET_ITEMIDS + BILIRUBIN_ITEMIDS + MAP_ITEMIDS + SYSTOLIC_BP_ITEMIDS + \
+    DIASTOLIC_BP_ITEMIDS + VASOPRESSOR_ITEMIDS + GCS_ITEMIDS + CREATININE_ITEMIDS + URINE_ITEMIDS
+
+# Components sofa_score.sql scores from a visit-wide aggregate rather than the worst measurement: the ratio of the
+# average PaO2 and FiO2, and the best total GCS. Their points can go down, so they're recorded from their hour
+# onwards as the aggregate so far instead of being accumulated as worst points
+AGGREGATE_COMPONENTS = [common.SOFA_component.RESPIRATION, common.SOFA_component.CNS]
+
+def get_respiration_points(pao2, fio2):
+    ratio = 0 if fio2 == 0 else np.floor(pao2 * 100 / fio2)
+    if ratio < 100: return 4
+    if ratio < 200: return 3
+    if ratio < 300: return 2
+    if ratio < 400: return 1
+    return 0
+
+def get_coagulation_points(platelets):
+    if platelets < 20:  return 4
+    if platelets < 50:  return 3
+    if platelets < 100: return 2
+    if platelets < 150: return 1
+    return 0
+
+def get_liver_points(bilirubin):
+    if bilirubin < 1.2: return 0
+    if bilirubin < 2:   return 1
+    if bilirubin < 6:   return 2
+    if bilirubin < 12:  return 3
+    return 4
+
+def get_vasopressor_points(itemid, amount):
+    if itemid == 221662:
+        # Dopamine
+        if amount < 5:  return 2
+        if amount > 15: return 4
+        return 3
+    if itemid == 221653:
+        # Dobutamine
+        return 2 if amount > 0 else 0
+    # Norepinephrine
+    return 3 if amount < 0.1 else 4
+
+def get_cns_points(gcs):
+    if gcs < 6:  return 4
+    if gcs < 10: return 3
+    if gcs < 13: return 2
+    if gcs < 15: return 1
+    return 0
+
+def get_creatinine_points(creatinine):
+    if creatinine < 1.2: return 0
+    if creatinine < 2:   return 1
+    if creatinine < 3.5: return 2
+    if creatinine < 5:   return 3
+    return 4
+
+def record_component(itemid, val_num, hour, visit):
     """
-    Evaluates SOFA prediction metrics. Reads SOFA predictions
-    and ground truth from sofa_preds.csv
+    Records the SOFA points of a measurement for the visit, keeping the worst per hour.
+    As in sofa_score.sql, respiration is scored from the ratio of the visit's average PaO2 and FiO2 so far,
+    and the CNS from the best total GCS so far, each hour's components summed. Both are kept from their
+    hour onwards, see AGGREGATE_COMPONENTS, which relies on the export's rows being in time order.
+    Without an arterial line, mean arterial pressure is estimated from the latest systolic and diastolic pressure.
+    Inputs seen so far are kept in visit.sofa_inputs. hour is the timeline column
     """
-    Y_pred_thresh = []
-    Y_pred_est = []
-    Y_true = []
+    inputs = visit.sofa_inputs
+    component, points = None, None
+
+    if itemid in PAO2_ITEMIDS or itemid in FIO2_ITEMIDS:
+        name = 'pao2' if itemid in PAO2_ITEMIDS else 'fio2'
+        total, count = inputs.get(name, (0.0, 0))
+        inputs[name] = (total + val_num, count + 1)
+        if 'pao2' in inputs and 'fio2' in inputs:
+            pao2 = inputs['pao2'][0] / inputs['pao2'][1]
+            fio2 = inputs['fio2'][0] / inputs['fio2'][1]
+            visit.sofa[common.SOFA_component.RESPIRATION, hour:] = get_respiration_points(pao2, fio2)
+
+    elif itemid in PLATELET_ITEMIDS:
+        component, points = common.SOFA_component.COAGULATION, get_coagulation_points(val_num)
+
+    elif itemid in BILIRUBIN_ITEMIDS:
+        component, points = common.SOFA_component.LIVER, get_liver_points(val_num)
+
+    elif itemid in MAP_ITEMIDS:
+        component, points = common.SOFA_component.CARDIOVASCULAR, int(val_num < 70)
+
+    elif itemid in SYSTOLIC_BP_ITEMIDS or itemid in DIASTOLIC_BP_ITEMIDS:
+        inputs['sbp' if itemid in SYSTOLIC_BP_ITEMIDS else 'dbp'] = val_num
+        if 'sbp' in inputs and 'dbp' in inputs and inputs['sbp'] > 0 and inputs['dbp'] > 0:
+            mean_pressure = (inputs['sbp'] + 2 * inputs['dbp']) / 3
+            component, points = common.SOFA_component.CARDIOVASCULAR, int(mean_pressure < 70)
 
-    # Read SOFA prediction and ground truth from csv
-    i = 0
-    with open(csv_file_path, 'r') as f:
-        for row in reader(f):
-            if i == 0:
-                i = i + 1
-                continue
-            Y_pred_thresh.append(int(int(row[common.SOFA_rows.SOFA_SCORE]) > common.SOFA_SCORE_THRESHOLD))
-            Y_pred_est.append(int(float(row[common.SOFA_rows.EST_MORTALITY]) > common.SOFA_EST_THRESHOLD))
-            Y_true.append(int(row[common.SOFA_rows.DIED]))
-            i = i + 1
+    elif itemid in VASOPRESSOR_ITEMIDS:
+        component, points = common.SOFA_component.CARDIOVASCULAR, get_vasopressor_points(itemid, val_num)
+
+    elif itemid in GCS_ITEMIDS:
+        # Total the components charted in this hour, like the SQL totals those charted in the same minute
+        if inputs.get('gcs_hour') != hour:
+            inputs['gcs_hour'], inputs['gcs'] = hour, dict()
+        inputs['gcs'][itemid] = val_num
+        inputs['gcs_max'] = max(inputs.get('gcs_max', 0), sum(inputs['gcs'].values()))
+        visit.sofa[common.SOFA_component.CNS, hour:] = get_cns_points(inputs['gcs_max'])
+
+    elif itemid in CREATININE_ITEMIDS:
+        component, points = common.SOFA_component.RENAL, get_creatinine_points(val_num)
+
+    elif itemid in URINE_ITEMIDS:
+        # Exported as 1 when there was no output, which scores as < 200 mL
+        component, points = common.SOFA_component.RENAL, 4 if val_num > 0 else 0
+
+    if component is not None:
+        visit.sofa[component, hour] = max(visit.sofa[component, hour], points)
+
+def get_trajectory(visit):
+    """
+    SOFA score at each hour of the visit. Each component contributes its worst points so far, or its
+    aggregate so far for AGGREGATE_COMPONENTS, so the last hour holds the score over the whole timeline.
+    """
+    points = np.maximum.accumulate(visit.sofa, axis=1)
+    points[AGGREGATE_COMPONENTS] = visit.sofa[AGGREGATE_COMPONENTS]
+    return points.sum(axis=0)
+
+def get_est_mortality(score):
+    return common.SOFA_EST_MORTALITY[min(int(score), len(common.SOFA_EST_MORTALITY) - 1)]
+
+def evaluate_sofa(csv_file_path, output_csv_path=None):
+    """
+    Evaluates SOFA prediction metrics. Reads SOFA scores, estimated mortality
+    and ground truth from sofa_score.sql's export or the sofa_preds.csv written
+    by csv_to_images. Both are treated as continuous predictors, swept over
+    every threshold and compared against common.SOFA_SCORE_THRESHOLD and
+    common.SOFA_EST_THRESHOLD.
+    """
+    rows = common.SOFA_rows
+    cols = baseline_eval.load_score_columns(csv_file_path, [rows.PATIENT_ID, rows.VISIT_ID, rows.SOFA_SCORE, rows.EST_MORTALITY, rows.DIED])
+    patient_ids = cols[rows.PATIENT_ID].astype(int)
+    visit_ids   = cols[rows.VISIT_ID].astype(int)
+    score       = cols[rows.SOFA_SCORE]
+    est         = cols[rows.EST_MORTALITY]
+    died        = cols[rows.DIED].astype(int)
 
     # Evaluate the scores' predictions against the ground truth
-    print(f"\nSOFA Scores Thresholded at {common.SOFA_SCORE_THRESHOLD}:")
-    common.evaluate_predictions(Y_true, Y_pred_thresh, score=Y_pred_thresh)
-    print(f"\n\nSOFA Est Mort Thresholded at {common.SOFA_EST_THRESHOLD}:")
-    common.evaluate_predictions(Y_true, Y_pred_est, score=Y_pred_est)
+    print(f"\nSOFA Scores swept over all thresholds (fixed threshold {common.SOFA_SCORE_THRESHOLD}):")
+    baseline_eval.print_sweep("SOFA", died, score, common.SOFA_SCORE_THRESHOLD)
+    baseline_eval.print_calibration("SOFA", died, score)
+
+    print(f"\n\nSOFA Est Mort swept over all thresholds (fixed threshold {common.SOFA_EST_THRESHOLD}):")
+    baseline_eval.print_sweep("SOFA est", died, est, common.SOFA_EST_THRESHOLD)
+
+    if output_csv_path is not None:
+        baseline_eval.compare_with_model("SOFA", patient_ids, visit_ids, score, died, output_csv_path)
 
 if __name__ == "__main__":
     """
@@ -37,15 +177,16 @@ if __name__ == "__main__":
     try:
         csv_file = sys.argv[1]
     except:
-        print("Usage: python sofa.py <csv_file>")
+        print("Usage: python sofa.py <csv_file> <optional_model_output_csv>")
         raise
 
-    # Store output image name suffix if supplied, but carry on if not
+    # Store model output csv to compare against if supplied, but carry on if not
+    output_path = None
     try:
-        OUT_IMG_SUFFIX = sys.argv[2]
+        output_path = os.path.join( os.getenv('DATA_DIR'), sys.argv[2])
     except:
         pass
 
     path = os.path.join( os.getenv('DATA_DIR'), csv_file)
 
-    evaluate_sofa(path)
\ No newline at end of file
+    evaluate_sofa(path, output_path)
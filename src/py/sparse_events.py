@@ -0,0 +1,308 @@
+import os
+import json
+import uuid
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset
+import common
+
+# Event shards are written to a cohort's master path, one per batch of visits
+EVENTS_FILE_PREFIX = 'events_'
+EVENTS_FILE_EXT    = '.npz'
+
+# Fill policies for the hours between measurements
+FILL_FORWARD = 'forward'    # carry the last measured value, as csv_to_images does
+FILL_NONE    = 'none'       # the row default everywhere but measured hours
+FILL_POLICIES = [ FILL_FORWARD, FILL_NONE ]
+
+def get_row_defaults( stats: np.ndarray, method: common.Norm_method ):
+    """
+    Normalized default of each row, as Patient_visit.init_img fills a new visit's image with.
+    """
+    defaults = np.zeros( common.N_ROWS, dtype=int )
+    for row in range( common.N_ROWS ):
+        defaults[row] = common.normalize(
+            stats,
+            stats[row, common.Stats_col.VAL_DEFAULT],
+            stats[row, common.Stats_col.VAL_MIN],
+            stats[row, common.Stats_col.VAL_MAX],
+            row,
+            stats[row, common.Stats_col.VAR_TYPE],
+            method
+        )
+    return defaults
+
+def is_events_file( name: str ):
+    return name.startswith( EVENTS_FILE_PREFIX ) and name.endswith( EVENTS_FILE_EXT )
+
+def remove_events( img_path: str ):
+    """
+    Removes event shards left in img_path by a previous run.
+    """
+    if not os.path.isdir( img_path ):
+        return
+    for name in os.listdir( img_path ):
+        if is_events_file( name ):
+            os.remove( os.path.join( img_path, name ) )
+
+def write_events( patient_visits: dict, stats: np.ndarray, img_paths: dict ):
+    """
+    Writes a batch of visits to one event shard per normalization method in img_paths, instead of an image per visit.
+    Each measured cell of a visit's timeline becomes an event ( feature, hour, normalized value ), stored in CSR
+    arrays with indptr marking each visit's events. Together with the row defaults and the rows that aren't carried
+    over, stored alongside, that's all EventStore.densify needs to rebuild the image.
+    The hour of day row is kept as its first hour only, since the rest follows from it.
+    """
+    visits = list( patient_visits.values() )
+    if len( visits ) == 0:
+        return
+
+    point_rows = stats[:, common.Stats_col.VAR_TYPE] == common.Var_type.BINARY_POINT
+
+    # Unique per batch, so a targeted rebuild starting at the same visit as an earlier batch never overwrites its shard
+    name = f"{EVENTS_FILE_PREFIX}{visits[0].patient_id}_{visits[0].visit_id}_{uuid.uuid4().hex}{EVENTS_FILE_EXT}"
+
+    for method, img_path in img_paths.items():
+        os.makedirs( img_path, exist_ok=True )
+        common.save_timeline( img_path, point_rows, get_row_defaults( stats, method ) )
+
+        features = list()
+        cols     = list()
+        values   = list()
+        indptr   = [ 0 ]
+        for visit in visits:
+            observed = visit.observed.copy()
+            observed[common.Special_itemids.ADMIT_HOUR, 1:] = False
+
+            feature, col = np.nonzero( observed )
+            features.append( feature )
+            cols.append( col )
+            values.append( visit.imgs[method][feature, col] )
+            indptr.append( indptr[-1] + len( feature ) )
+
+        # Written under a name listings skip, then renamed, so readers never see a partial shard
+        tmp_path = os.path.join( img_path, '.' + name + '.tmp' + EVENTS_FILE_EXT )
+        np.savez(
+            tmp_path,
+            patient_id    = np.array( [ visit.patient_id for visit in visits ], dtype=np.int64 ),
+            visit_id      = np.array( [ visit.visit_id for visit in visits ], dtype=np.int64 ),
+            died          = np.array( [ visit.hospital_expire_flag for visit in visits ], dtype=np.int8 ),
+            indptr        = np.array( indptr, dtype=np.int64 ),
+            feature       = np.concatenate( features ).astype( np.int16 ),
+            hour          = ( np.concatenate( cols ) * common.HOURS_PER_COL ).astype( np.float32 ),
+            value         = np.concatenate( values ).astype( np.uint8 ),
+            defaults      = get_row_defaults( stats, method ).astype( np.uint8 ),
+            point_rows    = point_rows,
+            n_hours       = common.N_HOURS,
+            hours_per_col = common.HOURS_PER_COL,
+        )
+        os.replace( tmp_path, os.path.join( img_path, name ) )
+
+        check_events( visits[:common.SPARSE_CHECK_VISITS], method, img_path, name )
+
+def check_events( visits: list, method: common.Norm_method, img_path: str, name: str ):
+    """
+    Densifies visits back out of the shard they were just written to and checks the result is the
+    image generate_images would have written for them. Raises ValueError on the first mismatch.
+    """
+    if len( visits ) == 0:
+        return
+
+    store    = EventStore( img_path, [ name ] )
+    names    = [ get_visit_name( visit.patient_id, visit.visit_id, visit.hospital_expire_flag ) for visit in visits ]
+    channels = list( common.Img_channel )
+    images   = store.densify( store.lookup( names ), channels, FILL_FORWARD, np.inf ).numpy()
+
+    for visit, visit_name, image in zip( visits, names, images ):
+        # The planes generate_images stores, cast to uint8 as the png holds them
+        planes = {
+            common.Img_channel.VALUE:    visit.imgs[method].astype( np.uint8 ),
+            common.Img_channel.OBSERVED: ( visit.observed * common.NORM_OUT_MAX ).astype( np.uint8 ),
+            common.Img_channel.RECENCY:  common.get_recency( visit.observed ).astype( np.uint8 ),
+        }
+        expected  = np.stack( [ planes[c] for c in channels ] )
+        densified = np.round( image * 255.0 ).astype( np.uint8 )
+
+        if not np.array_equal( densified, expected ):
+            channel, row, col = np.argwhere( densified != expected )[0]
+            raise ValueError( f"Densified {visit_name} differs from its image in {name} at channel {channels[channel].name}, "
+                              f"row {row}, col {col}: {densified[channel, row, col]} != {expected[channel, row, col]}" )
+
+def get_visit_name( patient_id, visit_id, died ):
+    """
+    Name a visit goes by in labels.csv, the same as its image would have.
+    """
+    return f"{patient_id}_{visit_id}_{died}.png"
+
+def list_visit_names( master_path: str ):
+    """
+    Names of every visit in the event shards of master_path.
+    """
+    names = set()
+    for name in os.listdir( master_path ):
+        if is_events_file( name ):
+            with np.load( os.path.join( master_path, name ) ) as shard:
+                names.update( get_visit_name( *ids ) for ids in zip( shard['patient_id'], shard['visit_id'], shard['died'] ) )
+    return sorted( names )
+
+class EventStore:
+    """
+    Every event shard of a cohort's master path, concatenated into one set of CSR arrays.
+    Shards are read oldest first, so a visit rebuilt later by a targeted ingest replaces its earlier events.
+    names limits the store to some of the shards.
+    """
+    def __init__( self, master_path: str, names: list = None ):
+        if names is None:
+            names = [ name for name in os.listdir( master_path ) if is_events_file( name ) ]
+        shards = [ np.load( os.path.join( master_path, name ) ) for name in sorted( names, key=lambda n: os.path.getmtime( os.path.join( master_path, n ) ) ) ]
+        if len( shards ) == 0:
+            raise FileNotFoundError( f"No event shards in {master_path}" )
+
+        self.defaults      = shards[0]['defaults'].astype( np.float32 )
+        self.point_rows    = shards[0]['point_rows']
+        self.n_hours       = float( shards[0]['n_hours'] )
+        self.hours_per_col = float( shards[0]['hours_per_col'] )
+
+        counts       = np.concatenate( [ np.diff( shard['indptr'] ) for shard in shards ] )
+        self.indptr  = np.concatenate( [ [ 0 ], np.cumsum( counts ) ] ).astype( np.int64 )
+        self.feature = np.concatenate( [ shard['feature'] for shard in shards ] ).astype( np.int64 )
+        self.hour    = np.concatenate( [ shard['hour']    for shard in shards ] )
+        self.value   = np.concatenate( [ shard['value']   for shard in shards ] ).astype( np.float32 )
+
+        names = [ get_visit_name( *ids ) for shard in shards for ids in zip( shard['patient_id'], shard['visit_id'], shard['died'] ) ]
+        self.visits = { name: i for i, name in enumerate( names ) }
+
+        for shard in shards:
+            shard.close()
+
+    def lookup( self, names ):
+        """
+        Visit indices of the given visit names.
+        """
+        return np.array( [ self.visits[name] for name in names ], dtype=np.int64 )
+
+    def densify( self, visits, channels=None, fill: str = None, max_carry_hours: float = None ):
+        """
+        Rebuilds the images [batch, channels, N_ROWS, N_COLS] of a batch of visit indices at the current
+        horizon and resolution, scaled to [0, 1] like CustomImageDataset loads them. The whole batch is built
+        with a handful of array ops rather than per visit. With FILL_FORWARD and no max_carry_hours, images
+        match the ones csv_to_images would generate, which check_events verifies for a few visits of every shard at ingest. max_carry_hours limits how long a value is carried
+        before the row reverts to its default.
+        """
+        channels        = [ int(c) for c in ( common.IMG_CHANNELS if channels is None else channels ) ]
+        fill            = common.SPARSE_FILL_POLICY if fill is None else fill
+        max_carry_hours = common.SPARSE_FILL_MAX_HOURS if max_carry_hours is None else max_carry_hours
+
+        if common.N_HOURS > self.n_hours or common.HOURS_PER_COL < self.hours_per_col:
+            raise ValueError( f"Can't densify {self.n_hours}h of events at {self.hours_per_col}h columns to {common.N_HOURS}h at {common.HOURS_PER_COL}h columns" )
+
+        visits = np.asarray( visits, dtype=np.int64 )
+        batch, n_rows, n_cols = len( visits ), common.N_ROWS, common.N_COLS
+
+        # Gather the batch's events out of the CSR arrays
+        starts = self.indptr[visits]
+        counts = self.indptr[visits + 1] - starts
+        index  = np.arange( counts.sum() ) - np.repeat( np.cumsum( counts ) - counts, counts ) + np.repeat( starts, counts )
+
+        b    = np.repeat( np.arange( batch ), counts )
+        f    = self.feature[index]
+        hour = self.hour[index]
+        v    = self.value[index]
+        c    = np.floor( hour / common.HOURS_PER_COL ).astype( np.int64 )
+
+        keep = c < n_cols
+        b, f, hour, v, c = b[keep], f[keep], hour[keep], v[keep], c[keep]
+
+        # Several stored hours can fall in one column at a coarser resolution, the latest wins as in common.resample_timeline
+        cell  = ( b * n_rows + f ) * n_cols + c
+        order = np.lexsort( ( hour, cell ) )
+        cell, v = cell[order], v[order]
+        last  = np.append( cell[1:] != cell[:-1], True )
+        cell, v = cell[last], v[last]
+
+        observed = np.zeros( batch * n_rows * n_cols, dtype=bool )
+        measured = np.zeros( batch * n_rows * n_cols, dtype=np.float32 )
+        observed[cell] = True
+        measured[cell] = v
+        observed = observed.reshape( batch, n_rows, n_cols )
+        measured = measured.reshape( batch, n_rows, n_cols )
+
+        # The hour of day row is known for the whole timeline once its first hour is
+        row      = int( common.Special_itemids.ADMIT_HOUR )
+        admitted = observed[:, row, 0].copy()
+        observed[:, row, :] = admitted[:, None]
+
+        # Column of the last measurement at or before each column, -1 before the first
+        cols     = np.arange( n_cols )
+        last_col = np.maximum.accumulate( np.where( observed, cols, -1 ), axis=2 )
+
+        value = np.broadcast_to( self.defaults[None, :, None], ( batch, n_rows, n_cols ) )
+        if fill == FILL_FORWARD:
+            carry = ( last_col >= 0 ) & ~self.point_rows[None, :, None]
+            if max_carry_hours is not None:
+                carry = carry & ( ( cols - last_col ) * common.HOURS_PER_COL <= max_carry_hours )
+            value = np.where( carry, np.take_along_axis( measured, np.maximum( last_col, 0 ), axis=2 ), value )
+        elif fill != FILL_NONE:
+            raise ValueError( f"Unknown fill policy {fill}, expected one of {FILL_POLICIES}" )
+        value = np.where( observed, measured, value )
+
+        # Regenerate the hour of day reel from the admission hour, truncated like the ingest's int image
+        admit_hour = np.round( measured[:, row, 0] * 23.0 / common.NORM_OUT_MAX )
+        reel       = np.mod( np.floor( cols * common.HOURS_PER_COL )[None, :] + admit_hour[:, None], 24 )
+        value[:, row, :] = np.where( admitted[:, None], np.trunc( reel / 23.0 * common.NORM_OUT_MAX ), value[:, row, :] )
+
+        # Same as common.get_recency, truncated like the ingest's uint8 image
+        hours   = np.where( last_col >= 0, ( cols - last_col ) * common.HOURS_PER_COL, common.N_HOURS )
+        recency = np.floor( np.interp( hours, [0, common.N_HOURS], [common.NORM_OUT_MIN, common.NORM_OUT_MAX] ) )
+
+        planes = {
+            common.Img_channel.VALUE:    value,
+            common.Img_channel.OBSERVED: observed * float( common.NORM_OUT_MAX ),
+            common.Img_channel.RECENCY:  recency,
+        }
+        images = np.stack( [ planes[c] for c in channels ], axis=1 ).astype( np.float32 ) / 255.0
+
+        return torch.from_numpy( images )
+
+class SparseEventDataset( Dataset ):
+    """
+    Split of a shuffled sparse cohort. Visits are listed in labels.csv like image cohorts, and densified from
+    the master's EventStore. The DataLoader fetches whole batches through __getitems__, so each batch is densified at once.
+    """
+    def __init__( self, annotations_file, img_dir, store: EventStore, channels=None ):
+        self.img_labels = pd.read_csv( annotations_file )
+        self.img_dir    = img_dir
+        self.store      = store
+        self.channels   = channels
+        self.visits     = store.lookup( self.img_labels.iloc[:, 0] )
+
+    def __len__( self ):
+        return len( self.img_labels )
+
+    def __getitem__( self, idx ):
+        return self.__getitems__( [ idx ] )[0]
+
+    def __getitems__( self, indices ):
+        images = self.store.densify( self.visits[indices], self.channels )
+        labels = self.img_labels.iloc[indices, 1].to_numpy()
+        return [ ( images[i], labels[i] ) for i in range( len( indices ) ) ]
+
+def write_sparse_cohort( shuffled_path: str, master_path: str ):
+    """
+    Marks a shuffled cohort as sparse, pointing it at the master its splits' events live in.
+    """
+    with open( os.path.join( shuffled_path, common.SPARSE_COHORT_FILE_NAME ), 'w' ) as f:
+        json.dump( { 'master': os.path.relpath( master_path, shuffled_path ) }, f )
+
+def load_splits( data_path: str, channels=None ):
+    """
+    Returns the train, test and val SparseEventDatasets of a shuffled sparse cohort, sharing one EventStore.
+    """
+    with open( os.path.join( data_path, common.SPARSE_COHORT_FILE_NAME ), 'r' ) as f:
+        master_path = os.path.normpath( os.path.join( data_path, json.load( f )['master'] ) )
+
+    store = EventStore( master_path )
+
+    return [ SparseEventDataset( os.path.join( data_path, split, common.ANNOTATIONS_FILE_NAME ), os.path.join( data_path, split ), store, channels )
+             for split in [ 'train', 'test', 'val' ] ]
@@ -0,0 +1,90 @@
+import os
+import pytest
+
+# The modules under test need the full training environment
+for module in [ 'numpy', 'pandas', 'torch', 'torchvision', 'sklearn' ]:
+    pytest.importorskip( module )
+
+import common
+
+def write_labels( split_path, names ):
+    os.makedirs( split_path, exist_ok=True )
+    with open( os.path.join( split_path, common.ANNOTATIONS_FILE_NAME ), 'w' ) as f:
+        for name in names:
+            f.write( f"{name},{name[-5]}\n" )
+
+def test_replay_with_different_first_visit( tmp_path ):
+    current = tmp_path / 'current'
+    old     = tmp_path / 'old'
+    write_labels( current / 'train', [ '1_10_0.png', '2_20_1.png', '3_30_0.png' ] )
+    write_labels( current / 'test',  [ '4_40_0.png' ] )
+    write_labels( current / 'val',   [ '5_50_1.png' ] )
+    write_labels( old / 'train',     [ '6_60_1.png', '4_40_0.png', '7_70_0.png' ] )
+
+    dataset = common.CustomImageDataset( str( current / 'train' / common.ANNOTATIONS_FILE_NAME ), str( current / 'train' ) )
+    n_current = len( dataset )
+    common.add_replay( dataset, str( current ), str( old ), 1.0 )
+
+    # Replayed rows line up with the current ones, and the visit held out in test isn't replayed
+    assert dataset.img_labels.shape == ( n_current + 2, 2 )
+    replayed = dataset.img_labels.iloc[n_current:]
+    assert sorted( os.path.basename( name ) for name in replayed.iloc[:, 0] ) == [ '6_60_1.png', '7_70_0.png' ]
+    assert sorted( replayed.iloc[:, 1].tolist() ) == [ 0, 1 ]
+
+def test_quantize_cnn_rl():
+    import torch
+    import cnn_rl
+    import quantize
+
+    model = cnn_rl.CNN_RL( fused_recurrent=True )
+    data  = torch.rand( ( 4, ) + tuple( common.get_input_shape() ) )
+
+    # The fused LSTM has no biases, so it stays in float while the rest is quantized
+    qmodel = quantize.quantize_model( model, [ ( data, torch.zeros( 4 ) ) ], n_samples=4 )
+    assert isinstance( qmodel.convLSTM.lstm, torch.nn.LSTM )
+    assert qmodel( data ).shape == ( 4, 2 )
+
+def test_target_auc_keeps_its_epoch( monkeypatch ):
+    import torch
+    import early_stopping
+
+    monkeypatch.setattr( common, 'EARLY_STOP_PATIENCE', 3 )
+    model     = torch.nn.Linear( 2, 2 )
+    optimizer = torch.optim.SGD( model.parameters(), lr=0.1 )
+    stopper   = early_stopping.EarlyStopper( model, optimizer, 10 )
+
+    # Epoch 1 is the best by val AUC, then epoch 2 hits the target on its test AUC
+    stopper.step( 1, 0.9 )
+    with torch.no_grad():
+        model.weight.fill_( 1.0 )
+    stopper.reached_target( 2 )
+
+    summary = stopper.finish()
+    assert summary['best_epoch'] == 2
+    assert torch.all( model.weight == 1.0 )
+
+def test_mask_prefixes_point_event():
+    import torch
+    import trajectory
+
+    point, level = 10, 11
+    data = torch.zeros( ( 1, 3, common.N_ROWS, common.N_COLS ) )
+    defaults = [ 0 ] * common.N_ROWS
+    defaults[point] = 51
+
+    # A point event at hour 2 on a row otherwise at its default, and a continuous row measured from hour 1
+    data[0, common.Img_channel.VALUE, point] = defaults[point] / common.NORM_OUT_MAX
+    data[0, common.Img_channel.VALUE, point, 2] = 1.0
+    data[0, common.Img_channel.VALUE, level, 1:] = 0.5
+
+    prefixes = trajectory.mask_prefixes( data, list( common.Img_channel ), [ point ], defaults ).reshape( common.N_COLS, 3, common.N_ROWS, common.N_COLS )
+    value = prefixes[:, common.Img_channel.VALUE]
+
+    # Prefix 2 keeps the event at its own hour only, while the continuous row is carried forward
+    assert value[2, point, 2] == 1.0
+    assert torch.all( value[2, point, 3:] == defaults[point] / common.NORM_OUT_MAX )
+    assert torch.all( value[2, level, 1:] == 0.5 )
+
+    # Later prefixes keep the event where it happened
+    assert value[5, point, 2] == 1.0
+    assert torch.all( value[5, point, 3:] == defaults[point] / common.NORM_OUT_MAX )
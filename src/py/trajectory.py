@@ -0,0 +1,161 @@
+import os
+import time
+import datetime
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import common
+import export
+
+# Max prefix images per forward pass. Each visit expands to N_COLS of them
+MAX_PREFIX_BATCH = 1024
+
+# Exported models whose outputs are logits rather than softmax probabilities
+LOGIT_MODELS = [ 'inceptionv3' ]
+
+# Prefix hours whose AUC is printed after scoring
+REPORT_HOURS = [ 6, 12, 24, 36, 48 ]
+
+def mask_prefixes( data, channels=None, point_rows=None, defaults=None ):
+    """
+    Expands a batch of images [batch, channels, n_rows, n_cols] into every column prefix of each,
+    [batch * n_cols, channels, n_rows, n_cols], ordered by visit then prefix. Prefix t keeps columns 0..t
+    and shows the rest as if nothing was measured after column t: VALUE holds column t's forward-filled
+    value, OBSERVED is cleared and RECENCY keeps counting up from column t.
+    Events in point_rows aren't carried forward by the ingest, so their VALUE after column t is the row's
+    normalized default instead, as returned by common.get_stored_rows.
+    The hour of day row is known for the whole timeline, so it is left as is.
+    """
+    channels = [ int(c) for c in ( common.IMG_CHANNELS if channels is None else channels ) ]
+    batch, n_channels, n_rows, n_cols = data.shape
+
+    # source[t, c] is the column that column c of prefix t is read from
+    cols   = torch.arange( n_cols, device=data.device )
+    source = torch.minimum( cols.unsqueeze( 0 ), cols.unsqueeze( 1 ) )
+    after  = cols.unsqueeze( 0 ) > cols.unsqueeze( 1 )
+
+    # [batch, channels, n_rows, prefix, col], every prefix gathered in one indexing op
+    prefixes = data[..., source]
+    for i, c in enumerate( channels ):
+        if c == common.Img_channel.VALUE and point_rows is not None and len( point_rows ) > 0:
+            rows = torch.as_tensor( point_rows, dtype=torch.long, device=data.device )
+            fill = torch.as_tensor( defaults, dtype=data.dtype, device=data.device )[rows] / common.NORM_OUT_MAX
+            prefixes[:, i, rows] = torch.where( after, fill[:, None, None], prefixes[:, i, rows] )
+        elif c == common.Img_channel.OBSERVED:
+            prefixes[:, i] = prefixes[:, i].masked_fill( after, 0.0 )
+        elif c == common.Img_channel.RECENCY:
+            # Recency is loaded as a fraction of N_HOURS
+            elapsed = ( cols.unsqueeze( 0 ) - source ) * common.HOURS_PER_COL / common.N_HOURS
+            prefixes[:, i] = torch.clamp( prefixes[:, i] + elapsed, max=1.0 )
+
+    row = int( common.Special_itemids.ADMIT_HOUR )
+    prefixes[:, :, row] = data[:, :, row].unsqueeze( 2 )
+
+    return prefixes.permute( 0, 3, 1, 2, 4 ).reshape( batch * n_cols, n_channels, n_rows, n_cols )
+
+def to_risk( outputs: np.ndarray, logits: bool = False ):
+    """
+    Probability of the died class from a model's [n, 2] outputs.
+    """
+    if logits:
+        outputs = torch.softmax( torch.from_numpy( outputs ), dim=1 ).numpy()
+    return outputs[:, 1]
+
+def score_trajectories( run, dataloader, logits: bool = False, max_batch: int = MAX_PREFIX_BATCH, point_rows=None, defaults=None ):
+    """
+    Scores every column prefix of every visit in dataloader. run maps a batch of images to a
+    numpy array of outputs, as returned by export.load_backend. All prefixes of a loader batch are
+    built as one tensor and run in chunks of at most max_batch images, so a visit's whole
+    trajectory costs a single expanded forward pass rather than N_COLS separate passes over the split.
+    Returns an [n_visits, N_COLS] risk matrix, where column t is the risk given hours up to the end of
+    column t, and the visits' labels, in loader order. point_rows and defaults are passed on to mask_prefixes.
+    """
+    risks  = []
+    labels = []
+
+    for data, target in dataloader:
+        prefixes = mask_prefixes( data, point_rows=point_rows, defaults=defaults )
+
+        outputs = np.concatenate( [ run( chunk ) for chunk in torch.split( prefixes, max_batch ) ], axis=0 )
+        risks.append( to_risk( outputs, logits ).reshape( len( data ), common.N_COLS ) )
+        labels.append( target.numpy() )
+
+    return np.concatenate( risks, axis=0 ), np.concatenate( labels )
+
+def save_trajectories( risks: np.ndarray, img_names, path: str ):
+    """
+    Writes one row per visit, [patient_id, visit_id, died, h0...], laid out like the clinical score
+    trajectories csv_to_images writes so the two can be joined on patient and visit id.
+    """
+    # Replayed visits in a train split are listed by absolute path
+    ids = [ os.path.splitext( os.path.basename( name ) )[0].split( '_' ) for name in img_names ]
+
+    df = pd.DataFrame( risks, columns=[ f'h{i}' for i in range( common.N_COLS ) ] )
+    df.insert( 0, 'died',       [ int( i[2] ) for i in ids ] )
+    df.insert( 0, 'visit_id',   [ int( i[1] ) for i in ids ] )
+    df.insert( 0, 'patient_id', [ int( i[0] ) for i in ids ] )
+    df.to_csv( path, index=False )
+
+def score( model_path: str, data_path: str, split: str = 'val', batch_size: int = None, max_batch: int = MAX_PREFIX_BATCH ):
+    """
+    Scores the hourly risk trajectory of every visit in a split of a shuffled cohort with an exported model,
+    prints the AUC of a few prefixes and writes the trajectories to DATA_DIR.
+    """
+    export.load_metadata( model_path )
+    run = export.load_backend( model_path )
+
+    model_name = os.path.splitext( os.path.basename( model_path ) )[0]
+    common.apply_tuned_config( model_name, 'score' )
+
+    # A batch size given on the command line wins over the tuned one
+    loader_args = dict() if batch_size is None else { 'batch_size': batch_size, 'tuned': False }
+    train_loader, test_loader, val_loader = common.load_data( data_path=data_path, **loader_args )
+    loader = { 'train': train_loader, 'test': test_loader, 'val': val_loader }[split]
+
+    # Point events must not carry into later prefix hours, which needs the rows recorded at ingest
+    point_rows, defaults = common.get_stored_rows( data_path )
+    if point_rows is None:
+        print( f"Warning: {os.path.basename(data_path)} doesn't record its point event rows, regenerate it to mask them. Carrying every row forward instead" )
+
+    start_time = time.time()
+    risks, Y_true = score_trajectories( run, loader, model_name in LOGIT_MODELS, max_batch, point_rows, defaults )
+    elapsed = time.time() - start_time
+
+    print( f"\nScored {common.N_COLS} prefixes of {len( Y_true )} visits in the {split} split of {os.path.basename(data_path)} with {os.path.basename(model_path)}" )
+    print( "Took {:.2f} sec, {:.1f} visits/sec".format( elapsed, len( Y_true ) / elapsed ) )
+
+    for hour in REPORT_HOURS:
+        col = int( hour / common.HOURS_PER_COL ) - 1
+        if 0 <= col < common.N_COLS:
+            auc, acc, p, r, f = common.evaluate_predictions( Y_true, ( risks[:, col] > 0.5 ).astype( int ), score=risks[:, col] )
+            common.print_scores( f"{hour}h", acc, auc, p, r, f )
+
+    datetime_str = datetime.datetime.now().strftime( "%Y%m%d%H%M" )
+    out_path = os.path.join( os.getenv('DATA_DIR'), f'trajectory_{model_name}_{split}_{datetime_str}.csv' )
+    save_trajectories( risks, loader.dataset.img_labels.iloc[:, 0].values, out_path )
+    print( f"Wrote {out_path}" )
+
+    return risks
+
+if __name__ == "__main__":
+    """
+    Main section for when this file is invoked directly.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('model', type=str,
+                        help='Exported .pt or .onnx model, relative to DATA_DIR')
+    parser.add_argument('-c', '--cohort', type=str, nargs=1,
+                        help='Path to shuffled cohort, relative to IMAGES_DIR')
+    parser.add_argument('-s', '--split', type=str, default='val', choices=['train', 'test', 'val'],
+                        help='Which split to score')
+    parser.add_argument('-b', '--batch_size', type=int,
+                        help='Visits per loader batch. Defaults to the autotuned one, or 128')
+    parser.add_argument('--max_batch', type=int, default=MAX_PREFIX_BATCH,
+                        help='Max prefix images per forward pass')
+    args = parser.parse_args()
+
+    model_path  = os.path.join(os.getenv('DATA_DIR'), args.model)
+    cohort_path = os.path.join(os.getenv('IMAGES_DIR'), args.cohort[0])
+
+    score(model_path, cohort_path, args.split, args.batch_size, args.max_batch)
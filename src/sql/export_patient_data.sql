@@ -519,7 +519,7 @@ with total_visits as (
 			-- Many of the records have NULL valuenum and reference ranges.  
 			-- Must explicitly cast to comply with everything else downstream
 			select l.subject_id, l.hadm_id, l.itemid, a.admittime, l.charttime, (case when l.valuenum is null then 0 else l.valuenum end) as valuenum, 0 as ref_min, 0 as ref_max, a.hospital_expire_flag, a.time_in, a.gap
-			from mimic_derived.cohort a join mimic_hosp.labevents l
+			from mimic_derived.cohort a join mimic_derived.cohort_labevents l
 			on a.subject_id = l.subject_id 
 			where l.hadm_id is not null
 			and l.itemid = 51484		-- Ketones (Urine).
@@ -532,7 +532,7 @@ with total_visits as (
 		) union (
 		
 			select l.subject_id, l.hadm_id, l.itemid, a.admittime, l.charttime, (case when l.valuenum is null then 0 else l.valuenum end) as valuenum, l.ref_range_lower as ref_min, l.ref_range_upper as ref_max, a.hospital_expire_flag, a.time_in, a.gap
-			from mimic_derived.cohort a join mimic_hosp.labevents l
+			from mimic_derived.cohort a join mimic_derived.cohort_labevents l
 			on a.subject_id = l.subject_id 
 			where l.hadm_id is not null
 			and l.itemid in (
@@ -1197,7 +1197,7 @@ with total_visits as (
 	with i_items as (
 		-- consider adding: rate, rate uom fields
 		select i.subject_id, i.hadm_id, i.itemid, a.admittime, i.starttime as charttime, (case when i.amount <= 0 then 0 else 1 end) as val_num, a.hospital_expire_flag, a.time_in, a.gap
-		from mimic_derived.cohort a join mimic_icu.inputevents i 
+		from mimic_derived.cohort a join mimic_derived.cohort_inputevents i 
 		on a.subject_id = i.subject_id
 		where i.hadm_id is not null
 		and i.itemid in (
@@ -1234,7 +1234,7 @@ with total_visits as (
 	
 		-- NOTE: urine output is normal (0), we flag abnormal (1) when urine is measured and there is no appreciable output (see paper)
 		select o.subject_id, o.hadm_id, o.itemid, a.admittime, o.charttime, (case when o.value > 0 then 0 else 1 end) as val_num, a.hospital_expire_flag, a.time_in, a.gap
-		from mimic_derived.cohort a join mimic_icu.outputevents o 
+		from mimic_derived.cohort a join mimic_derived.cohort_outputevents o 
 		on a.subject_id = o.subject_id 
 		where o.hadm_id is not null
 		and o.itemid in (
@@ -1441,7 +1441,7 @@ with total_visits as (
 	
 		with tmp as (
 			select d.subject_id, d.stay_id, ii.itemid
-			from mimic_ed.diagnosis d join icd_itemid ii
+			from mimic_derived.cohort_ed_diagnosis d join icd_itemid ii
 			on d.icd_code = ii.icd_code
 			where d.stay_id is not null 
 			and d.icd_code in ( 
@@ -1519,7 +1519,7 @@ with total_visits as (
 		-- select all values of interest within first 48 hours
 	
 		select c.subject_id, c.hadm_id, c.itemid, a.admittime, c.charttime, c.value, c.valuenum, a.hospital_expire_flag, a.time_in, a.gap
-		from mimic_derived.cohort a join mimic_icu.chartevents c
+		from mimic_derived.cohort a join mimic_derived.cohort_chartevents c
 		on a.subject_id = c.subject_id 
 		where c.hadm_id is not null
 		and c.itemid in (
@@ -1543,7 +1543,7 @@ with total_visits as (
 		-- merge edstays with vitalsign so data can be associated with hadm_id
 		select e.subject_id, e.hadm_id, e.stay_id, e.intime, e.outtime, e.admittime, v.charttime, e.edregtime, e.edouttime, e.ed_limit, e.gap, e.time_in,
 			v.temperature, v.heartrate, v.resprate, v.o2sat, v.sbp, v.dbp, v.rhythm, e.hospital_expire_flag
-		from edstays e join mimic_ed.vitalsign v
+		from edstays e join mimic_derived.cohort_ed_vitalsign v
 		on v.stay_id = e.stay_id
 		where extract( epoch from age( v.charttime, e.edregtime )) between 0 and e.ed_limit
 		
@@ -0,0 +1,198 @@
+/****************************************************************************
+ * materialize_events.sql
+ *
+ * Materializes the subsets of the large event tables that export_patient_data.sql,
+ * mews_score.sql and sofa_score.sql read, restricted to visits in mimic_derived.cohort
+ * and to the itemids those scripts use. The results are kept in unlogged tables in
+ * mimic_derived, indexed on (hadm_id, itemid, charttime), so each export scans a
+ * small indexed table instead of filtering chartevents, labevents and the ED tables
+ * from scratch.
+ *
+ * Run this after setting the cohort with one of the set_cohort_xxx.sql scripts.
+ * Refreshes are incremental: visits already materialized are kept, visits newly added
+ * to the cohort are copied in and visits removed from the cohort are deleted.
+ * Visits are tracked in mimic_derived.cohort_materialized_visits.
+ *
+ * NOTE: when adding itemids to the scripts above, add them to the lists here too and
+ *       rebuild from scratch (src/py/materialize.py --rebuild), since visits that were
+ *       already materialized are not copied again.
+ *       Unlogged tables are emptied if the server crashes, so rebuild after a crash too.
+ ****************************************************************************/
+
+/*******************
+ * Tables, created empty on the first run
+ *******************/
+create unlogged table if not exists mimic_derived.cohort_materialized_visits
+(
+	hadm_id			INTEGER NOT NULL PRIMARY KEY,
+	materialized_at	TIMESTAMP NOT NULL
+);
+
+create unlogged table if not exists mimic_derived.cohort_chartevents as
+	select * from mimic_icu.chartevents with no data;
+
+create unlogged table if not exists mimic_derived.cohort_labevents as
+	select * from mimic_hosp.labevents with no data;
+
+create unlogged table if not exists mimic_derived.cohort_inputevents as
+	select * from mimic_icu.inputevents with no data;
+
+create unlogged table if not exists mimic_derived.cohort_outputevents as
+	select * from mimic_icu.outputevents with no data;
+
+-- ED tables are keyed on stay_id, so carry the visit's hadm_id along from edstays
+create unlogged table if not exists mimic_derived.cohort_ed_vitalsign as
+	select e.hadm_id, v.* from mimic_ed.vitalsign v join mimic_ed.edstays e on v.stay_id = e.stay_id with no data;
+
+create unlogged table if not exists mimic_derived.cohort_ed_diagnosis as
+	select e.hadm_id, d.* from mimic_ed.diagnosis d join mimic_ed.edstays e on d.stay_id = e.stay_id with no data;
+
+/*******************
+ * Work out which visits changed since the last refresh
+ *******************/
+drop table if exists pg_temp.new_visits;
+create temp table new_visits as
+	select distinct c.hadm_id
+	from mimic_derived.cohort c
+	except
+	select m.hadm_id
+	from mimic_derived.cohort_materialized_visits m;
+
+drop table if exists pg_temp.removed_visits;
+create temp table removed_visits as
+	select m.hadm_id
+	from mimic_derived.cohort_materialized_visits m
+	except
+	select c.hadm_id
+	from mimic_derived.cohort c;
+
+/*******************
+ * Drop visits no longer in the cohort
+ *******************/
+delete from mimic_derived.cohort_chartevents   where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_labevents     where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_inputevents   where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_outputevents  where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_ed_vitalsign  where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_ed_diagnosis  where hadm_id in ( select hadm_id from removed_visits );
+delete from mimic_derived.cohort_materialized_visits where hadm_id in ( select hadm_id from removed_visits );
+
+/*******************
+ * Copy in events for visits new to the cohort
+ *******************/
+insert into mimic_derived.cohort_chartevents
+select c.*
+from mimic_icu.chartevents c
+where c.hadm_id in (
+	select hadm_id
+	from new_visits
+)
+and c.itemid in (
+	-- export_patient_data.sql: interventions
+	227579, 227580, 227581, 227582,		-- BiPAP
+	227583,								-- CPAP
+	227287,								-- HFNC
+	226169,								-- suction
+	-- export_patient_data.sql: vital signs
+	223835,								-- FiO2
+	220045,								-- heart rate
+	223762, 223761,						-- temperature C/F
+	220210,								-- respiratory rate
+	220179, 220050,						-- blood pressure, systolic
+	220180, 220051,						-- blood pressure, diastolic
+	220277, 228232,						-- O2 saturation
+	226104,								-- conscious level (AVPU)
+	220048,								-- cardiac rhythm
+	-- export_patient_data.sql: braden / morse
+	224054, 224055, 224056, 224057, 224058, 224059,
+	227341, 227342, 227343, 227344, 227345, 227346, 227348, 227349,
+	-- sofa_score.sql
+	220052, 225312,						-- mean arterial pressure
+	225690,								-- bilirubin, total
+	220739, 223901, 223900				-- Glasgow coma scale
+);
+
+insert into mimic_derived.cohort_labevents
+select l.*
+from mimic_hosp.labevents l
+where l.hadm_id in (
+	select hadm_id
+	from new_visits
+)
+and l.itemid in (
+	-- export_patient_data.sql
+	51484, 50862, 50863, 50868, 50878, 50882, 51006, 52647, 50893, 50902,
+	50931, 50809, 51222, 50811, 51237, 51675, 51984, 50813, 50956, 51250,
+	50818, 50821, 51275, 50820, 50970, 51265, 50971, 51277, 50983, 50885,
+	50976, 51002, 51003, 51300, 51301,
+	-- sofa_score.sql
+	50912								-- creatinine
+);
+
+insert into mimic_derived.cohort_inputevents
+select i.*
+from mimic_icu.inputevents i
+where i.hadm_id in (
+	select hadm_id
+	from new_visits
+)
+and i.itemid in (
+	-- export_patient_data.sql
+	225828, 225158, 220864, 220862, 226367, 227072,		-- interventions
+	225168, 220970, 225170, 225171,						-- transfusions
+	-- sofa_score.sql
+	221653, 221662, 221906								-- dobutamine, dopamine, norepinephrine
+);
+
+insert into mimic_derived.cohort_outputevents
+select o.*
+from mimic_icu.outputevents o
+where o.hadm_id in (
+	select hadm_id
+	from new_visits
+)
+and o.itemid in (
+	-- export_patient_data.sql, mews_score.sql, sofa_score.sql: urine output
+	226627, 226631, 227489, 226559
+);
+
+insert into mimic_derived.cohort_ed_vitalsign
+select e.hadm_id, v.*
+from mimic_ed.vitalsign v join mimic_ed.edstays e
+on v.stay_id = e.stay_id
+where e.hadm_id in (
+	select hadm_id
+	from new_visits
+);
+
+insert into mimic_derived.cohort_ed_diagnosis
+select e.hadm_id, d.*
+from mimic_ed.diagnosis d join mimic_ed.edstays e
+on d.stay_id = e.stay_id
+where e.hadm_id in (
+	select hadm_id
+	from new_visits
+);
+
+insert into mimic_derived.cohort_materialized_visits( hadm_id, materialized_at )
+select n.hadm_id, now()
+from new_visits n;
+
+/*******************
+ * Indexes, built once after the first fill and maintained incrementally afterwards
+ *******************/
+create index if not exists cohort_chartevents_idx  on mimic_derived.cohort_chartevents  ( hadm_id, itemid, charttime );
+create index if not exists cohort_labevents_idx    on mimic_derived.cohort_labevents    ( hadm_id, itemid, charttime );
+create index if not exists cohort_inputevents_idx  on mimic_derived.cohort_inputevents  ( hadm_id, itemid, starttime );
+create index if not exists cohort_outputevents_idx on mimic_derived.cohort_outputevents ( hadm_id, itemid, charttime );
+create index if not exists cohort_ed_vitalsign_idx on mimic_derived.cohort_ed_vitalsign ( hadm_id, charttime );
+create index if not exists cohort_ed_vitalsign_stay_idx on mimic_derived.cohort_ed_vitalsign ( stay_id );
+create index if not exists cohort_ed_diagnosis_idx on mimic_derived.cohort_ed_diagnosis ( stay_id, icd_code );
+
+analyze mimic_derived.cohort_materialized_visits;
+analyze mimic_derived.cohort_chartevents;
+analyze mimic_derived.cohort_labevents;
+analyze mimic_derived.cohort_inputevents;
+analyze mimic_derived.cohort_outputevents;
+analyze mimic_derived.cohort_ed_vitalsign;
+analyze mimic_derived.cohort_ed_diagnosis;
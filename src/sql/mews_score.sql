@@ -23,7 +23,7 @@ with visit_ids as(
 	 ******************************************/
 	(
 		select c.subject_id, c.hadm_id, c.itemid, c.charttime, c.value, c.valuenum
-		from mimic_icu.chartevents c join mimic_core.admissions a 
+		from mimic_derived.cohort_chartevents c join mimic_core.admissions a 
 		on c.hadm_id = a.hadm_id 
 		where c.itemid in (
 			220210,			-- respiratory rate
@@ -41,7 +41,7 @@ with visit_ids as(
 	) union (
 		-- Hourly Urine (for 2 hours)
 		select o.subject_id, o.hadm_id, o.itemid, o.charttime, NULL as value, o.value as valuenum
-		from mimic_icu.outputevents o join mimic_core.admissions a 
+		from mimic_derived.cohort_outputevents o join mimic_core.admissions a 
 		on o.hadm_id = a.hadm_id 
 		where itemid in (
 			226627, 	-- OR
@@ -51,7 +51,7 @@ with visit_ids as(
 	 ******************************************/
 	(
 		select c.subject_id, c.hadm_id, c.itemid, c.charttime, c.value, c.valuenum
-		from mimic_icu.chartevents c join mimic_core.admissions a3 
+		from mimic_derived.cohort_chartevents c join mimic_core.admissions a3 
 		on c.hadm_id = a3.hadm_id 
 		where c.itemid in (
 			223835,					-- FiO2
@@ -66,7 +66,7 @@ with visit_ids as(
 		
 	) union ( 
 		select l.subject_id, l.hadm_id, l.itemid, l.charttime, l.value, l.valuenum
-		from mimic_hosp.labevents l join mimic_core.admissions a2 
+		from mimic_derived.cohort_labevents l join mimic_core.admissions a2 
 		on l.hadm_id = a2.hadm_id 
 		where l.itemid in ( 
 			50821,		-- Partial Pressure Oxygen (PaO2)
@@ -84,7 +84,7 @@ with visit_ids as(
 	) union ( 
 		-- Input events (hypotension)
 		select i.subject_id, i.hadm_id, i.itemid, i.starttime as charttime, NULL as value, i.amount as valuenum
-		from mimic_icu.inputevents i join mimic_core.admissions a 
+		from mimic_derived.cohort_inputevents i join mimic_core.admissions a 
 		on i.hadm_id = a.hadm_id 
 		where i.itemid in (
 			221653,				-- Dobutamine		
@@ -100,7 +100,7 @@ with visit_ids as(
 	) union ( 
 		-- Output events (urine)
 		select a.subject_id, o.hadm_id, o.itemid, o.charttime, null as value, o.value as valuenum
-		from mimic_icu.outputevents o join mimic_core.admissions a 
+		from mimic_derived.cohort_outputevents o join mimic_core.admissions a 
 		on o.hadm_id = a.hadm_id 
 		where o.itemid in ( 
 			226627, 226631, 227489		-- Urine: OR, PACU, volume
@@ -237,7 +237,7 @@ with visit_ids as(
 			-- we include the 'minute' to ensure the Eye, Motor, and Verbal scores are grouped by timestamp
 			-- as patients often had multiple scores recorded throughout their stay, sometimes only minutes apart.
 			select c.hadm_id, c.valuenum, floor( extract( epoch from age (c.charttime, a.admittime)) / 60 ) as "minute" 
-			from mimic_icu.chartevents c join mimic_core.admissions a 
+			from mimic_derived.cohort_chartevents c join mimic_core.admissions a 
 			on c.hadm_id = a.hadm_id 
 			where c.itemid in (
 				220739, 223901, 223900	-- Full Glasgow Coma Scale
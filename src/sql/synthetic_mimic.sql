@@ -0,0 +1,291 @@
+/****************************************************************************
+ * synthetic_mimic.sql
+ *
+ * Creates a tiny MIMIC-IV shaped database for testing the extraction pipeline
+ * without access to MIMIC-IV. Only the tables and columns read by the
+ * set_cohort_xxx.sql, export_patient_data.sql, mews_score.sql and sofa_score.sql
+ * scripts are defined, and they hold a handful of made up events for 3 patients:
+ *
+ *   10000032: two ICU visits 50 days apart (the second is a readmission), survived both
+ *   10000084: one ICU visit with an ED stay beforehand, died
+ *   10000117: one 24 hour visit, too short to make the cohort
+ *
+ * Run this in an empty database, e.g.
+ *   createdb mimic_synthetic && psql -d mimic_synthetic -f synthetic_mimic.sql
+ * then run the extraction against it, e.g. from src/py
+ *   python ./extract.py synthetic --dsn "dbname=mimic_synthetic"
+ ****************************************************************************/
+
+drop schema if exists mimic_core    cascade;
+drop schema if exists mimic_hosp    cascade;
+drop schema if exists mimic_icu     cascade;
+drop schema if exists mimic_ed      cascade;
+drop schema if exists mimic_derived cascade;
+
+create schema mimic_core;
+create schema mimic_hosp;
+create schema mimic_icu;
+create schema mimic_ed;
+create schema mimic_derived;
+
+/*******************
+ * Tables
+ *******************/
+create table mimic_core.patients
+(
+	subject_id		INTEGER NOT NULL,
+	gender			VARCHAR(1) NOT NULL,
+	anchor_age		SMALLINT,
+	anchor_year		SMALLINT,
+	dod				TIMESTAMP
+);
+
+create table mimic_core.admissions
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER NOT NULL,
+	admittime		TIMESTAMP NOT NULL,
+	dischtime		TIMESTAMP,
+	deathtime		TIMESTAMP,
+	admission_type	VARCHAR(40),
+	ethnicity		VARCHAR(80),
+	edregtime		TIMESTAMP,
+	edouttime		TIMESTAMP,
+	hospital_expire_flag SMALLINT
+);
+
+create table mimic_core.transfers
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER,
+	transfer_id		INTEGER NOT NULL,
+	eventtype		VARCHAR(10),
+	careunit		VARCHAR(255),
+	intime			TIMESTAMP,
+	outtime			TIMESTAMP
+);
+
+create table mimic_hosp.labevents
+(
+	labevent_id		INTEGER NOT NULL,
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER,
+	itemid			INTEGER NOT NULL,
+	charttime		TIMESTAMP,
+	value			VARCHAR(200),
+	valuenum		DOUBLE PRECISION,
+	ref_range_lower	DOUBLE PRECISION,
+	ref_range_upper	DOUBLE PRECISION
+);
+
+create table mimic_hosp.emar
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER,
+	emar_id			VARCHAR(25) NOT NULL,
+	charttime		TIMESTAMP NOT NULL,
+	event_txt		VARCHAR(100)
+);
+
+create table mimic_hosp.emar_detail
+(
+	subject_id		INTEGER NOT NULL,
+	emar_id			VARCHAR(25) NOT NULL,
+	emar_seq		INTEGER NOT NULL,
+	product_code	VARCHAR(30)
+);
+
+create table mimic_icu.chartevents
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	charttime		TIMESTAMP NOT NULL,
+	itemid			INTEGER NOT NULL,
+	value			VARCHAR(200),
+	valuenum		DOUBLE PRECISION
+);
+
+create table mimic_icu.inputevents
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	starttime		TIMESTAMP NOT NULL,
+	endtime			TIMESTAMP NOT NULL,
+	itemid			INTEGER NOT NULL,
+	amount			DOUBLE PRECISION
+);
+
+create table mimic_icu.outputevents
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	charttime		TIMESTAMP NOT NULL,
+	itemid			INTEGER NOT NULL,
+	value			DOUBLE PRECISION
+);
+
+create table mimic_icu.procedureevents
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	starttime		TIMESTAMP NOT NULL,
+	endtime			TIMESTAMP NOT NULL,
+	itemid			INTEGER NOT NULL,
+	value			DOUBLE PRECISION
+);
+
+create table mimic_ed.edstays
+(
+	subject_id		INTEGER NOT NULL,
+	hadm_id			INTEGER,
+	stay_id			INTEGER NOT NULL,
+	intime			TIMESTAMP NOT NULL,
+	outtime			TIMESTAMP NOT NULL
+);
+
+create table mimic_ed.diagnosis
+(
+	subject_id		INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	seq_num			INTEGER NOT NULL,
+	icd_code		VARCHAR(8) NOT NULL
+);
+
+create table mimic_ed.vitalsign
+(
+	subject_id		INTEGER NOT NULL,
+	stay_id			INTEGER NOT NULL,
+	charttime		TIMESTAMP NOT NULL,
+	temperature		NUMERIC,
+	heartrate		NUMERIC,
+	resprate		NUMERIC,
+	o2sat			NUMERIC,
+	sbp				INTEGER,
+	dbp				INTEGER,
+	rhythm			TEXT,
+	pain			TEXT
+);
+
+/*******************
+ * Patients and visits
+ *******************/
+insert into mimic_core.patients( subject_id, gender, anchor_age, anchor_year, dod ) values
+	( 10000032, 'F', 52, 2150, null ),
+	( 10000084, 'M', 77, 2150, '2150-03-13 21:00:00' ),
+	( 10000117, 'F', 34, 2150, null );
+
+insert into mimic_core.admissions( subject_id, hadm_id, admittime, dischtime, deathtime, admission_type, ethnicity, edregtime, edouttime, hospital_expire_flag ) values
+	( 10000032, 22595853, '2150-01-01 08:00:00', '2150-01-05 12:00:00', null,                  'EW EMER.', 'WHITE',                  null,                  null,                  0 ),
+	( 10000032, 22841357, '2150-02-20 10:30:00', '2150-02-24 09:00:00', null,                  'URGENT',   'WHITE',                  null,                  null,                  0 ),
+	( 10000084, 23052089, '2150-03-10 14:00:00', '2150-03-13 21:00:00', '2150-03-13 21:00:00', 'EW EMER.', 'BLACK/AFRICAN AMERICAN', '2150-03-10 11:00:00', '2150-03-10 14:00:00', 1 ),
+	( 10000117, 27988844, '2150-04-02 09:00:00', '2150-04-03 09:00:00', null,                  'ELECTIVE', 'ASIAN',                  null,                  null,                  0 );
+
+insert into mimic_core.transfers( subject_id, hadm_id, transfer_id, eventtype, careunit, intime, outtime ) values
+	( 10000032, 22595853, 30000001, 'admit',     'Medical Intensive Care Unit (MICU)', '2150-01-01 08:00:00', '2150-01-03 08:00:00' ),
+	( 10000032, 22595853, 30000002, 'transfer',  'Medicine',                           '2150-01-03 08:00:00', '2150-01-05 12:00:00' ),
+	( 10000032, 22595853, 30000003, 'discharge', null,                                 '2150-01-05 12:00:00', null ),
+	( 10000032, 22841357, 30000004, 'admit',     'Medical Intensive Care Unit (MICU)', '2150-02-20 10:30:00', '2150-02-24 09:00:00' ),
+	( 10000084, 23052089, 30000005, 'ED',        'Emergency Department',               '2150-03-10 11:00:00', '2150-03-10 14:00:00' ),
+	( 10000084, 23052089, 30000006, 'admit',     'Coronary Care Unit (CCU)',           '2150-03-10 14:00:00', '2150-03-13 21:00:00' ),
+	( 10000117, 27988844, 30000007, 'admit',     'Surgery',                            '2150-04-02 09:00:00', '2150-04-03 09:00:00' );
+
+insert into mimic_ed.edstays( subject_id, hadm_id, stay_id, intime, outtime ) values
+	( 10000084, 23052089, 35000001, '2150-03-10 11:00:00', '2150-03-10 14:00:00' );
+
+insert into mimic_ed.diagnosis( subject_id, stay_id, seq_num, icd_code ) values
+	( 10000084, 35000001, 1, 'I454' );
+
+insert into mimic_ed.vitalsign( subject_id, stay_id, charttime, temperature, heartrate, resprate, o2sat, sbp, dbp, rhythm, pain ) values
+	( 10000084, 35000001, '2150-03-10 11:30:00', 99.1, 112, 24, 93, 96,  58, 'Atrial Fibrillation', '4' ),
+	( 10000084, 35000001, '2150-03-10 13:00:00', 99.5, 118, 26, 91, 88,  52, 'Atrial Fibrillation', '5' );
+
+/*******************
+ * Events
+ *******************/
+insert into mimic_icu.chartevents( subject_id, hadm_id, stay_id, charttime, itemid, value, valuenum ) values
+	-- 10000032, first visit: stable
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 220045, '84',    84   ),	-- heart rate
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 220210, '16',    16   ),	-- respiratory rate
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 220179, '124',   124  ),	-- systolic blood pressure
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 220180, '78',    78   ),	-- diastolic blood pressure
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 220277, '97',    97   ),	-- O2 saturation
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 223762, '36.9',  36.9 ),	-- temperature C
+	( 10000032, 22595853, 31000001, '2150-01-01 09:00:00', 226104, 'Alert', null ),	-- AVPU
+	( 10000032, 22595853, 31000001, '2150-01-01 10:00:00', 224054, '3',     3    ),	-- Braden sensory perception
+	( 10000032, 22595853, 31000001, '2150-01-01 10:00:00', 227341, '0',     0    ),	-- Morse history of falling
+	( 10000032, 22595853, 31000001, '2150-01-01 11:00:00', 220739, '4',     4    ),	-- GCS eye
+	( 10000032, 22595853, 31000001, '2150-01-01 11:00:00', 223900, '5',     5    ),	-- GCS verbal
+	( 10000032, 22595853, 31000001, '2150-01-01 11:00:00', 223901, '6',     6    ),	-- GCS motor
+	( 10000032, 22595853, 31000001, '2150-01-02 09:00:00', 220045, '78',    78   ),
+	( 10000032, 22595853, 31000001, '2150-01-02 09:00:00', 223835, '40',    40   ),	-- FiO2
+	( 10000032, 22595853, 31000001, '2150-01-02 09:00:00', 220052, '82',    82   ),	-- mean arterial pressure
+	-- 10000032, second visit
+	( 10000032, 22841357, 31000002, '2150-02-20 11:00:00', 220045, '96',    96   ),
+	( 10000032, 22841357, 31000002, '2150-02-20 11:00:00', 220210, '20',    20   ),
+	( 10000032, 22841357, 31000002, '2150-02-20 11:00:00', 223761, '100.9', 100.9 ),	-- temperature F
+	( 10000032, 22841357, 31000002, '2150-02-21 02:00:00', 227583, 'On',    null ),	-- CPAP
+	-- 10000084: deteriorating
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 220045, '124',   124  ),
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 220210, '28',    28   ),
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 220050, '82',    82   ),	-- arterial systolic blood pressure
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 220051, '48',    48   ),	-- arterial diastolic blood pressure
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 228232, '90',    90   ),	-- O2 saturation
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 223762, '38.8',  38.8 ),
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 226104, 'Arouse to Voice', null ),
+	( 10000084, 23052089, 31000003, '2150-03-10 15:00:00', 220048, 'AF (Atrial Fibrillation)', null ),	-- cardiac rhythm
+	( 10000084, 23052089, 31000003, '2150-03-10 16:00:00', 223835, '60',    60   ),
+	( 10000084, 23052089, 31000003, '2150-03-10 16:00:00', 225312, '61',    61   ),	-- mean arterial pressure
+	( 10000084, 23052089, 31000003, '2150-03-10 16:00:00', 227579, '8',     8    ),	-- BiPAP EPAP
+	( 10000084, 23052089, 31000003, '2150-03-11 06:00:00', 220739, '2',     2    ),
+	( 10000084, 23052089, 31000003, '2150-03-11 06:00:00', 223900, '2',     2    ),
+	( 10000084, 23052089, 31000003, '2150-03-11 06:00:00', 223901, '4',     4    ),
+	( 10000084, 23052089, 31000003, '2150-03-11 20:00:00', 220045, '136',   136  ),
+	( 10000084, 23052089, 31000003, '2150-03-11 20:00:00', 226104, 'Unresponsive', null ),
+	-- 10000117: outside the cohort
+	( 10000117, 27988844, 31000004, '2150-04-02 10:00:00', 220045, '72',    72   );
+
+insert into mimic_hosp.labevents( labevent_id, subject_id, hadm_id, itemid, charttime, value, valuenum, ref_range_lower, ref_range_upper ) values
+	( 1,  10000032, 22595853, 50983, '2150-01-01 10:00:00', '139',  139,  133,  145  ),	-- sodium
+	( 2,  10000032, 22595853, 50971, '2150-01-01 10:00:00', '4.1',  4.1,  3.3,  5.4  ),	-- potassium
+	( 3,  10000032, 22595853, 50912, '2150-01-01 10:00:00', '0.9',  0.9,  0.4,  1.1  ),	-- creatinine
+	( 4,  10000032, 22595853, 51265, '2150-01-01 10:00:00', '210',  210,  150,  440  ),	-- platelets
+	( 5,  10000032, 22595853, 51301, '2150-01-01 10:00:00', '7.2',  7.2,  4,    11   ),	-- WBC
+	( 6,  10000032, 22595853, 50821, '2150-01-02 09:30:00', '92',   92,   85,   105  ),	-- PaO2
+	( 7,  10000032, 22841357, 50983, '2150-02-20 12:00:00', '141',  141,  133,  145  ),
+	( 8,  10000032, 22841357, 51484, '2150-02-20 12:00:00', null,   null, null, null ),	-- ketones (urine)
+	( 9,  10000084, 23052089, 50983, '2150-03-10 15:30:00', '131',  131,  133,  145  ),
+	( 10, 10000084, 23052089, 50912, '2150-03-10 15:30:00', '3.8',  3.8,  0.5,  1.2  ),
+	( 11, 10000084, 23052089, 51265, '2150-03-10 15:30:00', '42',   42,   150,  440  ),
+	( 12, 10000084, 23052089, 50885, '2150-03-10 15:30:00', '2.4',  2.4,  0,    1.5  ),	-- bilirubin
+	( 13, 10000084, 23052089, 50813, '2150-03-10 15:30:00', '4.2',  4.2,  0.5,  2    ),	-- lactate
+	( 14, 10000084, 23052089, 50821, '2150-03-10 16:30:00', '64',   64,   85,   105  ),
+	( 15, 10000084, 23052089, 51006, '2150-03-11 06:00:00', '58',   58,   6,    20   );	-- BUN
+
+insert into mimic_hosp.emar( subject_id, hadm_id, emar_id, charttime, event_txt ) values
+	( 10000032, 22595853, '10000032-1', '2150-01-01 12:00:00', 'Administered' ),
+	( 10000084, 23052089, '10000084-1', '2150-03-10 17:00:00', 'Administered' ),
+	( 10000084, 23052089, '10000084-2', '2150-03-11 05:00:00', 'Not Given' );
+
+insert into mimic_hosp.emar_detail( subject_id, emar_id, emar_seq, product_code ) values
+	( 10000032, '10000032-1', 1, 'VANC1000NS' ),
+	( 10000084, '10000084-1', 1, 'VANC1000NS' ),
+	( 10000084, '10000084-2', 1, 'VANC1000NS' );
+
+insert into mimic_icu.inputevents( subject_id, hadm_id, stay_id, starttime, endtime, itemid, amount ) values
+	( 10000032, 22595853, 31000001, '2150-01-01 13:00:00', '2150-01-01 14:00:00', 225158, 500  ),	-- normal saline bolus
+	( 10000084, 23052089, 31000003, '2150-03-10 16:00:00', '2150-03-11 16:00:00', 221906, 0.15 ),	-- norepinephrine
+	( 10000084, 23052089, 31000003, '2150-03-10 18:00:00', '2150-03-10 20:00:00', 225168, 350  );	-- packed red blood cells
+
+insert into mimic_icu.outputevents( subject_id, hadm_id, stay_id, charttime, itemid, value ) values
+	( 10000032, 22595853, 31000001, '2150-01-01 15:00:00', 226559, 120 ),	-- foley
+	( 10000084, 23052089, 31000003, '2150-03-10 17:00:00', 226559, 20  ),
+	( 10000084, 23052089, 31000003, '2150-03-11 07:00:00', 226559, 0   );
+
+insert into mimic_icu.procedureevents( subject_id, hadm_id, stay_id, starttime, endtime, itemid, value ) values
+	( 10000032, 22595853, 31000001, '2150-01-01 09:30:00', '2150-01-01 09:30:00', 225401, 1    ),	-- blood culture
+	( 10000084, 23052089, 31000003, '2150-03-10 15:45:00', '2150-03-10 16:15:00', 221214, 1    ),	-- CT scan
+	( 10000084, 23052089, 31000003, '2150-03-12 02:00:00', '2150-03-12 02:20:00', 225466, 20   );	-- cardiac arrest